@@ -6,11 +6,12 @@ import json
 import time
 import traceback as tb
 
-import numpy
 from aiohttp import web
 
+from places.chunking import get_sentence_hashes
+from places.db import content_hash
 from places.utils import called_by, extract_text
-from places.vectors import build_vector
+from places.vectors import PageVectors, extract_page
 
 apis = web.RouteTableDef()
 
@@ -38,49 +39,47 @@ async def index_doc(request):
             # only works locally
             data["text"] = extract_text(data["filename"])
 
+        # the page did not change since it was indexed
+        digest = content_hash(data["text"])
+        try:
+            previous = request.app.pages_db.get(url, html=False, text=False)
+        except KeyError:
+            previous = {}
+        if previous.get("hash") == digest:
+            return await request.app.json_resp({"result": "unchanged"}, 200)
+
         # storing the page
         request.app.pages_db.set(url, {"html": data["text"]})
-        v_payload = json.dumps({"url": url, "text": data["text"]})
-
-        resp = build_vector(v_payload)
-
-        # for some reason, running in a separate process blocks everything in docker
-        # XXX to dig
-        # try:
-        #    resp = await request.app.run_in_executor(build_vector, v_payload)
-        # except Exception as e:
-        #    print(f"Failed to vectorize {repr(e)}")
-        #    return await request.app.json_resp({"error": str(e)}, 400)
-
-        resp = json.loads(resp)
-        print("Vectorize")
 
-        if "error" in resp:
-            print(f"Failed to vectorize {resp['error']}")
-            return await request.app.json_resp(resp, 400)
-
-        vectors = resp["vectors"]
-        sentences = resp["sentences"]
-        title = resp["title"]
+        try:
+            title, sentences, lang, text = await request.app.workers.run(
+                extract_page, url, data["text"]
+            )
+        except Exception as e:
+            print(f"Failed to vectorize {repr(e)}")
+            return await request.app.json_resp(error_to_json(e), 400)
 
         if len(sentences) < 5:
             print(f"only {len(sentences)} skipping")
+            get_sentence_hashes().release(url, sentences)
+            if "hash" in previous:
+                # the previous version of the page was indexed
+                await request.app.client.delete_urls([url])
+            request.app.pages_db.set(url, {"hash": digest})
             return await request.app.json_resp(
                 {"result": f"only {len(sentences)} skipping"}, 200
             )
 
-        points = []
-
-        for idx, (vec, sentence) in enumerate(zip(vectors, sentences, strict=True)):
-            try:
-                point = request.app.client.create_point(
-                    idx, url, title, list(numpy.asfarray(vec)), sentence
-                )
-            except Exception as e:
-                print("Failed to create a point")
-                return await request.app.json_resp({"error": str(e)}, 400)
+        # the batcher encodes these sentences along with other pages
+        vectors = await request.app.batcher.embed(sentences)
+        page = PageVectors(url, title, sentences, lang, text, vectors)
+        print("Vectorize")
 
-            points.append(point)
+        try:
+            points = page.points(request.app.client)
+        except Exception as e:
+            print("Failed to create a point")
+            return await request.app.json_resp({"error": str(e)}, 400)
 
         try:
             resp = await request.app.client.index(points=points)
@@ -92,8 +91,11 @@ async def index_doc(request):
             res = await request.app.json_resp(resp)
         except Exception as e:
             print("Failed to send points to vector db")
+            # other pages can index these sentences
+            get_sentence_hashes().release(url)
             return await request.app.json_resp({"error": str(e)}, 400)
 
+        request.app.pages_db.set(url, {"hash": digest})
         await request.app.db.indexed(url)
         return res
 
@@ -105,7 +107,7 @@ async def index_doc(request):
 async def remove_index(request):
     domain = request.rel_url.query["domain"]
     await request.app.db.set_skip(domain, True)
-    # TODO: remove indexed content...
+    request.app.purge(domain)
     raise web.HTTPFound("/admin")
 
 
@@ -116,6 +118,12 @@ async def remove_skip(request):
     raise web.HTTPFound("/admin")
 
 
+@apis.get("/purge_jobs")
+async def purge_jobs(request):
+    jobs = [job.stats() for job in request.app.purge_jobs.values()]
+    return web.json_response(jobs)
+
+
 @apis.get("/domain_info")
 async def info(request):
     url = request.rel_url.query["url"]
@@ -123,6 +131,19 @@ async def info(request):
     return web.json_response(res)
 
 
+@apis.get("/stats")
+async def stats(request):
+    batcher = request.app.batcher
+    res = {
+        "query_cache": request.app.query_cache.stats(),
+        "result_cache": request.app.result_cache.stats(),
+        "embeddings": {"batches": batcher.batches, "sentences": batcher.sentences},
+        # points the language and date filters leave out
+        "unfiltered_points": await request.app.client.count_unfiltered(),
+    }
+    return web.json_response(res)
+
+
 @apis.get("/answer/{uuid}")
 async def answer(request):
     uuid = request.match_info["uuid"]
@@ -4,16 +4,20 @@
 import asyncio
 import json
 import os
-from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 
-import numpy
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
 from places.backends import get_db
-from places.db import DB, Pages
+from places.batcher import EmbeddingBatcher
+from places.cache import QueryCache, ResultCache
+from places.chunking import get_sentence_hashes
+from places.db import DB, PAGES_DIR, Pages
+from places.purge import PENDING, RUNNING, PurgeJob
 from places.utils import get_webext_version
-from places.vectors import model
+from places.vectors import MODEL
+from places.workers import WorkerPool
 
 HERE = os.path.dirname(__file__)
 
@@ -23,31 +27,100 @@ class PlacesApplication(web.Application):
         super().__init__(client_max_size=None)
         self.env = Environment(loader=FileSystemLoader(os.path.join(HERE, "templates")))
         self.client = get_db(**args)
-        self.executor = ProcessPoolExecutor()
+        self.workers = WorkerPool(args.get("workers", 2))
         self.on_startup.append(self._startup)
         self.on_cleanup.append(self._cleanup)
-        self.pages_db = Pages("/tmp/pages")
+        self.pages_db = Pages(PAGES_DIR)
         self.db = DB()
+        self.batcher = EmbeddingBatcher(
+            self.encode,
+            max_batch_size=args.get("embed_batch_size", 64),
+            max_wait=args.get("embed_max_wait", 20) / 1000,
+        )
+        self.query_cache = QueryCache(
+            self.encode,
+            max_size=args.get("query_cache_size", 1024),
+            path=args.get("query_cache"),
+            model=MODEL,
+        )
+        self.result_cache = ResultCache(
+            args.get("result_cache_size", 256), ttl=args.get("result_cache_ttl", 60)
+        )
+        # removals of blocked domains, by domain
+        self.purge_jobs = {}
+        self._purge_tasks = set()
 
     async def _startup(self, app):
         self["loop"] = asyncio.get_running_loop()
         await self.db.check_db()
+        await self.client.init_db()
+        self.batcher.start()
 
     async def _cleanup(self, app):
-        self.executor.shutdown()
-
-    async def query(self, sentence):
-        # vectorize the query
-        embedding = await self.run_in_executor(model.encode, [sentence])
-        vector = numpy.asfarray(embedding[0])
-        vector = list(vector)
-        hits = []
-        async for hit in self.client.search(query_vector=vector, limit=10):
-            hits.append(hit)
-        return hits
-
-    def init_db(self):
-        self.client.init_db()
+        for task in self._purge_tasks:
+            task.cancel()
+        await asyncio.gather(*self._purge_tasks, return_exceptions=True)
+        await self.batcher.stop()
+        self.workers.shutdown()
+        self.query_cache.close()
+        self.pages_db.close()
+        await self.db.close()
+        await self.client.close()
+
+    async def encode(self, sentences):
+        return await self.workers.encode(sentences)
+
+    async def search(self, sentence, limit=10, filters=None):
+        """
+        Returns the hits of a query grouped by page, and the page urls.
+
+        `filters` restricts the hits, see places.filters.
+        """
+        # vectorize the query, unless it was seen recently
+        vector = await self.query_cache.get(sentence)
+        # read before searching, so results racing with an update are dropped
+        generation = self.client.generation
+        key = (vector.tobytes(), limit, tuple(sorted((filters or {}).items())))
+        result = self.result_cache.get(generation, key)
+        if result is not None:
+            return result
+
+        res = OrderedDict()
+        urls = []
+        async for hit in self.client.search(
+            query_vector=vector, limit=limit, filters=filters
+        ):
+            url = hit["url"]
+            page = url, hit["title"]
+            sentence = hit["sentence"]
+            if url not in urls:
+                urls.append(url)
+
+            if page in res:
+                if sentence not in res[page]:
+                    res[page].append(sentence)
+            else:
+                res[page] = [sentence]
+
+        hits = [list(k) + [sentences] for k, sentences in res.items()]
+        self.result_cache.set(generation, key, (hits, urls))
+        return hits, urls
+
+    def purge(self, domain):
+        """
+        Starts removing the indexed content of a domain in the background.
+        """
+        job = self.purge_jobs.get(domain)
+        if job is not None and job.state in (PENDING, RUNNING):
+            return job
+        job = PurgeJob(
+            domain, self.client, self.pages_db, self.db, get_sentence_hashes()
+        )
+        self.purge_jobs[domain] = job
+        task = asyncio.create_task(job.run())
+        self._purge_tasks.add(task)
+        task.add_done_callback(self._purge_tasks.discard)
+        return job
 
     async def get_db_info(self):
         return await self.client.get_db_info()
@@ -72,11 +145,11 @@ class PlacesApplication(web.Application):
         resp.set_status(status)
         return resp
 
-    def task_executor(self, function, *args, **kw):
-        return self["loop"].run_in_executor(self.executor, function, *args, **kw)
+    def task_executor(self, function, *args):
+        return self["loop"].run_in_executor(self.workers.executor, function, *args)
 
-    async def run_in_executor(self, function, *args, **kw):
-        task = self["loop"].run_in_executor(self.executor, function, *args, **kw)
+    async def run_in_executor(self, function, *args):
+        task = self["loop"].run_in_executor(self.workers.executor, function, *args)
         await task
 
         if task.exception() is not None:
@@ -1,60 +1,347 @@
+import asyncio
 import hashlib
+import time
 
-from qdrant_client import QdrantClient
+import httpx
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models
 from qdrant_client.models import PointStruct
 
+from places.policy import get_hostname, in_domain, parent_domains
+
+_PAYLOAD_INDEXES = [
+    ("url", models.PayloadSchemaType.KEYWORD),
+    ("domains", models.PayloadSchemaType.KEYWORD),
+    ("lang", models.PayloadSchemaType.KEYWORD),
+    ("ts", models.PayloadSchemaType.FLOAT),
+]
+
+
+_MISSING_DOMAINS = models.Filter(
+    must=[models.IsEmptyCondition(is_empty=models.PayloadField(key="domains"))]
+)
+
+
+def _match(key, value):
+    return models.Filter(
+        must=[models.FieldCondition(key=key, match=models.MatchValue(value=value))]
+    )
+
+
+class BatchSizer:
+    """
+    Adapts the number of points per upsert to the server latency:
+        the size doubles while batches take less than `target` seconds,
+        and halves when they are slower or fail.
+    """
+
+    def __init__(self, initial=64, minimum=8, maximum=1024, target=0.5):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+
+    def update(self, elapsed, failed=False):
+        if failed or elapsed > self.target:
+            self.size = max(self.minimum, self.size // 2)
+        elif elapsed < self.target / 2:
+            self.size = min(self.maximum, self.size * 2)
+
 
 class QDrantDB:
     def __init__(self, **kw):
         self.host = kw.pop("qdrant_host", "localhost")
         self.port = kw.pop("qdrant_port", 6333)
-        self.client = QdrantClient(host=self.host, port=self.port, timeout=120)
+        self.quantization = kw.pop("quantization", "none")
+        self.concurrency = kw.pop("qdrant_concurrency", 4)
+        self.client = AsyncQdrantClient(
+            host=self.host,
+            port=self.port,
+            grpc_port=kw.pop("qdrant_grpc_port", 6334),
+            prefer_grpc=kw.pop("qdrant_grpc", False),
+            timeout=120,
+            # keep-alive connections, reused by the concurrent upserts
+            limits=httpx.Limits(
+                max_connections=self.concurrency + 4,
+                max_keepalive_connections=self.concurrency + 4,
+            ),
+        )
         self._collection_name = "pages"
+        # bumped on every change of the indexed content
+        self.generation = 0
+        self.batch_sizer = BatchSizer()
+        # bounds the upserts in flight across all index() calls
+        self._inflight = None
 
-    async def search(self, query_vector, limit=10):
-        hits = self.client.search(
-            self._collection_name, query_vector=query_vector, limit=limit
+    def _quantization_config(self):
+        if self.quantization == "int8":
+            return models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(
+                    type=models.ScalarType.INT8, always_ram=True
+                )
+            )
+        if self.quantization == "pq":
+            return models.ProductQuantization(
+                product=models.ProductQuantizationConfig(
+                    compression=models.CompressionRatio.X32, always_ram=True
+                )
+            )
+        return None
+
+    def _filter(self, filters):
+        if not filters:
+            return None
+        must = []
+        if "domain" in filters:
+            # points have the list of their parent domains
+            must.append(
+                models.FieldCondition(
+                    key="domains", match=models.MatchValue(value=filters["domain"])
+                )
+            )
+        if "lang" in filters:
+            must.append(
+                models.FieldCondition(
+                    key="lang", match=models.MatchValue(value=filters["lang"])
+                )
+            )
+        if "after" in filters or "before" in filters:
+            must.append(
+                models.FieldCondition(
+                    key="ts",
+                    range=models.Range(
+                        gte=filters.get("after"), lt=filters.get("before")
+                    ),
+                )
+            )
+        return models.Filter(must=must)
+
+    async def search(self, query_vector, limit=10, filters=None):
+        """
+        Yields the best hits, among the points matching the filters
+        (see places.filters).
+        """
+        hits = await self.client.search(
+            self._collection_name,
+            query_vector=query_vector,
+            query_filter=self._filter(filters),
+            limit=limit,
         )
         for hit in hits:
             yield hit.payload
 
-    def _chunks(self, points, n=10):
-        for i in range(0, len(points), n):
-            yield points[i : i + n]
+    def _replace_operations(self, points):
+        """
+        Returns the operations writing the points of pages, and then
+        deleting the other points of these pages.
+        """
+        ids = {}
+        for point in points:
+            ids.setdefault(point.payload["url"], []).append(point.id)
+        operations = [models.UpsertOperation(upsert=models.PointsList(points=points))]
+        for url, url_ids in ids.items():
+            operations.append(
+                models.DeleteOperation(
+                    delete=models.FilterSelector(
+                        filter=models.Filter(
+                            must=[
+                                models.FieldCondition(
+                                    key="url", match=models.MatchValue(value=url)
+                                )
+                            ],
+                            must_not=[models.HasIdCondition(has_id=url_ids)],
+                        )
+                    )
+                )
+            )
+        return operations
 
-    async def index(self, points):
-        res = []
-        for sub in self._chunks(points):
-            res.append(
-                self.client.upsert(
-                    collection_name=self._collection_name,
-                    points=sub,
-                ).json()
+    async def _upsert(self, points):
+        start = time.monotonic()
+        try:
+            res = await self.client.batch_update_points(
+                collection_name=self._collection_name,
+                update_operations=self._replace_operations(points),
             )
+        except Exception:
+            self.batch_sizer.update(time.monotonic() - start, failed=True)
+            raise
+        finally:
+            self._inflight.release()
+        self.batch_sizer.update(time.monotonic() - start)
+        # the result of the upsert
+        return res[0].model_dump_json()
+
+    def _cut_batch(self, points, start):
+        """
+        Returns the end of the batch starting at `start`: whole pages,
+        up to the batch size, or a single page when it is bigger.
+        """
+        end = start
+        size = self.batch_sizer.size
+        while end < len(points):
+            url = points[end].payload["url"]
+            page_end = end
+            while page_end < len(points) and points[page_end].payload["url"] == url:
+                page_end += 1
+            if end > start and page_end - start > size:
+                break
+            end = page_end
+        return end
+
+    async def index(self, points):
+        """
+        Indexes the points of pages, replacing all their previous points.
+
+        Each page is replaced by a single request, which writes its points
+        and deletes the leftovers of its previous versions.
+        """
+        if self._inflight is None:
+            self._inflight = asyncio.Semaphore(self.concurrency)
+        # the points of a page are written together
+        order = {}
+        for point in points:
+            order.setdefault(point.payload["url"], len(order))
+        points = sorted(points, key=lambda point: order[point.payload["url"]])
+        tasks = []
+        start = 0
+        try:
+            while start < len(points):
+                # waits for a free slot, then cuts a batch sized
+                # after the latency of the previous ones
+                await self._inflight.acquire()
+                end = self._cut_batch(points, start)
+                batch = points[start:end]
+                start = end
+                tasks.append(asyncio.create_task(self._upsert(batch)))
+        finally:
+            res = await asyncio.gather(*tasks, return_exceptions=True)
+            # bumped once every write is done, so a search running
+            # during the update does not cache its results
+            self.generation += 1
+        for item in res:
+            if isinstance(item, BaseException):
+                raise item
         return res
 
-    def create_point(self, index, url, title, vec, sentence):
+    async def _scroll_urls(self, scroll_filter):
+        """
+        Returns the urls of the points matching a filter, scrolled
+        without their vectors.
+        """
+        urls = set()
+        offset = None
+        while True:
+            points, offset = await self.client.scroll(
+                self._collection_name,
+                scroll_filter=scroll_filter,
+                limit=1024,
+                offset=offset,
+                with_payload=["url"],
+                with_vectors=False,
+            )
+            urls.update(point.payload["url"] for point in points)
+            if offset is None:
+                return urls
+
+    async def domain_urls(self, domain):
+        """
+        Returns the indexed urls of a domain and its subdomains.
+        """
+        urls = await self._scroll_urls(_match("domains", get_hostname(domain)))
+        # points indexed before their domains were stored
+        legacy = await self._scroll_urls(_MISSING_DOMAINS)
+        urls.update(url for url in legacy if in_domain(url, domain))
+        return sorted(urls)
+
+    async def backfill(self):
+        """
+        Adds the domains of the points indexed before they were stored,
+        so that domain filters match them. Returns the number of urls.
+        """
+        urls = await self._scroll_urls(_MISSING_DOMAINS)
+        for url in urls:
+            await self.client.set_payload(
+                self._collection_name,
+                payload={"domains": parent_domains(url)},
+                points=_match("url", url),
+            )
+        if urls:
+            print(f"[qdrant] added the domains of {len(urls)} pages")
+            self.generation += 1
+        return len(urls)
+
+    async def count_unfiltered(self):
+        """
+        Returns the number of points indexed before their language and
+        date were stored, which the filters leave out.
+        """
+        res = await self.client.count(
+            self._collection_name,
+            count_filter=models.Filter(
+                must=[models.IsEmptyCondition(is_empty=models.PayloadField(key="ts"))]
+            ),
+            exact=True,
+        )
+        return res.count
+
+    async def delete_urls(self, urls):
+        await self.client.delete(
+            self._collection_name,
+            points_selector=models.FilterSelector(
+                filter=models.Filter(
+                    must=[
+                        models.FieldCondition(
+                            key="url", match=models.MatchAny(any=list(urls))
+                        )
+                    ]
+                )
+            ),
+        )
+        self.generation += 1
+
+    def create_point(self, index, url, title, vec, sentence, lang=None, ts=None):
         point_id = hashlib.md5(f"{url}-{index}".encode()).hexdigest()
         return PointStruct(
             id=point_id,
-            vector=vec,
-            payload={"url": url, "sentence": sentence, "title": title},
+            # the HTTP API takes lists, converted in one call
+            vector=vec.tolist(),
+            payload={
+                "url": url,
+                "sentence": sentence,
+                "title": title,
+                "domains": parent_domains(url),
+                "lang": lang,
+                "ts": ts,
+            },
         )
 
-    def init_db(self):
-        try:
-            self.client.get_collection(collection_name=self._collection_name)
-            return
-        except Exception:
-            self.client.recreate_collection(
+    async def init_db(self):
+        if not await self.client.collection_exists(self._collection_name):
+            await self.client.create_collection(
                 collection_name=self._collection_name,
                 vectors_config=models.VectorParams(
                     size=768, distance=models.Distance.COSINE
                 ),
+                # only applied to new collections
+                quantization_config=self._quantization_config(),
+            )
+        # pages are deleted with a filter on their url, and searches
+        # are filtered on the other fields
+        for field_name, field_schema in _PAYLOAD_INDEXES:
+            await self.client.create_payload_index(
+                self._collection_name,
+                field_name=field_name,
+                field_schema=field_schema,
             )
+        await self.backfill()
 
     async def get_db_info(self):
-        info = dict(self.client.get_collection(collection_name=self._collection_name))
+        info = dict(
+            await self.client.get_collection(collection_name=self._collection_name)
+        )
         info["name"] = "QDrant"
         return info
+
+    async def close(self):
+        await self.client.close()
@@ -1,36 +1,147 @@
 import hashlib
+import json
 
+from places.backends.ivf import IVFIndex
+from places.backends.quantize import ProductQuantizer, ScalarQuantizer
 from places.backends.vectra import LocalIndex
+from places.policy import get_hostname, in_domain
 
 
-# could use https://github.com/spotify/annoy instead
 class LocalDB:
     def __init__(self, **kw):
         self.path = kw["vectra_path"]
-        self._index = LocalIndex(self.path)
+        ann = None
+        if kw.get("ann") == "ivf":
+            ann = IVFIndex(nlist=kw.get("ann_nlist"), nprobe=kw.get("ann_nprobe", 16))
+        quantizer = None
+        if kw.get("quantization") == "int8":
+            quantizer = ScalarQuantizer()
+        elif kw.get("quantization") == "pq":
+            quantizer = ProductQuantizer(subspaces=kw.get("pq_subspaces", 96))
+        self._index = LocalIndex(
+            self.path,
+            ann=ann,
+            quantizer=quantizer,
+            rerank=kw.get("rerank", 10),
+            indexed_fields=("url", "domain", "lang"),
+            range_fields=("ts",),
+        )
         self._collection_name = "pages"
+        # bumped on every change of the indexed content
+        self.generation = 0
 
-    async def search(self, query_vector, limit=10):
-        hits = await self._index.query_items(query_vector, limit)
+    async def _where(self, filters):
+        where = {}
+        if "domain" in filters:
+            domains = await self._index.list_field_values("domain")
+            where["domain"] = [
+                domain for domain in domains if in_domain(domain, filters["domain"])
+            ]
+        if "lang" in filters:
+            where["lang"] = filters["lang"]
+        if "after" in filters or "before" in filters:
+            where["ts"] = (filters.get("after"), filters.get("before"))
+        return where
+
+    async def search(self, query_vector, limit=10, filters=None):
+        """
+        Yields the best hits, among the points matching the filters
+        (see places.filters).
+        """
+        where = await self._where(filters) if filters else None
+        hits = await self._index.query_items(query_vector, limit, where=where)
         for hit in hits:
             data = hit["item"]["metadata"]
             yield data
 
-    def init_db(self):
+    async def init_db(self):
         if not self._index.is_index_created():
             self._index.create_index()
+        # the web server and `places index --bulk` can't write at once
+        self._index.lock()
+        await self.backfill()
+
+    async def backfill(self, batch_size=1000):
+        """
+        Adds the domain of the points indexed before it was stored, so
+        that domain filters match them. Returns the number of points.
+        """
+        ids = await self._index.list_ids_without_field("domain")
+        for start in range(0, len(ids), batch_size):
+            items = []
+            for id in ids[start : start + batch_size]:
+                item = await self._index.get_item(id)
+                metadata = item["metadata"]
+                items.append(
+                    {
+                        "id": id,
+                        "metadata": dict(
+                            metadata, domain=get_hostname(metadata["url"])
+                        ),
+                        "vector": item["vector"],
+                    }
+                )
+            await self._index.upsert_items(items)
+        if ids:
+            print(f"[vectra] added the domain of {len(ids)} points")
+            self.generation += 1
+        return len(ids)
+
+    async def count_unfiltered(self):
+        """
+        Returns the number of points indexed before their language and
+        date were stored, which the filters leave out.
+        """
+        return len(await self._index.list_ids_without_field("ts"))
 
     async def get_db_info(self):
         stats = await self._index.get_index_stats()
         return {"name": f"Vectra v{stats['version']}", "vectors_count": stats["items"]}
 
-    def create_point(self, index, url, title, vec, sentence):
+    async def close(self):
+        await self._index.close()
+
+    def create_point(self, index, url, title, vec, sentence, lang=None, ts=None):
         point_id = hashlib.md5(f"{url}-{index}".encode()).hexdigest()
-        metadata = {"url": url, "title": title, "sentence": sentence}
+        metadata = {
+            "url": url,
+            "title": title,
+            "sentence": sentence,
+            "domain": get_hostname(url),
+            "lang": lang,
+            "ts": ts,
+        }
         return {"id": point_id, "metadata": metadata, "vector": vec}
 
+    async def domain_urls(self, domain):
+        """
+        Returns the indexed urls of a domain and its subdomains.
+        """
+        ids = []
+        for value in await self._index.list_field_values("domain"):
+            if in_domain(value, domain):
+                ids.extend(await self._index.list_ids_by_field("domain", value))
+        items = await self._index.get_items(ids)
+        return sorted({item["metadata"]["url"] for item in items})
+
+    async def delete_urls(self, urls):
+        ids = []
+        for url in urls:
+            ids.extend(await self._index.list_ids_by_field("url", url))
+        await self._index.delete_items(ids)
+        self.generation += 1
+
     async def index(self, points):
-        res = []
-        for point in points:
-            res.append(await self._index.upsert_item(point))
-        return res
+        """
+        Indexes the points of pages, replacing all their previous points.
+        """
+        ids = {point["id"] for point in points}
+        stale = []
+        for url in {point["metadata"]["url"] for point in points}:
+            for id in await self._index.list_ids_by_field("url", url):
+                if id not in ids:
+                    stale.append(id)
+        # one log append for the whole page, so it is replaced at once
+        items = await self._index.upsert_items(points, delete_ids=stale)
+        self.generation += 1
+        return [json.dumps(item) for item in items]
@@ -0,0 +1,186 @@
+"""
+Inverted file (IVF) index for the local backend.
+
+Vectors are clustered with a spherical k-means, and a query only scores
+the rows of the `nprobe` clusters with the closest centroids.
+Higher `nprobe` values give a better recall for slower queries.
+"""
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from places.backends.vectra import unit_vectors
+
+_CHUNK_ROWS = 16_384
+
+
+def nearest_centroids(
+    vectors: np.ndarray, centroids: np.ndarray, spherical: bool = True
+) -> np.ndarray:
+    """
+    Returns the index of the closest centroid of each vector,
+        by cosine similarity for unit vectors or by euclidean distance.
+    """
+    labels = np.empty(len(vectors), dtype=np.int32)
+    bias = 0 if spherical else -0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    for start in range(0, len(vectors), _CHUNK_ROWS):
+        chunk = np.asarray(vectors[start : start + _CHUNK_ROWS])
+        scores = chunk @ centroids.T + bias
+        labels[start : start + len(chunk)] = np.argmax(scores, axis=1)
+    return labels
+
+
+def kmeans(
+    vectors: np.ndarray,
+    k: int,
+    iterations: int = 10,
+    seed: int = 0,
+    spherical: bool = True,
+) -> np.ndarray:
+    """
+    k-means, spherical by default for unit vectors.
+    Returns k centroids, unit-normalized when spherical.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(vectors, centroids, spherical)
+        order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[order]
+        starts = np.flatnonzero(np.diff(sorted_labels, prepend=-1))
+        sums = np.add.reduceat(vectors[order], starts)
+        # empty clusters keep their previous centroid
+        if spherical:
+            centroids[sorted_labels[starts]] = unit_vectors(sums)
+        else:
+            counts = np.diff(np.append(starts, len(vectors)))
+            centroids[sorted_labels[starts]] = sums / counts[:, None]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Clusters of the rows of a LocalIndex.
+
+    Rows of the segment are kept sorted by cluster, so the rows of a
+        cluster are a slice of `_order`. Rows added since the segment
+        was written are assigned to their nearest centroid on insertion.
+    Centroids are trained when the segment is written (see
+        LocalIndex.compact), and retrained once the segment grew
+        `retrain_ratio` times since the last training.
+    """
+
+    name = "ivf"
+
+    def __init__(
+        self,
+        nlist: Optional[int] = None,
+        nprobe: int = 16,
+        min_train_rows: int = 10_000,
+        retrain_ratio: int = 4,
+    ):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self.retrain_ratio = retrain_ratio
+        self.centroids = None
+        self._trained_rows = 0
+        self._assign = np.empty(0, dtype=np.int32)
+        self._order = np.empty(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def reset(self) -> None:
+        self.centroids = None
+        self._trained_rows = 0
+        self._assign = np.empty(0, dtype=np.int32)
+        self._order = np.empty(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+
+    def set_rows(self, start: int, vectors: np.ndarray) -> None:
+        """
+        Assigns rows start..start + len(vectors) to their nearest centroid.
+        """
+        if not self.trained:
+            return
+        end = start + len(vectors)
+        if end > len(self._assign):
+            grown = np.full(max(end, 2 * len(self._assign)), -1, dtype=np.int32)
+            grown[: len(self._assign)] = self._assign
+            self._assign = grown
+        self._assign[start:end] = nearest_centroids(vectors, self.centroids)
+
+    def snapshot(self, size: int) -> Optional[np.ndarray]:
+        """
+        Returns a copy of the assignments of the first rows.
+        """
+        if not self.trained:
+            return None
+        return self._assign[:size].copy()
+
+    def build(
+        self, segment: np.ndarray, assign: Optional[np.ndarray] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Computes the state of a segment, retraining the centroids if needed.
+        `assign` are the known assignments of the segment rows.
+        Does not modify the index, so it can run in a thread.
+        """
+        count = len(segment)
+        if count == 0 or count < self.min_train_rows:
+            return None
+        centroids = self.centroids
+        trained_rows = self._trained_rows
+        retrain = centroids is None or count >= trained_rows * self.retrain_ratio
+        if retrain:
+            nlist = self.nlist or max(1, int(np.sqrt(count)))
+            # ~64 training vectors per centroid is plenty
+            rng = np.random.default_rng(count)
+            sample_size = min(count, 64 * nlist)
+            sample = np.sort(rng.choice(count, sample_size, replace=False))
+            centroids = kmeans(segment[sample], nlist)
+            trained_rows = count
+        if retrain or assign is None or (assign < 0).any():
+            assign = nearest_centroids(segment, centroids)
+        return {
+            "centroids": centroids,
+            "trained_rows": np.int64(trained_rows),
+            "assign": assign.astype(np.int32),
+        }
+
+    def load_state(self, state: Optional[Dict[str, Any]]) -> None:
+        """
+        Uses the state returned by build() for the segment rows.
+        """
+        if state is None:
+            self.reset()
+            return
+        self.centroids = np.asarray(state["centroids"], dtype=np.float32)
+        self._trained_rows = int(state["trained_rows"])
+        self._assign = np.array(state["assign"], dtype=np.int32)
+        self._order = np.argsort(self._assign, kind="stable")
+        self._offsets = np.searchsorted(
+            self._assign[self._order], np.arange(len(self.centroids) + 1)
+        )
+
+    def state_rows(self, state: Dict[str, Any]) -> int:
+        return len(state["assign"])
+
+    def candidates(
+        self, query: np.ndarray, segment_count: int, size: int
+    ) -> np.ndarray:
+        """
+        Returns the sorted rows of the clusters closest to the query.
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = [self._order[self._offsets[p] : self._offsets[p + 1]] for p in probes]
+        if size > segment_count:
+            tail = self._assign[segment_count:size]
+            rows.append(np.flatnonzero(np.isin(tail, probes)) + segment_count)
+        return np.sort(np.concatenate(rows))
@@ -0,0 +1,219 @@
+"""
+Compressed codes of the vectors of the local backend.
+
+Queries are first scored against the codes, which stay in memory,
+then the best candidates are re-ranked with their exact float vectors,
+read from the memory-mapped segment.
+
+- ScalarQuantizer: one int8 per dimension, 4x smaller than float32
+- ProductQuantizer: one byte per group of dimensions, 32x smaller with
+  the default groups of 8 dimensions
+"""
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from places.backends.ivf import kmeans, nearest_centroids
+
+_CHUNK_ROWS = 16_384
+
+
+class _Quantizer:
+    """
+    Keeps the codes of the rows of a LocalIndex, with the same life cycle
+        as IVFIndex: trained when a segment is written, retrained once
+        the segment grew `retrain_ratio` times, and rows added through
+        the log encoded on insertion.
+    """
+
+    name = "quant"
+    dtype = np.uint8
+    # rows scored at once
+    score_rows = _CHUNK_ROWS
+
+    def __init__(self, min_train_rows: int = 10_000, retrain_ratio: int = 4):
+        self.min_train_rows = min_train_rows
+        self.retrain_ratio = retrain_ratio
+        self.params = None
+        self._trained_rows = 0
+        self._codes = None
+
+    @property
+    def trained(self) -> bool:
+        return self.params is not None
+
+    @property
+    def code_size(self) -> int:
+        """
+        Returns the number of bytes used per vector.
+        """
+        return self._codes[0].nbytes
+
+    def reset(self) -> None:
+        self.params = None
+        self._trained_rows = 0
+        self._codes = None
+
+    def train(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        raise NotImplementedError()
+
+    def encode(self, vectors: np.ndarray, params: Dict[str, np.ndarray]) -> np.ndarray:
+        raise NotImplementedError()
+
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        raise NotImplementedError()
+
+    def _encode_chunks(
+        self, vectors: np.ndarray, params: Dict[str, np.ndarray]
+    ) -> np.ndarray:
+        return np.concatenate(
+            [
+                self.encode(np.asarray(vectors[start : start + _CHUNK_ROWS]), params)
+                for start in range(0, len(vectors), _CHUNK_ROWS)
+            ]
+        )
+
+    def set_rows(self, start: int, vectors: np.ndarray) -> None:
+        """
+        Encodes rows start..start + len(vectors).
+        """
+        if not self.trained:
+            return
+        end = start + len(vectors)
+        if end > len(self._codes):
+            capacity = max(end, 2 * len(self._codes))
+            grown = np.zeros((capacity,) + self._codes.shape[1:], dtype=self.dtype)
+            grown[: len(self._codes)] = self._codes
+            self._codes = grown
+        self._codes[start:end] = self.encode(vectors, self.params)
+
+    def snapshot(self, size: int) -> Optional[np.ndarray]:
+        """
+        Returns a copy of the codes of the first rows.
+        """
+        if not self.trained:
+            return None
+        return self._codes[:size].copy()
+
+    def build(
+        self, segment: np.ndarray, codes: Optional[np.ndarray] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Computes the state of a segment, retraining if needed.
+        `codes` are the known codes of the segment rows.
+        Does not modify the quantizer, so it can run in a thread.
+        """
+        count = len(segment)
+        if count == 0 or count < self.min_train_rows:
+            return None
+        params = self.params
+        trained_rows = self._trained_rows
+        retrain = params is None or count >= trained_rows * self.retrain_ratio
+        if retrain:
+            rng = np.random.default_rng(count)
+            sample = np.sort(rng.choice(count, min(count, 65_536), replace=False))
+            params = self.train(np.asarray(segment[sample]))
+            trained_rows = count
+        if retrain or codes is None:
+            codes = self._encode_chunks(segment, params)
+        return dict(params, trained_rows=np.int64(trained_rows), codes=codes)
+
+    def load_state(self, state: Optional[Dict[str, Any]]) -> None:
+        """
+        Uses the state returned by build() for the segment rows.
+        """
+        if state is None:
+            self.reset()
+            return
+        state = dict(state)
+        self._codes = np.array(state.pop("codes"), dtype=self.dtype)
+        self._trained_rows = int(state.pop("trained_rows"))
+        self.params = state
+
+    def state_rows(self, state: Dict[str, Any]) -> int:
+        return len(state["codes"])
+
+    def scores(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the approximate similarity of the query with the given rows.
+        """
+        scores = np.empty(len(rows), dtype=np.float32)
+        # a range of rows is sliced rather than gathered
+        contiguous = len(rows) > 0 and rows[-1] - rows[0] == len(rows) - 1
+        for start in range(0, len(rows), self.score_rows):
+            chunk = rows[start : start + self.score_rows]
+            if contiguous:
+                codes = self._codes[chunk[0] : chunk[-1] + 1]
+            else:
+                codes = self._codes[chunk]
+            scores[start : start + len(chunk)] = self._scores(codes, query)
+        return scores
+
+
+class ScalarQuantizer(_Quantizer):
+    """
+    Maps each dimension to 256 levels between its min and max values:
+        x ~= offset + scale * code, with an int8 code.
+    """
+
+    dtype = np.int8
+    # small enough for the decoded floats to stay in the CPU cache
+    score_rows = 2048
+
+    def train(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = np.maximum(high - low, 1e-12) / 255
+        return {"scale": scale, "offset": low + 128 * scale}
+
+    def encode(self, vectors: np.ndarray, params: Dict[str, np.ndarray]) -> np.ndarray:
+        codes = np.rint((vectors - params["offset"]) / params["scale"])
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        params = self.params
+        # BLAS only runs on floats
+        codes = codes.astype(np.float32)
+        return codes @ (query * params["scale"]) + query @ params["offset"]
+
+
+class ProductQuantizer(_Quantizer):
+    """
+    Splits vectors in `subspaces` groups of dimensions, and replaces each
+        group with the index of the closest of 256 centroids.
+    A query computes its dot product with every centroid once, then the
+        score of a row is the sum of one table lookup per group.
+    """
+
+    score_rows = 65_536
+
+    def __init__(self, subspaces: int = 96, **kw):
+        super().__init__(**kw)
+        self.subspaces = subspaces
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        # (n, dim) -> (subspaces, n, dim / subspaces)
+        n, dim = vectors.shape
+        if dim % self.subspaces:
+            raise ValueError(f"{dim} dimensions can't be split in {self.subspaces}")
+        return vectors.reshape(n, self.subspaces, -1).transpose(1, 0, 2)
+
+    def train(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        codebooks = [kmeans(sub, 256, spherical=False) for sub in self._split(vectors)]
+        return {"codebooks": np.stack(codebooks)}
+
+    def encode(self, vectors: np.ndarray, params: Dict[str, np.ndarray]) -> np.ndarray:
+        codebooks = params["codebooks"]
+        codes = [
+            nearest_centroids(sub, codebook, spherical=False)
+            for sub, codebook in zip(self._split(vectors), codebooks, strict=True)
+        ]
+        return np.stack(codes, axis=1).astype(np.uint8)
+
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        codebooks = self.params["codebooks"]
+        # (subspaces, 256) dot products of the query with each centroid
+        table = np.einsum("sd,skd->sk", self._split(query[None])[:, 0], codebooks)
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for subspace, column in enumerate(np.ascontiguousarray(codes.T)):
+            scores += table[subspace].take(column)
+        return scores
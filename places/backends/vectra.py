@@ -1,12 +1,67 @@
 # https://github.com/BMS-geodev/vectra-py
 # LICENCE MIT Copyright (c) 2023 brian schleckser
 import asyncio
+import fcntl
 import json
 import math
 import os
+import re
+import struct
 import uuid
 from typing import Any, Dict, List, Optional, Union
 
+import numpy as np
+
+_INITIAL_CAPACITY = 1024
+_FORMAT = 2
+_HEADER = "header.json"
+_LEGACY_INDEX = "index.json"
+_LOCK = "lock"
+_SEGMENT_FILE = re.compile(
+    r"^(vectors|items|wal|ivf|quant)\.(\d+)\.(npy|json|log|npz)$"
+)
+# payload size, vector size
+_RECORD_HEADER = struct.Struct("<II")
+# compaction starts when the log holds that many rows,
+# or more than 1/_COMPACT_RATIO of the segment
+_COMPACT_MIN_ROWS = 10_000
+_COMPACT_RATIO = 4
+_CHUNK_ROWS = 65_536
+# quantized queries re-rank _RERANK * k candidates with the float vectors
+_RERANK = 10
+
+
+def unit_vectors(vectors) -> np.ndarray:
+    """
+    Returns a float32 copy of the vector(s) scaled to unit length,
+        so cosine similarity becomes a plain dot product.
+    Zero vectors are left untouched.
+    """
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _grow(array: np.ndarray, index: int, fill: Any = 0) -> np.ndarray:
+    """
+    Returns a copy of the array with room for the given index,
+        at least doubling its capacity.
+    """
+    capacity = max(index + 1, 2 * len(array))
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def _encode_record(record: Dict[str, Any], vector: np.ndarray = None) -> bytes:
+    """
+    Encodes a log record: a JSON payload followed by the raw float32 vector.
+    """
+    payload = json.dumps(record).encode("utf-8")
+    vector = b"" if vector is None else vector.astype(np.float32).tobytes()
+    return _RECORD_HEADER.pack(len(payload), len(vector)) + payload + vector
+
 
 class CreateIndexConfig:
     def __init__(
@@ -110,33 +165,587 @@ class LocalIndex:
     """
     A class for managing a local index.
     Handles creating, deleting, and updating the index.
-    Each index is a folder on disk containing an index.json file,
-        and an optional set of metadata files.
+    Each index is a folder on disk containing:
+        - header.json: the format, version, metadata config
+            and the generation of the current segment
+        - vectors.<generation>.npy: the segment, a float32 matrix of
+            unit-normalized vectors opened with numpy.memmap
+        - items.<generation>.json: the id and metadata of each segment row
+        - wal.<generation>.log: an append-only log of the upserts and
+            deletes made since the segment was written
+        - an optional set of metadata files.
+
+    In memory, rows are the segment rows followed by a tail of rows
+        added by the log. Replacing or deleting an item tombstones its row.
+    Once the log grows large enough, a background compaction writes
+        the live rows in a new segment and drops the folded logs.
+
+    `indexed_fields` are metadata fields, like the url of the items,
+        mapped in memory to the ids of the items having each value, so
+        items can be found or deleted by value without a scan.
+    `range_fields` are numeric metadata fields, like dates, kept in
+        one float array per field, with a row per item.
+    Queries can be restricted to the items matching values of these
+        fields, and then only score the matching rows.
+
+    Optional row indexes are rebuilt with each segment and stored in
+        <name>.<generation>.npz:
+        - an approximate nearest neighbour index (see places.backends.ivf)
+            restricts queries to a subset of candidate rows.
+        - a quantizer (see places.backends.quantize) scores the candidates
+            with in-memory codes, and only the `rerank` * k best ones
+            are scored again with their float vectors.
+
+    Indexes created with the JSON format (a single index.json file)
+        are migrated on first load.
+
+    A single process writes to an index: the first update locks the
+        folder (see `lock`). Other processes, like `places query`, load
+        it read-only: they skip torn log records instead of truncating
+        them, and leave the files and row indexes to the writer.
     """
 
-    def __init__(self, folderPath: str):
+    def __init__(
+        self,
+        folderPath: str,
+        compact_min_rows: int = _COMPACT_MIN_ROWS,
+        ann: Any = None,
+        quantizer: Any = None,
+        rerank: int = _RERANK,
+        indexed_fields: tuple = (),
+        range_fields: tuple = (),
+    ):
         self._folderPath = folderPath
+        self._indexed_fields = tuple(indexed_fields)
+        self._range_fields = tuple(range_fields)
+        self._compact_min_rows = compact_min_rows
+        self._ann = ann
+        self._quantizer = quantizer
+        self._rerank = rerank
+        self._row_indexes = [index for index in (ann, quantizer) if index is not None]
         self._data = None
         self._update = None
+        self._wal = None
+        self._lock = None
+        self._compaction = None
+        self._reset()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._folderPath, name)
+
+    def _reset(self, base: Optional[np.ndarray] = None, items: List[dict] = None):
+        """
+        Sets the in-memory state to a segment with no log applied.
+        """
+        items = [] if items is None else items
+        self._base = base
+        self._base_count = len(items)
+        # rows below that limit are never modified in place
+        self._frozen = len(items)
+        self._tail = None
+        self._size = len(items)
+        self._live = np.ones(max(len(items), _INITIAL_CAPACITY), dtype=bool)
+        self._items = list(items)
+        self._rows = {item["id"]: i for i, item in enumerate(items)}
+        self._by_field = {field: {} for field in self._indexed_fields}
+        for item in items:
+            self._index_fields(item)
+        self._columns = {
+            field: np.full(len(self._live), np.nan) for field in self._range_fields
+        }
+        for row, item in enumerate(items):
+            self._set_columns(row, item)
+        self._wal_generation = 0
+        for row_index in self._row_indexes:
+            row_index.reset()
+
+    def _vector(self, row: int) -> np.ndarray:
+        if row < self._base_count:
+            return self._base[row]
+        return self._tail[row - self._base_count]
+
+    def _index_fields(self, item: Dict[str, Any], remove: bool = False) -> None:
+        metadata = item.get("metadata") or {}
+        for field, ids_by_value in self._by_field.items():
+            value = metadata.get(field)
+            if value is None:
+                continue
+            if remove:
+                ids = ids_by_value.get(value)
+                if ids is not None:
+                    ids.discard(item["id"])
+                    if not ids:
+                        del ids_by_value[value]
+            else:
+                ids_by_value.setdefault(value, set()).add(item["id"])
+
+    def _set_columns(self, row: int, item: Dict[str, Any]) -> None:
+        metadata = item.get("metadata") or {}
+        for field, column in self._columns.items():
+            if row >= len(column):
+                column = self._columns[field] = _grow(column, row, fill=np.nan)
+            value = metadata.get(field)
+            column[row] = np.nan if value is None else value
+
+    def _append_row(self, item: Dict[str, Any], vector: np.ndarray) -> None:
+        row = self._size
+        tail_row = row - self._base_count
+        if self._tail is None:
+            capacity = max(tail_row + 1, _INITIAL_CAPACITY)
+            self._tail = np.zeros((capacity, len(vector)), dtype=np.float32)
+        elif tail_row >= len(self._tail):
+            self._tail = _grow(self._tail, tail_row)
+        if row >= len(self._live):
+            self._live = _grow(self._live, row, fill=True)
+        self._tail[tail_row] = vector
+        self._live[row] = True
+        self._items.append(item)
+        self._rows[item["id"]] = row
+        self._index_fields(item)
+        self._set_columns(row, item)
+        self._size += 1
+        for row_index in self._row_indexes:
+            row_index.set_rows(row, vector[None])
+
+    def _tombstone(self, row: int) -> None:
+        self._live[row] = False
+        del self._rows[self._items[row]["id"]]
+        self._index_fields(self._items[row], remove=True)
+        self._items[row] = None
+
+    def _apply_upsert(self, item: Dict[str, Any], vector: np.ndarray) -> None:
+        row = self._rows.get(item["id"])
+        if row is not None and row >= self._frozen:
+            self._tail[row - self._base_count] = vector
+            self._index_fields(self._items[row], remove=True)
+            self._index_fields(item)
+            self._set_columns(row, item)
+            self._items[row] = item
+            for row_index in self._row_indexes:
+                row_index.set_rows(row, vector[None])
+            return
+        if row is not None:
+            self._tombstone(row)
+        self._append_row(item, vector)
+
+    def _apply_delete(self, id: str) -> None:
+        row = self._rows.get(id)
+        if row is not None:
+            self._tombstone(row)
+
+    def _scores(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the cosine similarity of the unit query with the given rows
+            (all rows by default), -inf for dead rows.
+        """
+        if rows is None:
+            scores = np.empty(self._size, dtype=np.float32)
+            if self._base_count:
+                scores[: self._base_count] = self._base @ query
+            if self._size > self._base_count:
+                scores[self._base_count :] = (
+                    self._tail[: self._size - self._base_count] @ query
+                )
+            scores[~self._live[: self._size]] = -np.inf
+            return scores
+        scores = self._gather(rows) @ query
+        scores[~self._live[rows]] = -np.inf
+        return scores
+
+    def _gather(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the vectors of the given sorted rows.
+        """
+        split = np.searchsorted(rows, self._base_count)
+        parts = []
+        if split > 0:
+            parts.append(self._base[rows[:split]])
+        if split < len(rows):
+            parts.append(self._tail[rows[split:] - self._base_count])
+        return np.concatenate(parts)
+
+    def _where_mask(self, where: Dict[str, Any]) -> np.ndarray:
+        """
+        Returns the mask of the live rows matching `where`, which maps
+            indexed fields to a value or a list of values, and range
+            fields to a (low, high) tuple, low included, high excluded,
+            either bound being optional.
+        """
+        mask = self._live[: self._size].copy()
+        for field, condition in where.items():
+            if field in self._columns:
+                low, high = condition
+                column = self._columns[field][: self._size]
+                # items without a value never match
+                with np.errstate(invalid="ignore"):
+                    if low is not None:
+                        mask &= column >= low
+                    if high is not None:
+                        mask &= column < high
+                continue
+            if not isinstance(condition, (list, tuple, set)):
+                condition = [condition]
+            ids_by_value = self._field_index(field)
+            rows = [
+                self._rows[id]
+                for value in condition
+                for id in ids_by_value.get(value, ())
+            ]
+            selected = np.zeros(self._size, dtype=bool)
+            selected[rows] = True
+            mask &= selected
+        return mask
+
+    def _candidates(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Returns the rows to score for a query, None to scan all rows.
+        """
+        if self._ann is None or not self._ann.trained:
+            return None
+        return self._ann.candidates(query, self._base_count, self._size)
+
+    def _write_json(self, name: str, data: Any) -> None:
+        tmp_path = self._path(f"{name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._path(name))
+
+    def _write_segment(
+        self,
+        header: Dict[str, Any],
+        base: Optional[np.ndarray],
+        tail: Optional[np.ndarray],
+        live: np.ndarray,
+        items: List[Dict[str, Any]],
+    ) -> None:
+        """
+        Writes the live rows of base + tail, the items and finally the header,
+            which is the commit point: a partially written segment is ignored.
+        Vectors are copied by chunks, so memory stays bounded.
+        """
+        generation = header["generation"]
+        if header["count"]:
+            vectors = np.lib.format.open_memmap(
+                self._path(f"vectors.{generation}.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(header["count"], header["dim"]),
+            )
+            offset = 0
+            base_count = 0 if base is None else len(base)
+            for part, mask in ((base, live[:base_count]), (tail, live[base_count:])):
+                if part is None:
+                    continue
+                for start in range(0, len(part), _CHUNK_ROWS):
+                    end = start + _CHUNK_ROWS
+                    chunk = part[start:end][mask[start:end]]
+                    vectors[offset : offset + len(chunk)] = chunk
+                    offset += len(chunk)
+            vectors.flush()
+            del vectors
+        self._write_json(f"items.{generation}.json", items)
+        self._write_json(_HEADER, header)
+
+    def _write_row_indexes(
+        self,
+        generation: int,
+        segment: Optional[np.ndarray],
+        snapshots: List[Optional[np.ndarray]],
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Builds and saves the state of each row index for a segment.
+        """
+        states = []
+        for row_index, snapshot in zip(self._row_indexes, snapshots, strict=True):
+            state = None if segment is None else row_index.build(segment, snapshot)
+            if state is not None:
+                name = f"{row_index.name}.{generation}.npz"
+                with open(self._path(f"{name}.tmp"), "wb") as f:
+                    np.savez(f, **state)
+                os.replace(self._path(f"{name}.tmp"), self._path(name))
+            states.append(state)
+        return states
+
+    def _load_row_indexes(self) -> None:
+        """
+        Loads the row indexes state of the segment, or schedules their build.
+        """
+        missing = False
+        for row_index in self._row_indexes:
+            path = self._path(f"{row_index.name}.{self._data['generation']}.npz")
+            if os.path.exists(path):
+                with np.load(path) as state:
+                    state = dict(state)
+                if row_index.state_rows(state) == self._base_count:
+                    row_index.load_state(state)
+                    continue
+            missing = missing or self._base_count >= row_index.min_train_rows
+        # readers query without the missing row indexes
+        if missing and self._lock is not None:
+            self._compaction = asyncio.create_task(self.build_row_indexes())
+
+    def _swap_row_indexes(self, states: List[Optional[Dict[str, Any]]]) -> None:
+        """
+        Uses new segment states, and adds the rows of the tail.
+        """
+        for row_index, state in zip(self._row_indexes, states, strict=True):
+            row_index.load_state(state)
+            if self._size > self._base_count:
+                tail = self._tail[: self._size - self._base_count]
+                row_index.set_rows(self._base_count, tail)
+
+    async def build_row_indexes(self) -> None:
+        """
+        Builds the row indexes of the current segment in a thread.
+        """
+        await self.load_index_data()
+        if not self._row_indexes or self._base is None or self._lock is None:
+            return
+        data = self._data
+        snapshots = [
+            row_index.snapshot(self._base_count) for row_index in self._row_indexes
+        ]
+        states = await asyncio.to_thread(
+            self._write_row_indexes, data["generation"], self._base, snapshots
+        )
+        if self._data is not data:
+            return
+        self._swap_row_indexes(states)
+
+    def _remove_stale_files(self) -> None:
+        """
+        Removes the logs folded in the segment and the previous segments.
+        """
+        generation = self._data["generation"]
+        for name in os.listdir(self._folderPath):
+            match = _SEGMENT_FILE.match(name)
+            if match is None:
+                continue
+            kind, file_generation = match.group(1), int(match.group(2))
+            if file_generation < generation or (
+                kind != "wal" and file_generation != generation
+            ):
+                os.remove(self._path(name))
+
+    def _wal_files(self) -> List[tuple]:
+        files = []
+        for name in os.listdir(self._folderPath):
+            match = _SEGMENT_FILE.match(name)
+            if match is not None and match.group(1) == "wal":
+                files.append((int(match.group(2)), self._path(name)))
+        return sorted(files)
+
+    def _append_log(self, records: List[bytes]) -> None:
+        if self._wal is None:
+            self._wal = open(self._path(f"wal.{self._wal_generation}.log"), "ab")
+        self._wal.write(b"".join(records))
+        self._wal.flush()
+
+    def _close_log(self) -> None:
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    def _replay_log(self, path: str) -> None:
+        """
+        Applies the records of a log file.
+        A record torn by a crash is truncated away by the writer. Readers
+            stop before it, as it can be a record being written.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            size, vector_size = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            end = start + size + vector_size
+            if end > len(data):
+                break
+            record = json.loads(data[start : start + size])
+            if record["op"] == "upsert":
+                vector = np.frombuffer(
+                    data, dtype=np.float32, count=vector_size // 4, offset=start + size
+                )
+                self._apply_upsert(record["item"], vector)
+            else:
+                self._apply_delete(record["id"])
+            offset = end
+        if offset < len(data) and self._lock is not None:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    def _migrate_json_index(self) -> None:
+        """
+        Converts an index.json index to the binary format.
+        The original file is kept as index.json.bak
+        """
+        with open(self._path(_LEGACY_INDEX), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        items = data["items"]
+        vectors = unit_vectors([item["vector"] for item in items]) if items else None
+        header = {
+            "format": _FORMAT,
+            "version": data["version"],
+            "metadata_config": data["metadata_config"],
+            "generation": 0,
+            "count": len(items),
+            "dim": None if vectors is None else int(vectors.shape[1]),
+        }
+        items = [
+            {k: v for k, v in item.items() if k not in ("vector", "norm")}
+            for item in items
+        ]
+        live = np.ones(len(items), dtype=bool)
+        self._write_segment(header, None, vectors, live, items)
+        os.replace(self._path(_LEGACY_INDEX), self._path(f"{_LEGACY_INDEX}.bak"))
+
+    def _maybe_compact(self) -> None:
+        """
+        Starts a background compaction when the log is large enough.
+        """
+        if self._compaction is not None and not self._compaction.done():
+            return
+        log_rows = self._size - self._base_count
+        dead_rows = self._size - len(self._rows)
+        threshold = max(self._compact_min_rows, self._base_count // _COMPACT_RATIO)
+        if log_rows + dead_rows >= threshold:
+            self._compaction = asyncio.create_task(self.compact())
+
+    async def compact(self) -> None:
+        """
+        Writes the live rows in a new segment and drops the folded logs.
+        The segment is written in a thread. Updates made in the meantime
+            go to the next log and are kept in memory on top of the segment.
+        """
+        await self.load_index_data()
+        data = self._data
+        size, base, base_count = self._size, self._base, self._base_count
+        live = self._live[:size].copy()
+        items = [item for item in self._items[:size] if item is not None]
+        snapshots = [row_index.snapshot(size) for row_index in self._row_indexes]
+        tail = None
+        if self._tail is not None:
+            tail = self._tail[: size - base_count].copy()
+        dim = None
+        if base is not None or tail is not None:
+            dim = int((base if base is not None else tail).shape[1])
+        header = dict(
+            self._data,
+            generation=self._wal_generation + 1,
+            count=len(items),
+            dim=dim if items else None,
+        )
+
+        # from now on, updates go to the next log and rows of the snapshot
+        # are never modified in place
+        self._close_log()
+        self._wal_generation = header["generation"]
+        self._frozen = size
+
+        await asyncio.to_thread(self._write_segment, header, base, tail, live, items)
+        if self._data is not data:
+            # the index was reloaded from disk in the meantime
+            return
+
+        kept = np.flatnonzero(live)
+        new_base = None
+        if len(kept):
+            new_base = np.load(
+                self._path(f"vectors.{header['generation']}.npy"), mmap_mode="r"
+            )
+        states = await asyncio.to_thread(
+            self._write_row_indexes,
+            header["generation"],
+            new_base,
+            [None if snapshot is None else snapshot[live] for snapshot in snapshots],
+        )
+        if self._data is not data:
+            return
+        # rows deleted or replaced during the compaction stay tombstoned
+        new_items = [self._items[row] for row in kept] + self._items[size:]
+        new_live = np.concatenate([self._live[kept], self._live[size : self._size]])
+        new_tail = None
+        if self._size > size:
+            new_tail = self._tail[size - base_count : self._size - base_count]
+
+        self._base = new_base
+        self._base_count = self._frozen = len(kept)
+        self._size = len(new_items)
+        self._items = new_items
+        self._live = np.ones(max(self._size, _INITIAL_CAPACITY), dtype=bool)
+        self._live[: self._size] = new_live
+        for field, column in self._columns.items():
+            new_column = np.full(len(self._live), np.nan)
+            new_column[: len(kept)] = column[kept]
+            new_column[len(kept) : self._size] = column[
+                size : size + self._size - len(kept)
+            ]
+            self._columns[field] = new_column
+        self._tail = None if new_tail is None else _grow(new_tail, len(new_tail))
+        self._rows = {
+            item["id"]: row for row, item in enumerate(new_items) if item is not None
+        }
+        self._data = header
+        self._swap_row_indexes(states)
+        self._remove_stale_files()
 
     async def begin_update(self) -> None:
         """
         Loads the index into memory and prepares it for updates.
         """
-        if self._update:
+        if self._update is not None:
             raise Exception("Update already in progress")
+        if self._lock is None:
+            self.lock()
         await self.load_index_data()
-        self._update = self._data.copy()
+        self._update = []
 
     def cancel_update(self) -> None:
         """
         Discards any changes made to the index since the update began.
+        The index is reloaded from disk on next access.
         """
         self._update = None
+        self._close_log()
+        self._data = None
+
+    def lock(self) -> None:
+        """
+        Locks the folder for this process until the index is closed.
+        Each process logs and compacts on its own, so a single one
+            can write to an index at a time.
+        """
+        if self._lock is not None:
+            return
+        lock = open(self._path(_LOCK), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise Exception(
+                f"Index {self._folderPath} is used by another process"
+            ) from None
+        self._lock = lock
+        # loaded read-only, before the lock
+        self._close_log()
+        self._data = None
+
+    async def close(self) -> None:
+        """
+        Waits for a running compaction, closes the log and unlocks
+            the folder.
+        """
+        if self._compaction is not None:
+            await asyncio.gather(self._compaction, return_exceptions=True)
+            self._compaction = None
+        self._close_log()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
 
     def create_index(self, config: Dict[str, Any] = None) -> None:
         """
-        Creates a new folder on disk containing an index.json file.
+        Creates a new folder on disk containing an empty index.
         """
         if config is None:
             config = {"version": 1}
@@ -147,15 +756,17 @@ class LocalIndex:
                 raise Exception("Index already exists")
         try:
             os.makedirs(self._folderPath, exist_ok=True)
-            self._data = {
+            header = {
+                "format": _FORMAT,
                 "version": config["version"],
                 "metadata_config": config.get("metadata_config", {}),
-                "items": [],
+                "generation": 0,
+                "count": 0,
+                "dim": None,
             }
-            with open(
-                os.path.join(self._folderPath, "index.json"), "w", encoding="utf-8"
-            ) as f:
-                json.dump(self._data, f)
+            self._write_segment(header, None, None, np.ones(0, dtype=bool), [])
+            self._data = header
+            self._reset()
         except Exception as e:
             self.delete_index()
             raise Exception("Error creating index") from e
@@ -164,7 +775,9 @@ class LocalIndex:
         """
         This method deletes the index folder from disk.
         """
+        self._close_log()
         self._data = None
+        self._reset()
         await asyncio.create_subprocess_shell(
             f"rm -rf {self._folderPath}",
             stderr=asyncio.subprocess.PIPE,
@@ -175,39 +788,42 @@ class LocalIndex:
         """
         Deletes an item from the index.
         """
-        if self._update:
-            index = next(
-                (i for i, item in enumerate(self._update["items"]) if item["id"] == id),
-                None,
-            )
-            if index is not None:
-                self._update["items"].pop(index)
+        if self._update is not None:
+            if id in self._rows:
+                self._apply_delete(id)
+                self._update.append(_encode_record({"op": "delete", "id": id}))
         else:
             await self.begin_update()
-            index = next(
-                (i for i, item in enumerate(self._update["items"]) if item["id"] == id),
-                None,
-            )
-            if index is not None:
-                self._update["items"].pop(index)
+            await self.delete_item(id)
             await self.end_update()
 
+    async def delete_items(self, ids: List[str]) -> None:
+        """
+        Deletes several items in a single update.
+        """
+        if self._update is not None:
+            for id in ids:
+                await self.delete_item(id)
+            return
+        await self.begin_update()
+        for id in ids:
+            await self.delete_item(id)
+        await self.end_update()
+
     async def end_update(self) -> None:
         """
         Ends an update to the index.
-        This method saves the index to disk.
+        This method appends the changes to the log.
         """
-        if not self._update:
+        if self._update is None:
             raise Exception("No update in progress")
         try:
-            with open(
-                os.path.join(self._folderPath, "index.json"), "w", encoding="utf-8"
-            ) as f:
-                json.dump(self._update, f)
-            self._data = self._update
+            if self._update:
+                self._append_log(self._update)
             self._update = None
         except Exception as e:
             raise Exception(f"Error saving index: {repr(e)}") from e
+        self._maybe_compact()
 
     async def get_index_stats(self) -> Dict[str, Union[int, Dict[str, Any]]]:
         """
@@ -217,15 +833,19 @@ class LocalIndex:
         return {
             "version": self._data["version"],
             "metadata_config": self._data["metadata_config"],
-            "items": len(self._data["items"]),
+            "items": len(self._rows),
         }
 
     async def get_item(self, id: str) -> Optional[Dict[str, Any]]:
         """
         Returns an item from the index given its ID.
+        The returned vector is normalized.
         """
         await self.load_index_data()
-        return next((item for item in self._data["items"] if item["id"] == id), None)
+        row = self._rows.get(id)
+        if row is None:
+            return None
+        return dict(self._items[row], vector=self._vector(row).tolist())
 
     async def insert_item(self, item: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -233,7 +853,7 @@ class LocalIndex:
         A new update is started if one is not already in progress.
         If an item with the same ID already exists, an error will be thrown.
         """
-        if self._update:
+        if self._update is not None:
             return await self.add_item_to_update(item, True)
         else:
             await self.begin_update()
@@ -245,59 +865,148 @@ class LocalIndex:
         """
         Returns true if the index exists.
         """
-        return os.path.exists(os.path.join(self._folderPath, "index.json"))
+        return os.path.exists(self._path(_HEADER)) or os.path.exists(
+            self._path(_LEGACY_INDEX)
+        )
 
     async def list_items(self) -> List[Dict[str, Any]]:
         """
-        Returns all items in the index.
-        This method loads the index into memory and returns all its items.
-        A copy of the items array is returned,
-            so no modifications should be made to the array.
+        Returns all items in the index, without their vectors.
+        """
+        await self.load_index_data()
+        return [item for item in self._items if item is not None]
+
+    async def get_vectors(self) -> np.ndarray:
+        """
+        Returns a copy of the normalized vectors of all items.
+        """
+        await self.load_index_data()
+        live = np.flatnonzero(self._live[: self._size])
+        if len(live) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._gather(live)
+
+    def _field_index(self, field: str) -> Dict[str, set]:
+        if field not in self._by_field:
+            raise ValueError(f"{field} is not an indexed field")
+        return self._by_field[field]
+
+    async def list_ids_by_field(self, field: str, value: Any) -> List[str]:
+        """
+        Returns the ids of the items with that value of an indexed field.
+        """
+        await self.load_index_data()
+        return list(self._field_index(field).get(value, ()))
+
+    async def list_field_values(self, field: str) -> List[Any]:
+        """
+        Returns the distinct values of an indexed field.
         """
         await self.load_index_data()
-        return self._data["items"].copy()
+        return list(self._field_index(field))
+
+    async def list_ids_without_field(self, field: str) -> List[str]:
+        """
+        Returns the ids of the items without a value for an indexed or
+            range field.
+        """
+        await self.load_index_data()
+        if field in self._columns:
+            column = self._columns[field][: self._size]
+            rows = np.flatnonzero(np.isnan(column) & self._live[: self._size])
+            return [self._items[row]["id"] for row in rows]
+        with_value = set().union(*self._field_index(field).values())
+        return [id for id in self._rows if id not in with_value]
+
+    async def get_items(self, ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Returns the items with these ids, without their vectors.
+        """
+        await self.load_index_data()
+        return [self._items[self._rows[id]] for id in ids if id in self._rows]
 
     async def list_items_by_metadata(
         self, filter: Dict[str, Any]
     ) -> List[Dict[str, Any]]:  # noqa
         """
         Returns all items in the index matching the filter.
-        This method loads the index into memory,
-            and returns all its items matching the filter.
         """
         await self.load_index_data()
         return [
-            i for i in self._data["items"] if ItemSelector.select(i["metadata"], filter)
+            i
+            for i in self._items
+            if i is not None and ItemSelector.select(i["metadata"], filter)
         ]
 
     async def query_items(
-        self, vector: List[float], topK: int, filter: Optional[Dict[str, Any]] = None
+        self,
+        vector: List[float],
+        topK: int,
+        filter: Optional[Dict[str, Any]] = None,
+        where: Optional[Dict[str, Any]] = None,
     ) -> List[Dict[str, Any]]:  # noqa
         """
         Finds the top k items in the index that are most similar to the vector.
-        This method loads the index into memory,
+        This method loads the index,
             and returns the top k items that are most similar.
         An optional filter can be applied to the metadata of the items.
+        `where` restricts the query to the rows matching indexed and range
+            fields (see _where_mask), before scoring them.
         """
         await self.load_index_data()
+        if len(self._rows) == 0 or topK <= 0:
+            return []
+        query = unit_vectors(vector)
+        rows = self._candidates(query)
+        if where:
+            matching = self._where_mask(where)
+            count = int(np.count_nonzero(matching))
+            if count == 0:
+                return []
+            if rows is None or count <= len(rows):
+                # scoring all the matching rows is cheaper than the candidates
+                rows = np.flatnonzero(matching)
+            else:
+                rows = rows[matching[rows]]
+            if len(rows) == 0:
+                return []
+        quantized = self._quantizer is not None and self._quantizer.trained
+        if quantized:
+            if rows is None:
+                rows = np.arange(self._size)
+            scores = self._quantizer.scores(query, rows)
+            scores[~self._live[rows]] = -np.inf
+        else:
+            scores = self._scores(query, rows)
+            if rows is None:
+                rows = np.arange(self._size)
         # Filter items
-        items = self._data["items"]
         if filter:
-            items = [i for i in items if ItemSelector.select(i["metadata"], filter)]
-        # Calculate distances
-        norm = ItemSelector.normalize(vector)
-        distances = []
-        for i, item in enumerate(items):
-            distance = ItemSelector.normalized_cosine_similarity(
-                vector, norm, item["vector"], item["norm"]  # noqa
+            mask = np.fromiter(
+                (
+                    self._items[i] is not None
+                    and ItemSelector.select(self._items[i]["metadata"], filter)
+                    for i in rows
+                ),
+                dtype=bool,
+                count=len(rows),
             )
-            distances.append({"index": i, "distance": distance})
-        # Sort by distance DESCENDING
-        distances = sorted(distances, key=lambda k: k["distance"], reverse=True)
-        # Find top k
-        top = []
-        for d in distances[:topK]:
-            top.append({"item": dict(items[d["index"]]), "score": d["distance"]})
+            scores[~mask] = -np.inf
+        # Find top k, sorted by similarity DESCENDING
+        k = min(topK, int(np.count_nonzero(scores > -np.inf)))
+        if k == 0:
+            return []
+        if quantized:
+            # exact scores of the best approximate candidates
+            shortlist = min(k * self._rerank, len(rows))
+            best = np.argpartition(-scores, shortlist - 1)[:shortlist]
+            rows = rows[np.sort(best[scores[best] > -np.inf])]
+            scores = self._scores(query, rows)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = [
+            {"item": dict(self._items[rows[i]]), "score": float(scores[i])} for i in top
+        ]
         # Load external metadata
         for item in top:
             if item["item"].get("metadataFile", None):
@@ -315,7 +1024,7 @@ class LocalIndex:
         A new update is started if one is not already in progress.
         If an item with the same ID already exists, it will be replaced.
         """
-        if self._update:
+        if self._update is not None:
             return await self.add_item_to_update(item, False)
         else:
             await self.begin_update()
@@ -323,15 +1032,69 @@ class LocalIndex:
             await self.end_update()
             return new_item
 
+    async def upsert_items(
+        self, items: List[Dict[str, Any]], delete_ids: List[str] = ()
+    ) -> List[Dict[str, Any]]:
+        """
+        Adds or replaces several items, and deletes `delete_ids`, in a
+            single update, so they are appended to the log in one write.
+        """
+        if self._update is not None:
+            new_items = [await self.add_item_to_update(item, False) for item in items]
+            for id in delete_ids:
+                await self.delete_item(id)
+            return new_items
+        await self.begin_update()
+        try:
+            new_items = await self.upsert_items(items, delete_ids)
+        except Exception:
+            self.cancel_update()
+            raise
+        await self.end_update()
+        return new_items
+
     async def load_index_data(self) -> None:
         if self._data:
             return
+        compaction = self._compaction
+        if (
+            compaction is not None
+            and not compaction.done()
+            and compaction is not asyncio.current_task()
+        ):
+            # the compaction commits the next generation, which the
+            # reloaded index must log after
+            await asyncio.gather(compaction, return_exceptions=True)
+            if self._data:
+                return
         if not self.is_index_created():
             raise Exception("Index does not exist")
-        with open(
-            os.path.join(self._folderPath, "index.json"), "r", encoding="utf-8"
-        ) as f:
-            self._data = json.load(f)
+        if not os.path.exists(self._path(_HEADER)):
+            self._migrate_json_index()
+        with open(self._path(_HEADER), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        generation = header["generation"]
+        with open(self._path(f"items.{generation}.json"), "r", encoding="utf-8") as f:
+            items = json.load(f)
+        base = None
+        if header["count"]:
+            base = np.load(self._path(f"vectors.{generation}.npy"), mmap_mode="r")
+        base_count = 0 if base is None else len(base)
+        if len(items) != header["count"] or base_count != header["count"]:
+            raise Exception(f"Corrupted index in {self._folderPath}")
+        self._reset(base, items)
+        self._data = header
+        self._wal_generation = generation
+        self._load_row_indexes()
+        for wal_generation, path in self._wal_files():
+            if wal_generation < generation:
+                continue
+            self._replay_log(path)
+            self._wal_generation = wal_generation
+        if self._lock is not None and (
+            self._compaction is None or self._compaction.done()
+        ):
+            self._remove_stale_files()
 
     async def add_item_to_update(self, item: dict, unique: bool) -> dict:
         # Ensure vector is provided
@@ -339,22 +1102,21 @@ class LocalIndex:
             raise ValueError("Vector is required")
 
         # Ensure unique
-        id = item.get("id", uuid.uuid4())
-        if unique:
-            existing = next((i for i in self._update["items"] if i["id"] == id), None)
-            if existing:
-                raise ValueError(f"Item with id {id} already exists")
+        id = str(item.get("id", uuid.uuid4()))
+        if unique and id in self._rows:
+            raise ValueError(f"Item with id {id} already exists")
 
         # Check for indexed metadata
         metadata = {}
         metadata_file = None
+        metadata_config = self._data["metadata_config"]
         if (
-            self._update["metadata_config"].get("indexed")
-            and len(self._update["metadata_config"]["indexed"]) > 0
+            metadata_config.get("indexed")
+            and len(metadata_config["indexed"]) > 0
             and "metadata" in item
         ):
             # Copy only indexed metadata
-            for key in self._update["metadata_config"]["indexed"]:
+            for key in metadata_config["indexed"]:
                 if item["metadata"] and item["metadata"].get(key):
                     metadata[key] = item["metadata"][key]
 
@@ -366,31 +1128,15 @@ class LocalIndex:
         elif "metadata" in item:
             metadata = item["metadata"]
 
-        # Create new item
-        new_item = {
-            "id": str(id),
-            "metadata": metadata,
-            "vector": item["vector"],
-            "norm": ItemSelector.normalize(item["vector"]),
-        }
+        # Create new item, the vector only lives in the matrix
+        new_item = {"id": id, "metadata": metadata}
         if metadata_file:
             new_item["metadataFile"] = metadata_file
-        # Add item to index
-        id = new_item["id"]
-
-        if not unique:
-            existing = next((i for i in self._update["items"] if i["id"] == id), None)
-            if existing:
-                existing["metadata"] = new_item["metadata"]
-                existing["vector"] = new_item["vector"]
-                existing["metadataFile"] = new_item.get("metadataFile")
-                return existing
-            else:
-                self._update["items"].append(new_item)
-                return new_item
-        else:
-            self._update["items"].append(new_item)
-            return new_item
+        # Add item to index and log
+        vector = unit_vectors(item["vector"])
+        self._apply_upsert(new_item, vector)
+        self._update.append(_encode_record({"op": "upsert", "item": new_item}, vector))
+        return new_item
 
 
 class IndexData:
@@ -465,7 +1211,7 @@ class ItemSelector:
                 if value is None:
                     return False
                 elif isinstance(value, dict):
-                    if not ItemSelector.metadataFilter(metadata.get(key), value):
+                    if not ItemSelector.metadata_filter(metadata.get(key), value):
                         return False
                 else:
                     if metadata.get(key) != value:
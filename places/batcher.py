@@ -0,0 +1,102 @@
+"""
+Embedding batcher
+
+Concurrent requests push their sentences in a shared queue, and a worker
+encodes them together, so the model runs on full batches instead of one
+small batch per page.
+"""
+import asyncio
+import time
+
+import numpy as np
+
+
+class EmbeddingBatcher:
+    """
+    Collects sentences until `max_batch_size` are pending or the oldest
+    request waited `max_wait` seconds, then encodes them in micro-batches
+    of sentences of similar length, which minimizes padding.
+
+    `encode` is a coroutine function taking a list of sentences and
+    returning a (len(sentences), dim) float32 array.
+    """
+
+    def __init__(self, encode, max_batch_size=64, max_wait=0.02):
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.sentences = 0
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def embed(self, sentences):
+        """
+        Returns the embeddings of the sentences, in order.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((list(sentences), future))
+        return await future
+
+    async def _collect(self):
+        requests = [await self._queue.get()]
+        pending = len(requests[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while pending < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            requests.append(request)
+            pending += len(request[0])
+        return requests
+
+    async def _run(self):
+        while True:
+            requests = await self._collect()
+            try:
+                embeddings = await self._encode(
+                    [sentence for sentences, _ in requests for sentence in sentences]
+                )
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for sentences, future in requests:
+                if not future.done():
+                    future.set_result(embeddings[start : start + len(sentences)])
+                start += len(sentences)
+
+    async def _encode(self, sentences):
+        if not sentences:
+            return np.empty((0, 0), dtype=np.float32)
+        order = np.argsort([len(sentence) for sentence in sentences], kind="stable")
+        batches = [
+            order[start : start + self.max_batch_size]
+            for start in range(0, len(order), self.max_batch_size)
+        ]
+        # micro-batches run concurrently when `encode` has several workers
+        encoded = await asyncio.gather(
+            *(self.encode([sentences[i] for i in batch]) for batch in batches)
+        )
+        embeddings = np.empty((len(sentences), encoded[0].shape[1]), dtype=np.float32)
+        for batch, batch_embeddings in zip(batches, encoded, strict=True):
+            embeddings[batch] = batch_embeddings
+        self.batches += len(batches)
+        self.sentences += len(sentences)
+        return embeddings
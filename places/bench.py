@@ -0,0 +1,94 @@
+"""
+Recall@k and QPS of the IVF index and of the quantizers against the exact scan.
+
+Queries are stored vectors with some noise, so they look like real queries
+without being exact duplicates of an indexed sentence.
+"""
+import time
+
+import numpy as np
+
+from places.backends.ivf import IVFIndex
+from places.backends.quantize import ProductQuantizer, ScalarQuantizer
+from places.backends.vectra import LocalIndex, unit_vectors
+
+
+def synthetic_vectors(count, dim=768, seed=0):
+    """
+    Returns `count` unit vectors grouped around sqrt(count) random centers.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, int(np.sqrt(count))), dim))
+    labels = rng.integers(len(centers), size=count)
+    return unit_vectors(centers[labels] + rng.normal(scale=0.5, size=(count, dim)))
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def measure(queries, truth, search):
+    """
+    Returns the recall and the QPS of a search function.
+    """
+    start = time.time()
+    found = [set(search(query)) for query in queries]
+    qps = len(queries) / (time.time() - start)
+    recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth, strict=True)])
+    return recall, qps
+
+
+async def main(args):
+    if args["synthetic"]:
+        vectors = synthetic_vectors(args["synthetic"])
+    else:
+        vectors = await LocalIndex(args["vectra_path"]).get_vectors()
+    if len(vectors) == 0:
+        print("No vectors to benchmark")
+        return
+
+    k = args["k"]
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), args["queries"])]
+    queries = unit_vectors(queries + rng.normal(scale=0.02, size=queries.shape))
+    print(f"[bench] {len(vectors)} vectors, {len(queries)} queries, k={k}")
+
+    start = time.time()
+    truth = [set(top_k(vectors @ query, k)) for query in queries]
+    exact_qps = len(queries) / (time.time() - start)
+    print(f"[bench] exact scan: {exact_qps:.1f} QPS")
+
+    ivf = IVFIndex(nlist=args["nlist"], min_train_rows=0)
+    start = time.time()
+    ivf.load_state(ivf.build(vectors))
+    print(
+        f"[bench] IVF with {len(ivf.centroids)} lists built in {time.time() - start:.1f}s"
+    )
+
+    def ivf_search(query):
+        rows = ivf.candidates(query, len(vectors), len(vectors))
+        return rows[top_k(vectors[rows] @ query, k)]
+
+    print("nprobe  recall@k  QPS  speedup")
+    for nprobe in [int(n) for n in args["nprobe"].split(",")]:
+        ivf.nprobe = nprobe
+        recall, qps = measure(queries, truth, ivf_search)
+        print(f"{nprobe:6d}  {recall:8.3f}  {qps:.1f}  {qps / exact_qps:.1f}x")
+
+    print(f"quantizer  bytes/vector  recall@k  QPS  (re-ranking {args['rerank']}x)")
+    rows = np.arange(len(vectors))
+    for name, quantizer in (
+        ("int8", ScalarQuantizer(min_train_rows=0)),
+        ("pq", ProductQuantizer(subspaces=args["pq_subspaces"], min_train_rows=0)),
+    ):
+        quantizer.load_state(quantizer.build(vectors))
+
+        def quantized_search(query, quantizer=quantizer):
+            approx = quantizer.scores(query, rows)
+            best = np.sort(top_k(approx, k * args["rerank"]))
+            return best[top_k(vectors[best] @ query, k)]
+
+        recall, qps = measure(queries, truth, quantized_search)
+        print(f"{name:9s}  {quantizer.code_size:12d}  {recall:8.3f}  {qps:.1f}")
@@ -0,0 +1,171 @@
+"""
+Query embedding cache
+
+The omnibox and the answer flow send the same queries over and over,
+so their embeddings are kept in a LRU, optionally persisted with
+diskcache so the web server and `places query` share them.
+"""
+import asyncio
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+
+from diskcache import Cache
+
+
+def normalize_query(query):
+    """
+    Returns the cache key of a query: NFKC normalized, with collapsed
+    whitespace.
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+
+class QueryCache:
+    """
+    Maps normalized queries to their float32 embedding.
+
+    `encode` is a coroutine function taking a list of sentences and
+    returning a (len(sentences), dim) float32 array. `model` is part of
+    the persisted keys, so changing the model does not serve stale
+    embeddings.
+    """
+
+    def __init__(self, encode, max_size=1024, path=None, model=""):
+        self.encode = encode
+        self.max_size = max_size
+        self.model = model
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._disk = None
+        if path:
+            path = os.path.expanduser(path)
+            os.makedirs(path, exist_ok=True)
+            self._disk = Cache(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, query):
+        """
+        Returns the embedding of the query, encoding it on a miss.
+        """
+        key = normalize_query(query)
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+        if self._disk is not None:
+            embedding = self._disk.get((self.model, key))
+            if embedding is not None:
+                self._remember(key, embedding)
+                self.disk_hits += 1
+                return embedding
+
+        # concurrent requests for the same query share one encoding
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await pending
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            embedding = (await self.encode([key]))[0]
+        except Exception as e:
+            future.set_exception(e)
+            # avoids a "never retrieved" warning without waiters
+            future.exception()
+            raise
+        else:
+            future.set_result(embedding)
+        finally:
+            del self._pending[key]
+
+        self._remember(key, embedding)
+        if self._disk is not None:
+            self._disk.set((self.model, key), embedding)
+        return embedding
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "persisted": self._disk is not None,
+        }
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+
+
+class ResultCache:
+    """
+    LRU of search results, valid for one generation of the index.
+
+    Backends bump their `generation` every time they index or delete
+    content, which drops every cached result. Content written by another
+    process, like `places index --bulk` on a Qdrant collection, does not
+    bump it, so results also expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_size=256, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, generation, key):
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] >= self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, generation, key, result):
+        # results computed before new content was indexed are dropped
+        if generation != self.generation or self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
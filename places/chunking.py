@@ -0,0 +1,136 @@
+"""
+Sentence chunking and deduplication.
+
+Sits between the tokenizer and the model:
+
+- near-empty sentences (separators, lone numbers...) are dropped
+- short sentences, like menu labels, are merged in windows of a few
+  words, so each vector has enough text to be meaningful
+- sentences already indexed for another page, like cookie banners and
+  footers, are dropped
+
+Duplicates are found with a global table of sentence hashes, owned by
+the first url they were seen on. The hashes ignore the case, the
+punctuation and the digits, so near-duplicates like "© 2022 Corp." and
+"© 2023 Corp" are found too. A url gives up the hashes of the sentences
+it loses when it is indexed again, or all of them once it is removed.
+"""
+import hashlib
+import re
+import unicodedata
+
+from diskcache import Cache
+
+SENTENCES_DIR = "/tmp/sentences"
+# windows are merged until they have that many words
+MIN_WORDS = 8
+MAX_WORDS = 64
+# sentences with fewer letters are dropped
+MIN_CHARS = 3
+
+_RE_WORD = re.compile(r"\w+")
+_RE_DIGIT = re.compile(r"\d")
+
+
+def sentence_key(sentence):
+    """
+    Returns the hash of a sentence, shared by its near-duplicates.
+    """
+    sentence = unicodedata.normalize("NFKC", sentence).casefold()
+    words = " ".join(_RE_WORD.findall(_RE_DIGIT.sub("0", sentence)))
+    return hashlib.blake2b(words.encode("utf8"), digest_size=8).hexdigest()
+
+
+def chunk_sentences(sentences, min_words=MIN_WORDS, max_words=MAX_WORDS):
+    """
+    Merges short sentences in windows of `min_words` to `max_words`
+    words, and drops near-empty ones.
+    """
+    window = []
+    size = 0
+    for sentence in sentences:
+        words = _RE_WORD.findall(sentence)
+        if sum(len(word) for word in words) < MIN_CHARS:
+            continue
+        if window and size + len(words) > max_words:
+            yield " ".join(window)
+            window, size = [], 0
+        window.append(sentence)
+        size += len(words)
+        if size >= min_words:
+            yield " ".join(window)
+            window, size = [], 0
+    if window:
+        yield " ".join(window)
+
+
+class SentenceHashes:
+    """
+    Wraps a mapping, usually a diskcache.Cache shared by the processes,
+    of sentence hashes to the url owning them, and of ("url", url) to
+    the hashes owned by the url.
+    """
+
+    def __init__(self, cache=None):
+        self._cache = {} if cache is None else cache
+
+    def _claim(self, key, url):
+        """
+        Returns the owner of a hash, making it the url if it had none.
+        """
+        if not hasattr(self._cache, "add"):
+            return self._cache.setdefault(key, url)
+        while True:
+            # atomic across the processes sharing the cache
+            self._cache.add(key, url)
+            owner = self._cache.get(key)
+            # None when released in the meantime
+            if owner is not None:
+                return owner
+
+    def _forget(self, url, keys):
+        for key in keys:
+            if self._cache.get(key) == url:
+                self._cache.pop(key, None)
+
+    def dedup(self, url, sentences):
+        """
+        Returns the sentences of a page that are not duplicates, and
+        makes the url their owner, instead of the sentences the previous
+        version of the page had.
+        """
+        kept = []
+        owned = set()
+        seen = set()
+        for sentence in sentences:
+            key = sentence_key(sentence)
+            if key in seen:
+                continue
+            seen.add(key)
+            if self._claim(key, url) == url:
+                owned.add(key)
+                kept.append(sentence)
+        self._forget(url, set(self._cache.get(("url", url), ())) - owned)
+        self._cache[("url", url)] = sorted(owned)
+        return kept
+
+    def release(self, url, sentences=()):
+        """
+        Forgets the sentences owned by the url, once it is not indexed,
+        or when indexing it failed.
+        """
+        keys = set(self._cache.get(("url", url), ()))
+        keys.update(sentence_key(sentence) for sentence in sentences)
+        self._forget(url, keys)
+        self._cache.pop(("url", url), None)
+
+
+_hashes = None
+
+
+def get_sentence_hashes():
+    """Returns the global table of sentence hashes, opened on first use."""
+    global _hashes
+    if _hashes is None:
+        _hashes = SentenceHashes(Cache(SENTENCES_DIR))
+    return _hashes
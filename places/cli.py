@@ -17,6 +17,92 @@ def set_logger():
     root.addHandler(handler)
 
 
+def add_backend_arguments(parser):
+    parser.add_argument(
+        "--db", type=str, default="qdrant", choices=["qdrant", "vectra"]
+    )
+    parser.add_argument("--vectra-path", type=str, default="data.db")
+    parser.add_argument("--qdrant-host", type=str, default="localhost")
+    parser.add_argument("--qdrant-port", type=int, default=6333)
+    parser.add_argument("--qdrant-grpc-port", type=int, default=6334)
+    parser.add_argument(
+        "--qdrant-grpc",
+        action="store_true",
+        help="Talk to Qdrant over gRPC instead of HTTP",
+    )
+    parser.add_argument(
+        "--qdrant-concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of upsert batches sent to Qdrant at once",
+    )
+    parser.add_argument(
+        "--ann",
+        type=str,
+        default="none",
+        choices=["none", "ivf"],
+        help="Approximate nearest neighbour index for the vectra backend",
+    )
+    parser.add_argument(
+        "--ann-nlist",
+        type=int,
+        default=None,
+        help="Number of IVF clusters (default: sqrt of the number of vectors)",
+    )
+    parser.add_argument(
+        "--ann-nprobe",
+        type=int,
+        default=16,
+        help="Number of IVF clusters scanned per query, higher is slower but more accurate",
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="none",
+        choices=["none", "int8", "pq"],
+        help="Compress the vectors kept in memory",
+    )
+    parser.add_argument(
+        "--pq-subspaces",
+        type=int,
+        default=96,
+        help="Number of bytes per vector with --quantization pq",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        default=10,
+        help="Quantized searches re-rank that many times the results with float vectors",
+    )
+
+
+def add_query_cache_arguments(parser):
+    parser.add_argument(
+        "--query-cache",
+        type=str,
+        default="~/.cache/places/queries",
+        help="Directory persisting the query embeddings, empty to keep them in memory",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=1024,
+        help="Number of query embeddings kept in memory",
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        type=int,
+        default=256,
+        help="Number of search results kept until new content is indexed, 0 to disable",
+    )
+    parser.add_argument(
+        "--result-cache-ttl",
+        type=float,
+        default=60,
+        help="Seconds a search result is kept, for content indexed by other processes",
+    )
+
+
 def main():
     # Set up the parser
     parser = argparse.ArgumentParser(
@@ -26,10 +112,102 @@ def main():
 
     index_parser = subparsers.add_parser("index", help="Index your browser history")
     index_parser.add_argument("database")
+    index_parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Index in-process instead of posting the pages to the web server",
+    )
+    index_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Check the indexed pages for changes, and re-index the changed ones",
+    )
+    index_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only read the history visited since the last run",
+    )
+    index_parser.add_argument(
+        "--watch",
+        type=int,
+        default=0,
+        help="Sync the history incrementally every that many seconds",
+    )
+    index_parser.add_argument(
+        "--fetch-per-host",
+        type=int,
+        default=2,
+        help="Maximum number of pages fetched at once from a host",
+    )
+    index_parser.add_argument(
+        "--fetch-delay",
+        type=float,
+        default=0.5,
+        help="Minimum delay in seconds between two fetches on a host",
+    )
+    index_parser.add_argument(
+        "--fetch-concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of pages fetched at once",
+    )
+    index_parser.add_argument(
+        "--max-page-bytes",
+        type=int,
+        default=2 * 1024 * 1024,
+        help="Pages are truncated to that many bytes when downloaded",
+    )
+    add_backend_arguments(index_parser)
+    index_parser.add_argument(
+        "--extract-workers",
+        type=int,
+        default=2,
+        help="Number of processes extracting the text of pages, with --bulk",
+    )
+    index_parser.add_argument(
+        "--extract-chunk-size",
+        type=int,
+        default=8,
+        help="Number of pages sent at once to an extract process, with --bulk",
+    )
+    index_parser.add_argument(
+        "--embed-workers",
+        type=int,
+        default=1,
+        help="Number of processes running the sentence model, with --bulk",
+    )
+    index_parser.add_argument(
+        "--upsert-workers",
+        type=int,
+        default=4,
+        help="Number of pages sent to the backend at once, with --bulk",
+    )
+    index_parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=64,
+        help="Maximum number of sentences encoded at once, with --bulk",
+    )
     index_parser.set_defaults(func=run_index)
 
     query_parser = subparsers.add_parser("query", help="Query your browser history")
     query_parser.add_argument("query")
+    query_parser.add_argument(
+        "--domain", type=str, help="Only search that domain and its subdomains"
+    )
+    query_parser.add_argument(
+        "--lang", type=str, help="Only search pages in that language, e.g. english"
+    )
+    query_parser.add_argument(
+        "--after",
+        type=str,
+        help="Only search pages indexed since that date, YYYY-MM-DD",
+    )
+    query_parser.add_argument(
+        "--before", type=str, help="Only search pages indexed before that date"
+    )
+    add_backend_arguments(query_parser)
+    add_query_cache_arguments(query_parser)
     query_parser.set_defaults(func=run_query)
 
     load_parser = subparsers.add_parser("load", help="Load models")
@@ -37,12 +215,56 @@ def main():
 
     web_parser = subparsers.add_parser("web", help="Run the web server")
     web_parser.set_defaults(func=run_web)
+    add_backend_arguments(web_parser)
+    add_query_cache_arguments(web_parser)
     web_parser.add_argument(
-        "--db", type=str, default="qdrant", choices=["qdrant", "vectra"]
+        "--embed-batch-size",
+        type=int,
+        default=64,
+        help="Maximum number of sentences encoded at once",
+    )
+    web_parser.add_argument(
+        "--embed-max-wait",
+        type=int,
+        default=20,
+        help="Maximum time in ms a page waits for other pages to fill a batch",
+    )
+    web_parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="Number of worker processes running the models",
+    )
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="Benchmark the IVF index against the exact scan"
+    )
+    bench_parser.set_defaults(func=run_bench)
+    bench_parser.add_argument("--vectra-path", type=str, default="data.db")
+    bench_parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="Benchmark on that many random clustered vectors instead of the index",
+    )
+    bench_parser.add_argument("--queries", type=int, default=200)
+    bench_parser.add_argument("--k", type=int, default=10)
+    bench_parser.add_argument("--nlist", type=int, default=None)
+    bench_parser.add_argument("--nprobe", type=str, default="1,4,16,64")
+    bench_parser.add_argument("--pq-subspaces", type=int, default=96)
+    bench_parser.add_argument("--rerank", type=int, default=10)
+
+    pages_parser = subparsers.add_parser(
+        "migrate-pages",
+        help="Import the pages stored one file per url in the pages db",
+    )
+    pages_parser.set_defaults(func=run_migrate_pages)
+    pages_parser.add_argument("--source", type=str, default="/tmp/pages")
+    pages_parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete the imported files",
     )
-    web_parser.add_argument("--vectra-path", type=str, default="data.db")
-    web_parser.add_argument("--qdrant-host", type=str, default="localhost")
-    web_parser.add_argument("--qdrant-port", type=int, default=6333)
     args = parser.parse_args()
 
     set_logger()
@@ -58,28 +280,53 @@ def main():
 def run_index(args):
     from places.index.main import main
 
-    asyncio.run(main(args["database"]))
+    asyncio.run(main(args.pop("database"), args))
 
 
 def run_query(args):
     from places.query import query
 
-    query(args["query"])
+    asyncio.run(query(args.pop("query"), args))
 
 
-def load_models(args):
+def download_nltk():
     import nltk
 
     nltk.download("bcp47")
     nltk.download("punkt")
 
-    from places import vectors  # NOQA
+
+def load_models(args):
+    download_nltk()
+
+    from places.utils import get_qa
+    from places.vectors import get_model
+
+    get_model()
+    get_qa()
 
     print("LOADED!")
 
 
+def run_bench(args):
+    from places.bench import main
+
+    asyncio.run(main(args))
+
+
+def run_migrate_pages(args):
+    from places.db import PAGES_DIR, Pages, migrate_pages
+
+    pages = Pages(PAGES_DIR)
+    try:
+        migrate_pages(args["source"], pages, delete=args["delete"])
+    finally:
+        pages.close()
+
+
 def run_web(args):
-    load_models(args)
+    # the models are loaded by the workers
+    download_nltk()
 
     from places.web import main
 
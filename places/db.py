@@ -2,70 +2,293 @@ import asyncio
 import hashlib
 import json
 import os
+import re
+import sqlite3
+import threading
 import time
+import zlib
+from collections import Counter
 from contextlib import asynccontextmanager
-from urllib.parse import urlparse
 
 import aiosqlite
 
 from places.config import URL_SKIP_LIST
+from places.policy import domain_policy, get_hostname
 
+PAGES_DIR = "/tmp/pages"
 
-class Pages:
-    def __init__(self, root_dir):
-        self.root_dir = root_dir
-        os.makedirs(self.root_dir, exist_ok=True)
 
-    def get_path(self, url):
-        url_id = hashlib.md5(url.encode("utf8")).hexdigest()
-        return os.path.join(self.root_dir, url_id)
+def content_hash(html):
+    """
+    Returns the hash of the content of a page.
+    """
+    return hashlib.sha1(html.encode("utf8", "surrogatepass")).hexdigest()
 
-    def get_ts(self, url):
-        return self.get(url)["ts"]
 
-    def get(self, url):
-        path = self.get_path(url)
-        if os.path.exists(path):
-            with open(path) as f:
-                return json.loads(f.read())
-        else:
-            raise KeyError(f"{url} {path}")
+_PAGES_CREATION = """\
+CREATE TABLE IF NOT EXISTS pages (
+  url TEXT PRIMARY KEY NOT NULL,
+  ts REAL,
+  html BLOB,
+  text BLOB,
+  meta TEXT NOT NULL DEFAULT '{}'
+  )
+"""
+
+# only the fields that are set are updated, so processes writing
+# different fields of a page do not overwrite each other
+_PAGES_UPSERT = """\
+INSERT INTO pages (url, ts, html, text, meta) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(url) DO UPDATE SET
+  ts = excluded.ts,
+  html = COALESCE(excluded.html, html),
+  text = COALESCE(excluded.text, text),
+  meta = json_patch(meta, excluded.meta)
+"""
+
+_BLOBS = ("html", "text")
+_RE_LEGACY_PAGE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _compress(value):
+    return None if value is None else zlib.compress(value.encode("utf8"), 3)
 
-    def set(self, url, data, ts=None):
-        if ts is None:
-            ts = time.time()
-        path = self.get_path(url)
 
-        if os.path.exists(path):
-            doc_data = self.get(url)
-            doc_data.update(data)
-        else:
-            doc_data = data
+def _decompress(value):
+    return None if value is None else zlib.decompress(value).decode("utf8")
 
-        doc_data["ts"] = ts
-        doc_data["url"] = url
 
-        print(f"Storing {url} in {path}")
-        with open(path, "w") as f:
-            f.write(json.dumps(doc_data))
+class Pages:
+    """
+    Stores the html, text and metadata (hash, etag...) of pages.
+
+    Pages are rows of a SQLite db, `pages.sqlite` when `path` is a
+    directory, with the html and text compressed. `set` merges the
+    fields in the stored page.
+
+    Writes are sent in batches of `batch_size` rows, or by a timer
+    `max_delay` seconds after the first pending one; pending writes are
+    visible to `get` right away, and are sent by `flush` and `close`.
+    """
+
+    def __init__(self, path, batch_size=1, max_delay=5.0):
+        if os.path.isdir(path) or not os.path.splitext(path)[-1]:
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, "pages.sqlite")
+        self.path = path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._conn = None
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(_PAGES_CREATION)
+            self._conn.commit()
+        return self._conn
+
+    def get_ts(self, url):
+        return self.get(url, html=False, text=False)["ts"]
+
+    def get(self, url, html=True, text=True):
+        """
+        Returns the fields of a page. Raises KeyError when unknown.
+
+        Skipping the `html` or `text` columns avoids decompressing
+        them.
+        """
+        columns = ["ts", "meta"] + [
+            name for name, wanted in zip(_BLOBS, (html, text), strict=True) if wanted
+        ]
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    f"SELECT {', '.join(columns)} FROM pages WHERE url = ?", (url,)
+                )
+                .fetchone()
+            )
+            pending = [data for key, data in self._pending if key == url]
+
+        if row is None and not pending:
+            raise KeyError(url)
+        page = {}
+        if row is not None:
+            page.update(json.loads(row[1]))
+            for name, value in zip(columns[2:], row[2:], strict=True):
+                if value is not None:
+                    page[name] = _decompress(value)
+            page["ts"] = row[0]
+        for data in pending:
+            page.update(
+                {
+                    name: value
+                    for name, value in data.items()
+                    if (name != "html" or html) and (name != "text" or text)
+                }
+            )
+        page["url"] = url
+        return page
+
+    def set(self, url, data, ts=None):
+        if ts is None:
+            ts = time.time()
+        data = dict(data, ts=ts)
+        with self._lock:
+            self._pending.append((url, data))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rows = []
+        for url, data in self._pending:
+            meta = {
+                name: value
+                for name, value in data.items()
+                if name not in _BLOBS and name not in ("ts", "url")
+            }
+            rows.append(
+                (
+                    url,
+                    data["ts"],
+                    _compress(data.get("html")),
+                    _compress(data.get("text")),
+                    json.dumps(meta),
+                )
+            )
+        self._pending = []
+        if rows:
+            conn = self._connect()
+            with conn:
+                conn.executemany(_PAGES_UPSERT, rows)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def remove(self, url):
+        with self._lock:
+            self._pending = [item for item in self._pending if item[0] != url]
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+
+    def __len__(self):
+        self.flush()
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def migrate_pages(source, pages, delete=False, batch_size=500):
+    """
+    Imports the pages stored by older versions, one JSON file per url
+    in the `source` directory, in a Pages store.
+
+    Returns the number of imported pages.
+    """
+    pages.batch_size = max(pages.batch_size, batch_size)
+    count = 0
+    for entry in os.scandir(source):
+        if not entry.is_file() or not _RE_LEGACY_PAGE.match(entry.name):
+            continue
+        with open(entry.path) as f:
+            data = json.loads(f.read())
+        url = data.pop("url")
+        ts = data.pop("ts", None)
+        pages.set(url, data, ts=ts)
+        count += 1
+        if count % batch_size == 0:
+            print(f"[pages] {count} pages imported")
+    pages.flush()
+    if delete:
+        for entry in os.scandir(source):
+            if entry.is_file() and _RE_LEGACY_PAGE.match(entry.name):
+                os.remove(entry.path)
+    print(f"[pages] {count} pages imported in {pages.path}")
+    return count
 
 
 _CREATION = """\
 CREATE TABLE IF NOT EXISTS domain (
   domain TEXT PRIMARY KEY NOT NULL,
   skip BOOL DEFAULT FALSE,
-  indexed_pages INTEGER DEFAULT 0
+  indexed_pages INTEGER DEFAULT 0,
+  allow BOOL DEFAULT FALSE
   )
 """
 
+# dbs created before the allow column
+_ADD_ALLOW = "ALTER TABLE domain ADD COLUMN allow BOOL DEFAULT FALSE"
+
+# `allow` records that a domain was explicitly unskipped, unlike the
+# rows created by the counters of indexed pages
+_SET_SKIP = """\
+INSERT INTO domain (domain, skip, allow) VALUES (?, ?, ?)
+ON CONFLICT(domain) DO UPDATE SET skip = excluded.skip, allow = excluded.allow
+"""
+
+_ADD_INDEXED = """\
+INSERT INTO domain (domain, indexed_pages) VALUES (?, ?)
+ON CONFLICT(domain) DO UPDATE SET
+  indexed_pages = indexed_pages + excluded.indexed_pages
+"""
+
 
 class DB:
-    def __init__(self, path="places-db.sqlite"):
+    """
+    Domains db: the skipped domains, and the number of indexed pages
+    of each domain.
+
+    Skipped and explicitly allowed domains are loaded in a DomainPolicy,
+    the one shared by the process by default, so `get_skip` does not
+    query the db.
+
+    One connection is kept open, in WAL mode, and reuses its prepared
+    statements. Indexed pages are counted in memory, and the counters
+    are written in one transaction `flush_delay` seconds later, or by
+    `flush` and `close`.
+    """
+
+    def __init__(self, path="places-db.sqlite", flush_delay=1.0, policy=None):
         self.path = path
+        self.flush_delay = flush_delay
+        self.policy = domain_policy if policy is None else policy
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._indexed = Counter()
+        self._flusher = None
+
+    async def _connect(self):
+        if self._conn is None:
+            conn = await aiosqlite.connect(self.path)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+        return self._conn
 
     @asynccontextmanager
     async def session(self):
-        async with aiosqlite.connect(self.path) as db:
+        async with self._lock:
+            db = await self._connect()
             try:
                 yield db
             finally:
@@ -74,79 +297,115 @@ class DB:
     async def check_db(self):
         async with self.session() as db:
             await db.execute(_CREATION)
-        for url in URL_SKIP_LIST:
-            print(f"Adding {url} to skip list")
-            await self.set_skip(url)
+            cursor = await db.execute("PRAGMA table_info(domain)")
+            if "allow" not in {row[1] for row in await cursor.fetchall()}:
+                await db.execute(_ADD_ALLOW)
+            # the blocklist is loaded in one transaction
+            await db.executemany(_SET_SKIP, [(url, 1, 0) for url in URL_SKIP_LIST])
+            cursor = await db.execute(
+                "SELECT domain, skip FROM domain WHERE skip = 1 OR allow = 1"
+            )
+            self.policy.load(await cursor.fetchall())
+        print(f"Added {len(URL_SKIP_LIST)} domains to the skip list")
 
     async def get_skipped_domains(self):
         async with self.session() as db:
-            cursor = await db.execute("SELECT * from domain WHERE skip=1")
-            async for row in cursor:
-                domain, __, indexed_pages = row
-
-                yield {"domain": domain, "skip": True, "indexed_pages": indexed_pages}
+            cursor = await db.execute(
+                "SELECT domain, indexed_pages from domain WHERE skip=1"
+            )
+            rows = await cursor.fetchall()
+        for domain, indexed_pages in rows:
+            indexed_pages += self._indexed[domain]
+            yield {"domain": domain, "skip": True, "indexed_pages": indexed_pages}
 
     async def get_indexed_domains(self):
+        await self.flush()
         async with self.session() as db:
             cursor = await db.execute(
-                "SELECT * from domain WHERE skip = 0 AND indexed_pages > 0 ORDER BY indexed_pages DESC"
+                "SELECT domain, indexed_pages from domain WHERE skip = 0 AND indexed_pages > 0 ORDER BY indexed_pages DESC"
             )
-            async for row in cursor:
-                domain, __, indexed_pages = row
-
-                yield {"domain": domain, "skip": False, "indexed_pages": indexed_pages}
+            rows = await cursor.fetchall()
+        for domain, indexed_pages in rows:
+            yield {"domain": domain, "skip": False, "indexed_pages": indexed_pages}
 
     def get_domain(self, url):
-        if url.startswith("http"):
-            return urlparse(url).hostname
-        return url
+        return get_hostname(url)
 
     async def set_skip(self, url, skip=True):
-        info = await self.domain_info(url)
-        info["skip"] = skip
-        await self._save_domain(info)
-
-    async def get_skip(self, url):
-        info = await self.domain_info(url)
-        return info["skip"]
-
-    async def _save_domain(self, domain):
-        skip = 1 if domain["skip"] else 0
-
         async with self.session() as db:
             await db.execute(
-                "UPDATE domain SET skip = ?, indexed_pages = ? WHERE domain = ?",
-                (skip, domain["indexed_pages"], domain["domain"]),
+                _SET_SKIP, (self.get_domain(url), 1 if skip else 0, 0 if skip else 1)
             )
+        self.policy.set_skip(url, skip)
+
+    async def get_skip(self, url):
+        return self.policy.is_skipped(url)
 
     async def indexed(self, url):
-        domain = self.get_domain(url)
+        self._indexed[self.get_domain(url)] += 1
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Writes the pending counters of indexed pages.
+        """
+        if not self._indexed:
+            return
+        counters, self._indexed = self._indexed, Counter()
+        async with self.session() as db:
+            await db.executemany(_ADD_INDEXED, list(counters.items()))
 
+    async def reset_indexed(self, url):
+        """
+        Resets the indexed pages of a domain and its subdomains.
+        """
+        domain = self.get_domain(url)
+        await self.flush()
         async with self.session() as db:
             await db.execute(
-                "UPDATE domain SET indexed_pages = indexed_pages +  1 WHERE domain = ?",
-                (domain,),
+                "UPDATE domain SET indexed_pages = 0 WHERE domain = ? OR domain LIKE ?",
+                (domain, f"%.{domain}"),
             )
 
     async def add_domain(self, url):
         domain = self.get_domain(url)
         async with self.session() as db:
-            await db.execute("INSERT INTO domain (domain) values (?)", (domain,))
+            await db.execute(
+                "INSERT OR IGNORE INTO domain (domain) values (?)", (domain,)
+            )
 
     async def domain_info(self, url):
         domain = self.get_domain(url)
 
         async with self.session() as db:
             cursor = await db.execute(
-                "SELECT * from domain WHERE domain = ?", (domain,)
+                "SELECT indexed_pages from domain WHERE domain = ?", (domain,)
             )
             row = await cursor.fetchone()
-            if row is None:
-                await db.execute("INSERT INTO domain (domain) values (?)", (domain,))
-                return {"domain": domain, "skip": False, "indexed_pages": 0}
-            _, skip, indexed_pages = row
-            skip = True if skip == 1 else False
-            return {"domain": domain, "skip": skip, "indexed_pages": indexed_pages}
+        # counters not written yet
+        pending = self._indexed[domain]
+        indexed_pages = 0 if row is None else row[0]
+        return {
+            "domain": domain,
+            # parent domains can be skipped too
+            "skip": self.policy.is_skipped(domain),
+            "indexed_pages": indexed_pages + pending,
+        }
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
 
 
 if __name__ == "__main__":
@@ -165,5 +424,6 @@ if __name__ == "__main__":
         assert not (await db.get_skip("http://example.com"))
         await db.set_skip("http://example.com", False)
         assert await db.get_skip("http://example.com")
+        await db.close()
 
     asyncio.run(test_db())
@@ -0,0 +1,249 @@
+"""
+Streaming html extraction.
+
+Pages are fed to an incremental parser, chunk by chunk, instead of
+being loaded in a full tree. The parser yields the text of the main
+content, one block (paragraph, heading, list item...) at a time, and
+drops scripts, styles and the navigation boilerplate on the way.
+
+lxml is used when it is installed, the html.parser module of the
+standard library otherwise.
+"""
+import re
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# size of the chunks fed to the parser
+CHUNK_SIZE = 64 * 1024
+
+# content that is never text
+_DROPPED = {"script", "style", "noscript", "template", "svg", "math", "iframe"}
+# navigation and other boilerplate around the main content
+_BOILERPLATE = {"nav", "aside", "menu", "dialog"}
+# boilerplate of the page, unless they are part of the content, like the
+# header of an article
+_PAGE_BOILERPLATE = {"header", "footer"}
+_CONTENT = {"article", "main", "section"}
+_BOILERPLATE_ROLES = {
+    "navigation",
+    "banner",
+    "contentinfo",
+    "complementary",
+    "search",
+    "menu",
+    "dialog",
+}
+# elements that end a block of text
+_BLOCKS = {
+    "address",
+    "article",
+    "blockquote",
+    "br",
+    "dd",
+    "details",
+    "div",
+    "dl",
+    "dt",
+    "figcaption",
+    "figure",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "li",
+    "main",
+    "ol",
+    "p",
+    "pre",
+    "section",
+    "summary",
+    "table",
+    "td",
+    "th",
+    "tr",
+    "ul",
+}
+_VOID = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+}
+
+_RE_SPACES = re.compile(r"\s+")
+
+
+class _Target:
+    """
+    Receives the parser events and builds the text blocks.
+    """
+
+    def __init__(self):
+        self.title = ""
+        self.blocks = []
+        self._text = []
+        self._title = None
+        # element being skipped, and how many of them are open
+        self._skipped = None
+        self._depth = 0
+        # number of open content elements
+        self._content = 0
+
+    def start(self, tag, attrib):
+        tag = tag.lower()
+        if self._skipped is not None:
+            if tag == self._skipped:
+                self._depth += 1
+            return
+        if tag in _VOID:
+            if tag in _BLOCKS:
+                self._flush()
+            return
+        role = (attrib.get("role") or "").lower()
+        if (
+            tag in _DROPPED
+            or tag in _BOILERPLATE
+            or (tag in _PAGE_BOILERPLATE and not self._content)
+            or role in _BOILERPLATE_ROLES
+        ):
+            self._flush()
+            self._skipped = tag
+            self._depth = 1
+            return
+        if tag in _CONTENT:
+            self._content += 1
+        if tag == "title":
+            self._title = []
+        elif tag in _BLOCKS:
+            self._flush()
+
+    def end(self, tag):
+        tag = tag.lower()
+        if self._skipped is not None:
+            if tag == self._skipped:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._skipped = None
+            return
+        if tag in _CONTENT and self._content:
+            self._content -= 1
+        if tag == "title" and self._title is not None:
+            self.title = _RE_SPACES.sub(" ", "".join(self._title)).strip()
+            self._title = None
+            # the title is part of the text, as the first block
+            if self.title:
+                self.blocks.append(self.title)
+        elif tag in _BLOCKS:
+            self._flush()
+
+    def data(self, data):
+        if self._skipped is not None:
+            return
+        if self._title is not None:
+            self._title.append(data)
+        else:
+            self._text.append(data)
+
+    def close(self):
+        self._flush()
+
+    def _flush(self):
+        text = _RE_SPACES.sub(" ", "".join(self._text)).strip()
+        self._text = []
+        if text:
+            self.blocks.append(text)
+
+
+class _StdlibParser(HTMLParser):
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, {name: value for name, value in attrs})
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _VOID:
+            self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+    def close(self):
+        super().close()
+        self.target.close()
+
+
+class TextExtractor:
+    """
+    Incremental extractor: `feed()` takes html chunks, and returns the
+    text blocks completed so far. `close()` returns the last ones.
+
+    The title is available in `title` once it has been parsed.
+    """
+
+    def __init__(self, use_lxml=True):
+        self._target = _Target()
+        if use_lxml and etree is not None:
+            self._parser = etree.HTMLParser(target=self._target, recover=True)
+        else:
+            self._parser = _StdlibParser(self._target)
+
+    @property
+    def title(self):
+        return self._target.title
+
+    def _pop(self):
+        blocks = self._target.blocks
+        self._target.blocks = []
+        return blocks
+
+    def feed(self, chunk):
+        self._parser.feed(chunk)
+        return self._pop()
+
+    def close(self):
+        self._parser.close()
+        return self._pop()
+
+
+def iter_blocks(chunks, extractor=None):
+    """
+    Yields the text blocks of html read in chunks.
+    """
+    extractor = extractor or TextExtractor()
+    for chunk in chunks:
+        yield from extractor.feed(chunk)
+    yield from extractor.close()
+
+
+def extract_html(html, chunk_size=CHUNK_SIZE):
+    """
+    Returns the (title, text) of an html page, with one line per block
+    of text.
+    """
+    extractor = TextExtractor()
+    chunks = (html[i : i + chunk_size] for i in range(0, len(html), chunk_size))
+    text = "\n".join(iter_blocks(chunks, extractor))
+    return extractor.title, text
@@ -0,0 +1,50 @@
+"""
+Search filters
+
+Searches can be restricted to a domain and its subdomains, a language
+("english", "french"...) and a range of indexing dates. Filters are
+passed to the backends as a dict with the filters that are set:
+
+    {"domain": "example.com", "lang": "english", "after": ts, "before": ts}
+
+Dates are timestamps: `after` is included, `before` excluded.
+"""
+import datetime
+
+from places.policy import get_hostname
+
+FILTERS = ("domain", "lang", "after", "before")
+
+
+def parse_date(value):
+    """
+    Returns the timestamp of a YYYY-MM-DD date, in UTC, or of a timestamp.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date {value!r}, expected YYYY-MM-DD") from None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def search_filters(domain=None, lang=None, after=None, before=None):
+    """
+    Returns the filters of a search, from the strings of a query string
+    or of the command line. Raises ValueError on invalid dates.
+    """
+    filters = {}
+    if domain:
+        filters["domain"] = get_hostname(domain)
+    if lang:
+        filters["lang"] = lang.strip().lower()
+    if after:
+        filters["after"] = parse_date(after)
+    if before:
+        filters["before"] = parse_date(before)
+    return filters
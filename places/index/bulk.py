@@ -0,0 +1,247 @@
+"""
+In-process bulk indexing.
+
+Instead of posting every page to the /index endpoint of a running
+server, scraped pages go through a pipeline of stages, each with its
+own number of workers:
+
+    pages -> extract (processes) -> embed (processes) -> upsert -> backend
+
+The extract stage tokenizes the pages and detects their language in
+its own processes, and hands them off in chunks, so the next pages are
+tokenized while the model embeds the current ones.
+
+Stages are connected by bounded queues, so a slow stage holds back
+the previous ones instead of piling up pages in memory.
+
+Progress is recorded in an IndexState: embedded pages are checkpointed,
+so a resumed run only upserts them.
+"""
+import asyncio
+import os
+import time
+
+from places.backends import get_db
+from places.batcher import EmbeddingBatcher
+from places.chunking import get_sentence_hashes
+from places.db import DB, content_hash
+from places.index.state import INDEXED, SKIPPED, IndexState
+from places.vectors import PageVectors, extract_pages, pages_db
+from places.workers import WorkerPool
+
+# pages waiting between two stages, per worker of the next stage
+_QUEUE_PER_WORKER = 4
+_REPORT_INTERVAL = 10
+_MIN_SENTENCES = 5
+
+
+class BulkStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.pages = 0
+        self.sentences = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        print(
+            f"[bulk] {self.pages} pages ({self.pages / elapsed:.1f}/s), "
+            f"{self.sentences} sentences ({self.sentences / elapsed:.1f}/s), "
+            f"{self.skipped} skipped, {self.failed} failed"
+        )
+
+
+class BulkIndexer:
+    """
+    Reads (url, html) tuples from `pages` until "END", and indexes them
+    in the backend described by `args` (see places.cli).
+    """
+
+    def __init__(self, pages, args, state=None):
+        self.pages = pages
+        self.args = args
+        self.state = state or IndexState()
+        self.extract_workers = args.get("extract_workers", 2)
+        self.embed_workers = args.get("embed_workers", 1)
+        self.upsert_workers = args.get("upsert_workers", 4)
+        self.embed_batch_size = args.get("embed_batch_size", 64)
+        self.extract_chunk_size = args.get("extract_chunk_size", 8)
+        self.stats = BulkStats()
+
+    def _failed(self, item, error):
+        url = item.url if isinstance(item, PageVectors) else item[0]
+        print(f"[bulk] failed on {url}: {error!r}")
+        self.state.failed(url, error)
+        self.stats.failed += 1
+
+    async def _take(self, source, chunk_size):
+        """
+        Returns the next item of `source` and the items waiting behind
+        it, up to `chunk_size`. Returns an empty list once `source` is
+        exhausted.
+        """
+        items = []
+        while len(items) < chunk_size:
+            if items and source.empty():
+                break
+            item = await source.get()
+            if item is None or item == "END":
+                # other workers of this stage stop too
+                await source.put(item)
+                break
+            items.append(item)
+        return items
+
+    async def _stage(self, source, sink, workers, process, chunk_size=None):
+        """
+        Runs `workers` coroutines calling `process` on the items of
+        `source`, and puts the results in `sink`. Ends the next stage
+        once `source` is exhausted.
+
+        With `chunk_size`, `process` is called with lists of items and
+        returns a list with the result of each, or the exception it
+        failed with.
+        """
+
+        async def worker():
+            while True:
+                items = await self._take(source, chunk_size or 1)
+                if not items:
+                    return
+                try:
+                    if chunk_size is None:
+                        results = [await process(items[0])]
+                    else:
+                        results = await process(items)
+                except Exception as e:
+                    results = [e] * len(items)
+                for item, result in zip(items, results, strict=True):
+                    if isinstance(result, Exception):
+                        self._failed(item, result)
+                    elif result is not None and sink is not None:
+                        await sink.put(result)
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        if sink is not None:
+            await sink.put(None)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(_REPORT_INTERVAL)
+            self.stats.report()
+
+    async def run(self):
+        client = get_db(**self.args)
+        await client.init_db()
+        db = DB()
+        await db.check_db()
+
+        extractor = WorkerPool(self.extract_workers, models=False)
+        # the cores left by the extract workers run the model
+        cores = max(1, (os.cpu_count() or 1) - self.extract_workers)
+        embedder = WorkerPool(
+            self.embed_workers, threads=max(1, cores // self.embed_workers)
+        )
+        batcher = EmbeddingBatcher(
+            embedder.encode, max_batch_size=self.embed_batch_size
+        )
+        batcher.start()
+
+        # enough pages are embedded at once to fill the batches
+        embed_tasks = self.embed_workers * _QUEUE_PER_WORKER
+        extracted = asyncio.Queue(embed_tasks * _QUEUE_PER_WORKER)
+        embedded = asyncio.Queue(self.upsert_workers * _QUEUE_PER_WORKER)
+
+        def skip(url, digest=None):
+            if digest is not None:
+                pages_db.set(url, {"hash": digest})
+            self.state.set(url, SKIPPED)
+            self.stats.skipped += 1
+
+        async def forget(url):
+            # the previous version of the page was indexed
+            try:
+                previous = pages_db.get(url, html=False, text=False)
+            except KeyError:
+                return
+            if "hash" in previous:
+                await client.delete_urls([url])
+
+        async def extract(pages):
+            results = [None] * len(pages)
+            todo = []
+            for i, (url, html) in enumerate(pages):
+                checkpoint = self.state.restore(url)
+                if checkpoint is not None:
+                    results[i] = checkpoint
+                elif html is None or await db.get_skip(url):
+                    skip(url)
+                else:
+                    todo.append(i)
+            if not todo:
+                return results
+
+            # one round trip to the extract workers per chunk of pages
+            extracted = await extractor.run(extract_pages, [pages[i] for i in todo])
+            for i, page in zip(todo, extracted, strict=True):
+                if isinstance(page, Exception):
+                    results[i] = page
+                    continue
+                url, html = pages[i]
+                title, sentences, lang, text = page
+                digest = content_hash(html)
+                if len(sentences) < _MIN_SENTENCES:
+                    # other pages can index these sentences
+                    get_sentence_hashes().release(url, sentences)
+                    await forget(url)
+                    skip(url, digest)
+                else:
+                    results[i] = url, title, sentences, lang, text, digest
+            return results
+
+        async def embed(page):
+            if isinstance(page, PageVectors):
+                return page
+            url, title, sentences, lang, text, digest = page
+            vectors = await batcher.embed(sentences)
+            page = PageVectors(url, title, sentences, lang, text, vectors, digest)
+            self.state.checkpoint(url, page)
+            return page
+
+        async def upsert(page):
+            try:
+                await client.index(points=page.points(client))
+            except Exception:
+                # other pages can index these sentences
+                get_sentence_hashes().release(page.url)
+                raise
+            await db.indexed(page.url)
+            pages_db.set(page.url, {"hash": page.content_hash})
+            self.state.set(page.url, INDEXED, sentences=len(page))
+            self.stats.pages += 1
+            self.stats.sentences += len(page)
+
+        reporter = asyncio.create_task(self._report())
+        try:
+            await asyncio.gather(
+                # two chunks per process keep the extract workers busy while
+                # the previous pages are embedded
+                self._stage(
+                    self.pages,
+                    extracted,
+                    self.extract_workers * 2,
+                    extract,
+                    chunk_size=self.extract_chunk_size,
+                ),
+                self._stage(extracted, embedded, embed_tasks, embed),
+                self._stage(embedded, None, self.upsert_workers, upsert),
+            )
+        finally:
+            reporter.cancel()
+            await batcher.stop()
+            extractor.shutdown()
+            embedder.shutdown()
+            await db.close()
+            await client.close()
+        self.stats.report()
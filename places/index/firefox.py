@@ -1,6 +1,12 @@
+import asyncio
+import os
+import pathlib
+import shutil
 import sqlite3
+import tempfile
 from urllib.parse import urlparse
 
+from places.index.state import IndexState
 from places.utils import should_skip
 
 
@@ -12,44 +18,128 @@ class Places:
     Parameters:
     @queue: An asyncio queue to put the read URLs into.
     @db: The path to the places.sqlite database file. Default is "places.sqlite".
-    @cache: An optional cache to check for duplicate URLs. Default is None.
+    @state: An optional IndexState tracking the URLs of previous runs.
+    @incremental: Only read the rows added or visited since the last run.
+    @refresh: Also read the URLs indexed by previous runs.
 
     Functionality:
-    - Reads the places.sqlite database.
+    - Reads a snapshot of the places.sqlite database, which Firefox locks.
     - Extracts URLs from the moz_places table.
+    - In incremental mode, reads only the rows with a higher id or
+      last_visit_date than the high-water mark of the last run. The mark
+      is saved by commit(), once the URLs are indexed, and stays below
+      the rows of the URLs that failed and are retried later.
     - Puts all non-skipped URLs into the queue.
     - Skips URLs that:
         - Contain a domain in the skip list (github.com, google.com, etc.)
-        - Are already in the cache
+        - Were indexed or skipped by a previous run, or failed recently.
+          With @refresh, indexed URLs are read again, to update the changed ones.
     - Prints stats on the number of URLs collected and skipped.
     - Puts "END" into the queue when done.
     """
 
-    def __init__(self, queue, db="places.sqlite", cache=None):
+    def __init__(
+        self, queue, db="places.sqlite", state=None, incremental=False, refresh=False
+    ):
         self.db = db
         self.queue = queue
-        if cache is None:
-            self.cache = {}
+        if state is None:
+            self.state = IndexState()
         else:
-            self.cache = cache
+            self.state = state
+        self.incremental = incremental
+        self.refresh = refresh
+        self.mark_key = os.path.abspath(db)
+        self._mark = None
+        # url -> row id, of the urls read by the run that may be retried
+        self._rows = {}
 
-    async def run(self):
-        # blocking code
-        con = sqlite3.connect(self.db)
+    def snapshot(self, target):
+        """
+        Copies the database into `target`, with the sqlite backup API,
+        or by copying the files when Firefox holds an exclusive lock.
+        """
+        try:
+            uri = pathlib.Path(self.db).absolute().as_uri()
+            source = sqlite3.connect(f"{uri}?mode=ro", uri=True)
+            dest = sqlite3.connect(target)
+            try:
+                source.backup(dest)
+            finally:
+                source.close()
+                dest.close()
+        except sqlite3.OperationalError:
+            for suffix in ("", "-wal"):
+                if os.path.exists(self.db + suffix):
+                    shutil.copyfile(self.db + suffix, target + suffix)
+
+    def read_rows(self, con, mark=None):
+        """
+        Yields the (id, url, last_visit_date) rows past the mark.
+        """
         cur = con.cursor()
-        print("[places] Reading places.sqlite")
+        if mark is None:
+            yield from cur.execute(
+                "SELECT id, url, last_visit_date FROM moz_places ORDER BY id"
+            )
+            return
+        yield from cur.execute(
+            "SELECT id, url, last_visit_date FROM moz_places WHERE id > ? "
+            "UNION "
+            "SELECT id, url, last_visit_date FROM moz_places WHERE last_visit_date > ? "
+            "ORDER BY id",
+            (mark["id"], mark["last_visit_date"]),
+        )
+
+    async def run(self):
+        mark = self.state.get_mark(self.mark_key) if self.incremental else None
+        new_mark = dict(mark or {"id": 0, "last_visit_date": 0})
         url_count = 0
         skipped_count = 0
-        for line in cur.execute("select URL from moz_places"):
-            url = line[0]
-            if should_skip(url, cache=self.cache):
-                skipped_count += 1
-                continue
-            self.cache[url] = "processing"
-            parsed = urlparse(url)
-            if parsed.scheme in ("http", "https"):
-                url_count += 1
-                await self.queue.put(url)
+        self._rows = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = os.path.join(tmp, "places.sqlite")
+            await asyncio.to_thread(self.snapshot, snapshot)
+            # blocking code
+            con = sqlite3.connect(snapshot)
+            try:
+                print("[places] Reading places.sqlite")
+                for row_id, url, last_visit_date in self.read_rows(con, mark):
+                    new_mark["id"] = max(new_mark["id"], row_id)
+                    new_mark["last_visit_date"] = max(
+                        new_mark["last_visit_date"], last_visit_date or 0
+                    )
+                    if should_skip(url):
+                        skipped_count += 1
+                        continue
+                    if not self.state.pending(url, refresh=self.refresh):
+                        # waiting for its backoff
+                        if self.state.retried(url):
+                            self._rows[url] = row_id
+                        skipped_count += 1
+                        continue
+                    parsed = urlparse(url)
+                    if parsed.scheme in ("http", "https"):
+                        self.state.queue(url)
+                        self._rows[url] = row_id
+                        url_count += 1
+                        await self.queue.put(url)
+            finally:
+                con.close()
 
+        self._mark = new_mark
         print(f"[places] Collected {url_count} urls. Skipped {skipped_count} urls")
         await self.queue.put("END")
+
+    def commit(self):
+        """
+        Saves the high-water mark of the last run, below the first row
+        of the urls that are retried later.
+        """
+        if self._mark is None:
+            return
+        mark = dict(self._mark)
+        for url, row_id in self._rows.items():
+            if self.state.retried(url):
+                mark["id"] = min(mark["id"], row_id - 1)
+        self.state.set_mark(self.mark_key, mark)
@@ -4,8 +4,12 @@ import sys
 
 from diskcache import Cache
 
+from places.db import DB
 from places.index import Places, SessionBuddy
-from places.scrap import WebScrap
+from places.index.bulk import BulkIndexer
+from places.index.state import IndexState
+from places.scheduler import HostScheduler
+from places.scrap import MAX_PAGE_BYTES, WebScrap
 from places.vectors import Upserter
 
 CACHE_DIR = os.path.join(os.path.expanduser("~/.cache"), "places")
@@ -25,36 +29,83 @@ def initiate_cache(source):
     return cache
 
 
-async def main(db_path):
+async def run_once(db_path, args=None):
     urls = asyncio.Queue()
     pages = asyncio.Queue()
 
     coros = []
     source = None
+    reader = None
+    args = args or {}
+
+    # the readers skip the domains skipped in the web app too
+    db = DB()
+    await db.check_db()
+    await db.close()
 
     # check if ends with .sqlite or .json
     if db_path.endswith(".sqlite"):
         # Places feeds the urls queue
         source = "firefox"
-        cache = initiate_cache(source)
-        coros.append(Places(urls, db=db_path, cache=cache).run())
+        state = IndexState(initiate_cache(source))
+        reader = Places(
+            urls,
+            db=db_path,
+            state=state,
+            incremental=args.get("incremental") or bool(args.get("watch")),
+            refresh=args.get("refresh", False),
+        )
     elif db_path.endswith(".json"):
         # SessionBuddy feeds the urls queue
         source = "sessionbuddy"
-        cache = initiate_cache(source)
-        coros.append(SessionBuddy(urls, db=db_path, cache=cache).run())
+        state = IndexState(initiate_cache(source))
+        reader = SessionBuddy(
+            urls, db=db_path, state=state, refresh=args.get("refresh", False)
+        )
     else:
         raise ValueError(f"Unknown source of bookmarks db {db_path}")
+    coros.append(reader.run())
 
-    # Webscrap converts urls into pages
-    coros.append(WebScrap(urls, pages, source=source).run())
+    # Webscrap converts urls into pages, politely
+    scheduler = HostScheduler(
+        per_host=args.get("fetch_per_host", 2),
+        delay=args.get("fetch_delay", 0.5),
+        max_concurrency=args.get("fetch_concurrency", 64),
+    )
+    scrap = WebScrap(
+        urls,
+        pages,
+        source=source,
+        state=state,
+        scheduler=scheduler,
+        max_bytes=args.get("max_page_bytes", MAX_PAGE_BYTES),
+    )
+    coros.append(scrap.run())
 
-    # Upserter reads from pages and sends to web api
-    coros.append(Upserter(pages).run())
+    if args.get("bulk"):
+        # BulkIndexer reads from pages and indexes them in-process
+        coros.append(BulkIndexer(pages, args, state=state).run())
+    else:
+        # Upserter reads from pages and sends to web api
+        coros.append(Upserter(pages, state=state).run())
 
     # let's start everyone
     await asyncio.gather(*coros)
 
+    # the next incremental run starts after these rows
+    if isinstance(reader, Places):
+        reader.commit()
+
+
+async def main(db_path, args=None):
+    watch = (args or {}).get("watch")
+    while True:
+        await run_once(db_path, args)
+        if not watch:
+            return
+        print(f"[index] Next sync in {watch} seconds")
+        await asyncio.sleep(watch)
+
 
 if __name__ == "__main__":
     bookmarks_path = sys.argv[-1]
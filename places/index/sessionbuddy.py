@@ -1,6 +1,7 @@
 import json
 from urllib.parse import urlparse
 
+from places.index.state import IndexState
 from places.utils import remove_bom, should_skip
 
 
@@ -12,7 +13,8 @@ class SessionBuddy:
     Parameters:
     @queue: An asyncio queue to put the read URLs into.
     @db: The path to the Session Buddy JSON export file.
-    @cache: An optional cache to check for duplicate URLs. Default is an empty dict.
+    @state: An optional IndexState tracking the URLs of previous runs.
+    @refresh: Also read the URLs indexed by previous runs.
 
     Functionality:
     - Reads the Session Buddy JSON export file
@@ -21,18 +23,20 @@ class SessionBuddy:
     - Puts all non-skipped URLs into the queue.
     - Skips URLs that:
         - Contain a domain in the skip list (github.com, google.com, etc.)
-        - Are already in the cache
+        - Were indexed or skipped by a previous run, or failed recently.
+          With @refresh, indexed URLs are read again, to update the changed ones.
     - Prints stats on the number of URLs collected and skipped.
     - Puts "END" into the queue when done.
     """
 
-    def __init__(self, queue, db="session.json", cache=None):
+    def __init__(self, queue, db="session.json", state=None, refresh=False):
         self.db = db
         self.queue = queue
-        if cache is None:
-            self.cache = {}
+        if state is None:
+            self.state = IndexState()
         else:
-            self.cache = cache
+            self.state = state
+        self.refresh = refresh
         remove_bom(self.db)
 
     async def run(self):
@@ -60,12 +64,15 @@ class SessionBuddy:
                 for tab in tabs:
                     url = tab["url"]
                     title = tab["title"]
-                    if should_skip(url, cache=self.cache):
+                    if should_skip(url) or not self.state.pending(
+                        url, refresh=self.refresh
+                    ):
                         skipped_count += 1
                         continue
-                    self.cache[url] = title
                     parsed = urlparse(url)
                     if parsed.scheme in ("http", "https"):
+                        # the title is indexed when the page can't be read
+                        self.state.queue(url, title=title)
                         url_count += 1
                         await self.queue.put(url)
 
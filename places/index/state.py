@@ -0,0 +1,144 @@
+"""
+Durable state of the urls of indexing runs.
+
+Every url goes through:
+
+    queued -> fetched -> embedded -> indexed
+
+or ends as skipped (nothing to index), or failed, in which case it is
+retried by later runs with an exponential backoff.
+
+Each transition is written to the diskcache of the source right away,
+so an interrupted run resumes where it stopped: fetched pages are read
+back from the pages db instead of being fetched again, and embedded
+pages are checkpointed with their vectors so they are not re-embedded.
+"""
+import time
+
+QUEUED = "queued"
+FETCHED = "fetched"
+EMBEDDED = "embedded"
+INDEXED = "indexed"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# values written by older versions of the url cache
+_LEGACY = {
+    "processing": QUEUED,
+    "processed": INDEXED,
+    "error": FAILED,
+    "unreadable": FAILED,
+}
+
+
+class IndexState:
+    """
+    Wraps a mapping, usually a diskcache.Cache, with one entry per url:
+
+        {"state": ..., "ts": ..., "failures": ..., "retry_at": ...}
+
+    After `max_failures` failures, a url is not retried anymore.
+    """
+
+    def __init__(self, cache=None, max_failures=5, backoff=60, max_backoff=86400):
+        self._cache = {} if cache is None else cache
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def get(self, url):
+        entry = self._cache.get(url)
+        if entry is None:
+            return None
+        if isinstance(entry, str):
+            state = _LEGACY.get(entry, QUEUED)
+            entry = {"state": state, "ts": 0, "failures": int(state == FAILED)}
+        return dict(entry)
+
+    def state(self, url):
+        entry = self.get(url)
+        return None if entry is None else entry["state"]
+
+    def pending(self, url, now=None, refresh=False):
+        """
+        Returns True when the url still needs some work.
+        With `refresh`, indexed urls are checked for changes.
+        """
+        entry = self.get(url)
+        if entry is None:
+            return True
+        if entry["state"] == INDEXED:
+            return refresh
+        if entry["state"] == SKIPPED:
+            return False
+        if entry["state"] == FAILED:
+            if entry["failures"] >= self.max_failures:
+                return False
+            now = time.time() if now is None else now
+            return now >= entry.get("retry_at", 0)
+        # interrupted by a previous run
+        return True
+
+    def retried(self, url):
+        """
+        Returns True when a later run still has work on the url: it
+        failed and is retried after its backoff, or it was interrupted.
+        """
+        entry = self.get(url)
+        if entry is None or entry["state"] in (INDEXED, SKIPPED):
+            return False
+        if entry["state"] == FAILED:
+            return entry["failures"] < self.max_failures
+        return True
+
+    def set(self, url, state, **fields):
+        entry = self.get(url) or {"failures": 0}
+        entry.update(fields)
+        entry["state"] = state
+        entry["ts"] = time.time()
+        entry.pop("retry_at", None)
+        self._cache[url] = entry
+        if state in (INDEXED, SKIPPED, FAILED):
+            self._cache.pop(("vectors", url), None)
+        return entry
+
+    def queue(self, url, **fields):
+        """
+        Marks a url as queued, unless a previous run made progress on it.
+        """
+        if self.state(url) in (FETCHED, EMBEDDED):
+            return self.get(url)
+        return self.set(url, QUEUED, **fields)
+
+    def failed(self, url, error):
+        entry = self.get(url) or {"failures": 0}
+        failures = entry["failures"] + 1
+        entry = self.set(url, FAILED, failures=failures, error=repr(error))
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        entry["retry_at"] = entry["ts"] + delay
+        self._cache[url] = entry
+        return entry
+
+    def checkpoint(self, url, page):
+        """
+        Keeps the embedded page until it is indexed.
+        """
+        self._cache[("vectors", url)] = page
+        return self.set(url, EMBEDDED)
+
+    def restore(self, url):
+        """
+        Returns the page checkpointed by a previous run, if any.
+        """
+        if self.state(url) != EMBEDDED:
+            return None
+        return self._cache.get(("vectors", url))
+
+    def get_mark(self, source):
+        """
+        Returns the position reached by the last run on a source.
+        """
+        return self._cache.get(("mark", source))
+
+    def set_mark(self, source, mark):
+        self._cache[("mark", source)] = mark
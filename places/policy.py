@@ -0,0 +1,77 @@
+"""
+Domain policy
+
+Decides which urls are skipped, in memory. Domains are matched with
+their subdomains: skipping google.com skips mail.google.com too, unless
+mail.google.com has a state of its own. The most specific domain wins.
+
+Each process has one policy, loaded from the blocklist, then from the
+domains db by DB.check_db when the web app or `places index` starts, and
+updated in place when domains are skipped or unskipped.
+"""
+from urllib.parse import urlparse
+
+from places.config import URL_SKIP_LIST
+
+
+def get_hostname(url):
+    """
+    Returns the hostname of a url, or the url itself if it is a domain.
+    """
+    if "://" in url:
+        url = urlparse(url).hostname or ""
+    return url.strip().rstrip(".").lower()
+
+
+def parent_domains(url):
+    """
+    Returns the hostname of a url followed by its parent domains.
+    """
+    labels = get_hostname(url).split(".")
+    return [".".join(labels[i:]) for i in range(len(labels))]
+
+
+def in_domain(url, domain):
+    """
+    Returns True when the url is on the domain or one of its subdomains.
+    """
+    hostname = get_hostname(url)
+    domain = get_hostname(domain)
+    return hostname == domain or hostname.endswith("." + domain)
+
+
+class DomainPolicy:
+    def __init__(self, skipped=()):
+        # domain -> True when skipped, False when explicitly allowed
+        self._states = {}
+        for domain in skipped:
+            self.set_skip(domain)
+
+    def __len__(self):
+        return len(self._states)
+
+    def set_skip(self, url, skip=True):
+        domain = get_hostname(url)
+        if domain:
+            self._states[domain] = skip
+
+    def load(self, states):
+        """
+        Sets the states of (domain, skip) pairs.
+        """
+        for domain, skip in states:
+            self.set_skip(domain, bool(skip))
+
+    def is_skipped(self, url):
+        # from the full hostname up to its top-level domain
+        for domain in parent_domains(url):
+            state = self._states.get(domain)
+            if state is not None:
+                return state
+        return False
+
+    def skipped(self):
+        return sorted(domain for domain, skip in self._states.items() if skip)
+
+
+domain_policy = DomainPolicy(URL_SKIP_LIST)
@@ -0,0 +1,71 @@
+"""
+Removal of the indexed content of a domain.
+
+Blocking a domain removes its pages from the vector backend, the pages
+db, the sentence hashes and the domain counters. Large domains can have thousands of pages,
+so the removal runs in the background, a batch of urls at a time, and
+reports its progress.
+"""
+import asyncio
+import time
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class PurgeJob:
+    def __init__(self, domain, client, pages_db, db, hashes=None, batch_size=50):
+        self.domain = domain
+        self.client = client
+        self.pages_db = pages_db
+        self.db = db
+        # the SentenceHashes owned by the urls, if any
+        self.hashes = hashes
+        self.batch_size = batch_size
+        self.state = PENDING
+        self.total = 0
+        self.removed = 0
+        self.error = None
+        self.start = None
+        self.end = None
+
+    async def run(self):
+        self.state = RUNNING
+        self.start = time.time()
+        try:
+            urls = await self.client.domain_urls(self.domain)
+            self.total = len(urls)
+            print(f"[purge] removing {self.total} pages of {self.domain}")
+            for i in range(0, len(urls), self.batch_size):
+                batch = urls[i : i + self.batch_size]
+                await self.client.delete_urls(batch)
+                for url in batch:
+                    self.pages_db.remove(url)
+                    if self.hashes is not None:
+                        # other pages can index the sentences of the url
+                        self.hashes.release(url)
+                self.removed += len(batch)
+                print(f"[purge] {self.domain}: {self.removed}/{self.total}")
+                # lets the server answer requests between batches
+                await asyncio.sleep(0)
+            await self.db.reset_indexed(self.domain)
+            self.state = DONE
+        except Exception as e:
+            print(f"[purge] failed on {self.domain}: {e!r}")
+            self.error = repr(e)
+            self.state = FAILED
+        finally:
+            self.end = time.time()
+
+    def stats(self):
+        return {
+            "domain": self.domain,
+            "state": self.state,
+            "total": self.total,
+            "removed": self.removed,
+            "error": self.error,
+            "start": self.start,
+            "end": self.end,
+        }
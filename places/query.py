@@ -1,28 +1,42 @@
+import asyncio
 import sys
 
-import numpy
-from sentence_transformers import SentenceTransformer
-
 from places.backends import get_db
-
-model = SentenceTransformer("all-MiniLM-L6-v2")
-client = get_db(db="qdrant")
-
-
-def query(sentence):
-    embedding = model.encode([sentence])
-    vector = numpy.asfarray(embedding[0])
-    vector = list(vector)
-
-    hits = client.search(query_vector=vector, limit=3)
-
-    for i, hit in enumerate(hits):
-        print(f"{i}. {hit.payload['url']}")
-        print()
-        print(hit.payload["sentence"])
-        print()
-        print()
+from places.cache import QueryCache
+from places.filters import FILTERS, search_filters
+from places.vectors import MODEL, embed
+
+
+async def _encode(sentences):
+    return embed(sentences)
+
+
+async def query(sentence, args):
+    filters = search_filters(**{name: args.pop(name, None) for name in FILTERS})
+    client = get_db(**args)
+    cache = QueryCache(
+        _encode,
+        max_size=args.get("query_cache_size", 1024),
+        path=args.get("query_cache"),
+        model=MODEL,
+    )
+    try:
+        vector = await cache.get(sentence)
+    finally:
+        cache.close()
+
+    try:
+        i = 0
+        async for hit in client.search(query_vector=vector, limit=3, filters=filters):
+            print(f"{i}. {hit['url']}")
+            print()
+            print(hit["sentence"])
+            print()
+            print()
+            i += 1
+    finally:
+        await client.close()
 
 
 if __name__ == "__main__":
-    query(sys.argv[-1])
+    asyncio.run(query(sys.argv[-1], {"db": "qdrant"}))
@@ -0,0 +1,249 @@
+"""
+Host-aware fetch scheduler.
+
+Urls are queued per host, and hosts are served in turn, so a history
+dominated by a few domains does not keep the others waiting. Each host
+gets at most `per_host` requests at once, started `delay` seconds
+apart, and backs off when it answers 429 or 503.
+
+The global concurrency adapts to the fetches: it grows by one while
+they are fast and successful, and shrinks by a quarter when latency or
+overload errors go up.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+import aiohttp
+
+_EWMA = 0.2
+_MAX_BACKOFF = 64
+
+
+def is_overload(error):
+    """
+    Returns True for errors that mean the host is overloaded:
+        timeouts, connection errors, 429 and 5xx responses.
+    Other errors, like invalid urls or undecodable pages, are the
+        page's own.
+    """
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+        return True
+    status = getattr(error, "status", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.first = None
+        self.last = None
+
+    def record(self, start, latency, error):
+        self.requests += 1
+        self.errors += int(error is not None)
+        self.latency += latency
+        self.first = start if self.first is None else self.first
+        self.last = start + latency
+
+    def as_dict(self):
+        elapsed = (self.last - self.first) if self.requests > 1 else 0
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_latency": self.latency / max(self.requests, 1),
+            "rate": self.requests / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class _Host:
+    def __init__(self):
+        self.jobs = deque()
+        self.active = 0
+        self.next_start = 0.0
+        self.backoff = 1
+        self.stats = HostStats()
+
+
+class HostScheduler:
+    """
+    Runs jobs, coroutine functions fetching a url, with per-host limits.
+
+    `callback(url, result, error)` is called when a job is done, with
+    the exception it raised, if any.
+
+    `put` waits once `max_pending` jobs are queued. Queued jobs are
+    small, and the bound is high, so a long run of urls of one host does
+    not keep the reader from queuing the urls of the others.
+    """
+
+    def __init__(
+        self,
+        per_host=2,
+        delay=0.5,
+        min_concurrency=4,
+        max_concurrency=64,
+        concurrency=16,
+        target_latency=2.0,
+        max_error_rate=0.2,
+        max_pending=100_000,
+    ):
+        self.per_host = per_host
+        self.delay = delay
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = concurrency
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.max_pending = max_pending
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self._since_change = 0
+        self._hosts = {}
+        # hosts with queued jobs, in the order they are served
+        self._waiting = OrderedDict()
+        self._pending = 0
+        self._active = 0
+        self._tasks = set()
+        self._wake = asyncio.Event()
+        self._room = asyncio.Event()
+        self._dispatcher = None
+
+    async def put(self, url, job, callback):
+        """
+        Queues a job, waiting while `max_pending` jobs are queued.
+        """
+        while self._pending >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        name = urlparse(url).hostname or ""
+        host = self._hosts.setdefault(name, _Host())
+        host.jobs.append((url, job, callback))
+        self._waiting.setdefault(name, None)
+        self._pending += 1
+        self._wake.set()
+
+    async def join(self):
+        """
+        Waits for all the queued jobs.
+        """
+        while self._pending or self._tasks:
+            if self._tasks:
+                await asyncio.wait(list(self._tasks))
+            else:
+                await asyncio.sleep(0.05)
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def _start_ready(self):
+        """
+        Starts the jobs of the hosts that can take one, and returns the
+        time until the next host delay expires, if any.
+        """
+        wait = None
+        started = True
+        while started and self._active < self.concurrency:
+            started = False
+            now = time.monotonic()
+            for name in list(self._waiting):
+                if self._active >= self.concurrency:
+                    break
+                host = self._hosts[name]
+                if host.active >= self.per_host:
+                    continue
+                if host.next_start > now:
+                    delay = host.next_start - now
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                job = host.jobs.popleft()
+                if host.jobs:
+                    self._waiting.move_to_end(name)
+                else:
+                    del self._waiting[name]
+                host.active += 1
+                host.next_start = now + self.delay * host.backoff
+                self._active += 1
+                self._pending -= 1
+                self._room.set()
+                task = asyncio.create_task(self._run(host, *job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                started = True
+        return wait
+
+    async def _dispatch(self):
+        while True:
+            self._wake.clear()
+            wait = self._start_ready()
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, host, url, job, callback):
+        start = time.monotonic()
+        result = error = None
+        try:
+            result = await job()
+        except Exception as e:
+            error = e
+        finally:
+            latency = time.monotonic() - start
+            host.active -= 1
+            self._active -= 1
+            host.stats.record(start, latency, error)
+            self._adapt(host, latency, error)
+            self._wake.set()
+        callback(url, result, error)
+
+    def _adapt(self, host, latency, error):
+        overloaded = error is not None and is_overload(error)
+        if overloaded:
+            host.backoff = min(_MAX_BACKOFF, host.backoff * 2)
+            retry_after = _retry_after(error)
+            if retry_after is not None:
+                host.next_start = max(host.next_start, time.monotonic() + retry_after)
+        else:
+            host.backoff = max(1, host.backoff // 2)
+
+        self.latency += _EWMA * (latency - self.latency)
+        self.error_rate += _EWMA * (overloaded - self.error_rate)
+        self._since_change += 1
+        # waits for a full round of fetches at the current concurrency
+        if self._since_change < self.concurrency:
+            return
+        if self.error_rate > self.max_error_rate or self.latency > self.target_latency:
+            self.concurrency = max(self.min_concurrency, self.concurrency * 3 // 4)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        self._since_change = 0
+
+    def stats(self):
+        return {name: host.stats.as_dict() for name, host in self._hosts.items()}
+
+    def report(self, top=10):
+        hosts = sorted(
+            self.stats().items(), key=lambda item: item[1]["requests"], reverse=True
+        )
+        print(f"[scrap] concurrency {self.concurrency}, {len(hosts)} hosts")
+        for name, stats in hosts[:top]:
+            print(
+                f"[scrap] {name}: {stats['requests']} requests, "
+                f"{stats['errors']} errors, {stats['avg_latency']:.2f}s avg, "
+                f"{stats['rate']:.2f}/s"
+            )
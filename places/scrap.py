@@ -1,65 +1,155 @@
+import codecs
 import functools
 
 import aiohttp
 
-from places.utils import task_pool
+from places.db import PAGES_DIR, Pages, content_hash
+from places.extract import CHUNK_SIZE
+from places.index.state import EMBEDDED, FETCHED, INDEXED, SKIPPED, IndexState
+from places.scheduler import HostScheduler
 
 supported = [
     "text/html",
 ]
 
+# the end of bigger pages is not downloaded
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+
+
+async def read_html(resp, max_bytes=MAX_PAGE_BYTES):
+    """
+    Reads and decodes the body of a response in chunks, up to `max_bytes`.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(resp.charset or "utf-8")("replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    parts = []
+    size = 0
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        chunk = chunk[: max_bytes - size]
+        size += len(chunk)
+        parts.append(decoder.decode(chunk))
+        if size >= max_bytes:
+            break
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
 
 class WebScrap:
-    def __init__(self, urls, pages, source="firefox", cache=None):
+    def __init__(
+        self,
+        urls,
+        pages,
+        source="firefox",
+        state=None,
+        scheduler=None,
+        max_bytes=MAX_PAGE_BYTES,
+    ):
         self.urls = urls
         self.pages = pages
         self.source = source
-        self.cache = cache or {}
-        self._tasks = []
+        self.state = state or IndexState()
+        self.scheduler = scheduler or HostScheduler()
+        self.max_bytes = max_bytes
+        # fetched pages are written in batches
+        self.pages_db = Pages(PAGES_DIR, batch_size=64)
 
-    async def get_url(self, client, url):
-        # print(f"[scrap] reading {url}")
+    def _stored_page(self, url):
         try:
-            async with client.head(url) as resp:
-                ct = resp.content_type
+            return self.pages_db.get(url)
+        except KeyError:
+            return {}
 
-            if ct not in supported:
-                return None
+    def _changed(self, url, page, html):
+        """
+        Returns the page to index, or None when it was indexed as is.
+        """
+        if page.get("hash") == content_hash(html):
+            self.state.set(url, INDEXED)
+            return None
+        self.state.set(url, FETCHED)
+        return url, html
+
+    async def fetch(self, client, url):
+        """
+        Returns the (url, html) page to index, or None.
+        Raises on errors.
+        """
+        page = self._stored_page(url)
+        if self.state.state(url) in (FETCHED, EMBEDDED) and "html" in page:
+            # fetched by an interrupted run
+            return url, page["html"]
+
+        # validators of the stored page
+        headers = {}
+        if "html" in page:
+            if page.get("etag"):
+                headers["If-None-Match"] = page["etag"]
+            if page.get("last_modified"):
+                headers["If-Modified-Since"] = page["last_modified"]
 
-            async with client.get(url) as resp:
-                for history in resp.history:
-                    if history.status > 399:
-                        return None
-
-                text = await resp.text()
-                self.cache[url] = "processed"
-                return url, text
-        except Exception as e:
-            print(f"[scrap] Could not read {url} {e}")
-            if self.source == "sessionbuddy":
-                title = self.cache.get(url)
-                self.cache[url] = "unreadable"
-                return url, title
-            else:
-                self.cache[url] = "error"
+        async with client.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return self._changed(url, page, page["html"])
+
+            for history in resp.history:
+                if history.status > 399:
+                    raise aiohttp.ClientResponseError(
+                        history.request_info, (), status=history.status
+                    )
+            resp.raise_for_status()
+
+            # the body of other documents is not downloaded
+            if resp.content_type not in supported:
+                self.state.set(url, SKIPPED)
                 return None
 
-    def url_fetched(self, result):
+            text = await read_html(resp, self.max_bytes)
+            self.pages_db.set(
+                url,
+                {
+                    "html": text,
+                    "etag": resp.headers.get("ETag"),
+                    "last_modified": resp.headers.get("Last-Modified"),
+                },
+            )
+            return self._changed(url, page, text)
+
+    def _failed(self, url, error):
+        print(f"[scrap] Could not read {url} {error}")
+        entry = self.state.failed(url, error)
+        if self.source == "sessionbuddy":
+            return url, entry.get("title")
+        return None
+
+    def url_fetched(self, url, result, error):
+        if error is not None:
+            result = self._failed(url, error)
         if result is None:
             return
         self.pages.put_nowait(result)
 
     async def run(self):
-        async with task_pool() as tasks:
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=15)
-            ) as client:
-                while True:
-                    url = await self.urls.get()
-                    if url == "END":
-                        await self.pages.put("END")
-                        return
-
-                    await tasks.put(
-                        functools.partial(self.get_url, client, url), self.url_fetched
-                    )
+        scheduler = self.scheduler
+        # resolved hosts and idle connections are reused across urls
+        connector = aiohttp.TCPConnector(
+            limit=scheduler.max_concurrency,
+            limit_per_host=scheduler.per_host,
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+        )
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=15)
+        ) as client:
+            while True:
+                url = await self.urls.get()
+                if url == "END":
+                    break
+                await scheduler.put(
+                    url, functools.partial(self.fetch, client, url), self.url_fetched
+                )
+            await scheduler.join()
+        self.pages_db.close()
+        scheduler.report()
+        await self.pages.put("END")
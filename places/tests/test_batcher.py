@@ -0,0 +1,33 @@
+import asyncio
+
+import numpy as np
+
+from places.batcher import EmbeddingBatcher
+
+
+def test_batcher():
+    batches = []
+
+    async def encode(sentences):
+        batches.append(sentences)
+        return np.array([[len(s), 0] for s in sentences], dtype=np.float32)
+
+    async def _run():
+        batcher = EmbeddingBatcher(encode, max_batch_size=4, max_wait=0.05)
+        batcher.start()
+        try:
+            return await asyncio.gather(
+                batcher.embed(["aaa", "b", "cc"]),
+                batcher.embed(["dddd", "eeeee"]),
+                batcher.embed([]),
+            )
+        finally:
+            await batcher.stop()
+
+    first, second, empty = asyncio.run(_run())
+
+    # pages share batches of sentences sorted by length
+    assert batches == [["b", "cc", "aaa", "dddd"], ["eeeee"]]
+    assert first[:, 0].tolist() == [3, 1, 2]
+    assert second[:, 0].tolist() == [4, 5]
+    assert len(empty) == 0
@@ -0,0 +1,56 @@
+import asyncio
+
+from places.index.bulk import BulkIndexer
+
+
+def test_stages():
+    async def _run():
+        indexer = BulkIndexer(None, {})
+        pages, doubled, seen = asyncio.Queue(), asyncio.Queue(2), []
+        for i in range(20):
+            pages.put_nowait((i, None))
+        pages.put_nowait("END")
+
+        async def double(item):
+            if item[0] == 7:
+                raise ValueError("boom")
+            return (item[0] * 2,)
+
+        async def collect(item):
+            seen.append(item[0])
+
+        await asyncio.gather(
+            indexer._stage(pages, doubled, 3, double),
+            indexer._stage(doubled, None, 2, collect),
+        )
+        return indexer, seen
+
+    indexer, seen = asyncio.run(_run())
+    assert sorted(seen) == [i * 2 for i in range(20) if i != 7]
+    assert indexer.stats.failed == 1
+
+
+def test_chunked_stage():
+    async def _run():
+        indexer = BulkIndexer(None, {})
+        pages, seen, chunks = asyncio.Queue(), [], []
+        for i in range(10):
+            pages.put_nowait((i, None))
+        pages.put_nowait("END")
+
+        async def process(items):
+            chunks.append(len(items))
+            return [ValueError("boom") if i == 3 else (i,) for i, _ in items]
+
+        async def collect(item):
+            seen.append(item[0])
+
+        sink = asyncio.Queue()
+        await indexer._stage(pages, sink, 1, process, chunk_size=4)
+        await indexer._stage(sink, None, 1, collect)
+        return indexer, seen, chunks
+
+    indexer, seen, chunks = asyncio.run(_run())
+    assert chunks == [4, 4, 2]
+    assert seen == [i for i in range(10) if i != 3]
+    assert indexer.stats.failed == 1
@@ -0,0 +1,70 @@
+import asyncio
+
+import numpy as np
+
+from places.cache import QueryCache, ResultCache, normalize_query
+
+
+def test_normalize_query():
+    assert normalize_query("  what is\tpython ?\n") == "what is python ?"
+    assert normalize_query("ｃａｆé") == "café"
+
+
+def test_query_cache(tmp_path):
+    encoded = []
+
+    async def encode(sentences):
+        encoded.extend(sentences)
+        return np.array([[len(s), 1] for s in sentences], dtype=np.float32)
+
+    async def _run(cache, *queries):
+        return await asyncio.gather(*(cache.get(query) for query in queries))
+
+    cache = QueryCache(encode, max_size=2, path=str(tmp_path), model="test")
+    first, second, third = asyncio.run(_run(cache, "python", " python ", "rust"))
+    np.testing.assert_array_equal(first, [6, 1])
+    assert second is first
+    # concurrent identical queries are encoded once
+    assert encoded == ["python", "rust"]
+
+    asyncio.run(_run(cache, "go", "python"))
+    assert encoded == ["python", "rust", "go"]
+    # the oldest entry was evicted from memory, but not from disk
+    assert len(cache) == 2
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.stats()["misses"] == 3
+    cache.close()
+
+    # another process shares the persisted embeddings
+    cache = QueryCache(encode, path=str(tmp_path), model="test")
+    asyncio.run(_run(cache, "rust"))
+    assert cache.stats()["disk_hits"] == 1
+    assert len(encoded) == 3
+    cache.close()
+
+
+def test_result_cache():
+    cache = ResultCache(max_size=2)
+    assert cache.get(0, "a") is None
+    cache.set(0, "a", ["hit"])
+    assert cache.get(0, "a") == ["hit"]
+
+    # new content invalidates every result
+    assert cache.get(1, "a") is None
+    # a search started before the update is not cached
+    cache.set(0, "a", ["stale"])
+    assert cache.get(1, "a") is None
+
+    for key in "abc":
+        cache.set(1, key, [key])
+    assert len(cache) == 2
+    assert cache.get(1, "a") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_result_cache_ttl():
+    cache = ResultCache(ttl=0)
+    cache.set(0, "a", ["hit"])
+    # content written by another process does not bump the generation
+    assert cache.get(0, "a") is None
+    assert len(cache) == 0
@@ -0,0 +1,69 @@
+from diskcache import Cache
+
+from places.chunking import SentenceHashes, chunk_sentences, sentence_key
+
+
+def test_chunk_sentences():
+    sentences = [
+        "Home",
+        "About",
+        "»",
+        "This sentence is long enough to be embedded alone.",
+        "1.",
+        "Short one.",
+    ]
+    assert list(chunk_sentences(sentences)) == [
+        "Home About This sentence is long enough to be embedded alone.",
+        "Short one.",
+    ]
+    assert list(chunk_sentences(["a b c d"] * 3, min_words=10, max_words=8)) == [
+        "a b c d a b c d",
+        "a b c d",
+    ]
+
+
+def test_dedup():
+    assert sentence_key("© 2022 Corp.") == sentence_key("© 2023 CORP")
+    assert sentence_key("Accept cookies") != sentence_key("Refuse cookies")
+
+    hashes = SentenceHashes()
+    page = ["Accept cookies", "Some text", "Some text!"]
+    assert hashes.dedup("a", page) == ["Accept cookies", "Some text"]
+    assert hashes.dedup("b", ["Accept all cookies.", "accept cookies"]) == [
+        "Accept all cookies."
+    ]
+    # re-indexing a page keeps its sentences
+    assert hashes.dedup("a", page) == ["Accept cookies", "Some text"]
+
+    hashes.release("a", page)
+    assert hashes.dedup("b", ["Accept cookies"]) == ["Accept cookies"]
+
+
+def test_reindex_releases_sentences():
+    hashes = SentenceHashes()
+    assert hashes.dedup("a", ["Shared sentence", "Only on a"]) == [
+        "Shared sentence",
+        "Only on a",
+    ]
+    assert hashes.dedup("b", ["Shared sentence", "Only on b"]) == ["Only on b"]
+
+    # a lost the sentence when it was indexed again
+    assert hashes.dedup("a", ["Only on a"]) == ["Only on a"]
+    assert hashes.dedup("b", ["Shared sentence", "Only on b"]) == [
+        "Shared sentence",
+        "Only on b",
+    ]
+
+    # removed urls release all their sentences
+    hashes.release("a")
+    assert hashes.dedup("c", ["Only on a"]) == ["Only on a"]
+
+
+def test_concurrent_claims(tmp_path):
+    cache = Cache(str(tmp_path))
+    first, second = SentenceHashes(cache), SentenceHashes(cache)
+    # another process claimed the footer between the two reads
+    cache.add(sentence_key("Footer"), "b")
+    assert first.dedup("a", ["Footer", "Text of a"]) == ["Text of a"]
+    assert second.dedup("b", ["Footer"]) == ["Footer"]
+    cache.close()
@@ -0,0 +1,60 @@
+import asyncio
+
+from places.db import DB
+from places.policy import DomainPolicy
+
+
+def test_domains(tmp_path):
+    async def _run():
+        db = DB(str(tmp_path / "db.sqlite"), flush_delay=60, policy=DomainPolicy())
+        await db.check_db()
+        assert await db.get_skip("https://www.google.com/search")
+        await db.set_skip("http://skipped.com/page")
+        assert await db.get_skip("http://www.skipped.com")
+        assert (await db.domain_info("sub.skipped.com"))["skip"]
+        await db.set_skip("skipped.com", False)
+        assert not await db.get_skip("skipped.com")
+        await db.set_skip("other.com")
+
+        for _ in range(3):
+            await db.indexed("http://example.com/page")
+        # the counters are not written yet, but are counted
+        info = await db.domain_info("http://example.com")
+        assert info == {"domain": "example.com", "skip": False, "indexed_pages": 3}
+
+        domains = [domain async for domain in db.get_indexed_domains()]
+        assert domains == [info]
+        await db.indexed("http://example.com/other")
+        await db.close()
+
+        # the skipped domains are loaded from the db
+        policy = DomainPolicy()
+        db = DB(str(tmp_path / "db.sqlite"), policy=policy)
+        await db.check_db()
+        assert policy.is_skipped("https://www.other.com")
+        info = await db.domain_info("example.com")
+        assert info["indexed_pages"] == 4
+        await db.close()
+
+    asyncio.run(_run())
+
+
+def test_indexed_subdomain_does_not_allow(tmp_path):
+    async def _run():
+        path = str(tmp_path / "db.sqlite")
+        db = DB(path, policy=DomainPolicy())
+        await db.check_db()
+        await db.indexed("https://mail.example.org/a")
+        await db.set_skip("explicit.example.org", False)
+        await db.close()
+
+        # restart, then block the parent domain
+        db = DB(path, policy=DomainPolicy())
+        await db.check_db()
+        await db.set_skip("example.org")
+        assert await db.get_skip("https://mail.example.org/x")
+        assert await db.get_skip("https://www.example.org/x")
+        assert not await db.get_skip("https://explicit.example.org/x")
+        await db.close()
+
+    asyncio.run(_run())
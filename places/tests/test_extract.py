@@ -0,0 +1,61 @@
+from places.extract import TextExtractor, extract_html, iter_blocks
+
+_PAGE = """
+<html>
+  <head>
+    <title>The  title</title>
+    <style>body { color: red; }</style>
+    <script>var text = "not text";</script>
+  </head>
+  <body>
+    <nav><ul><li>Home</li><li>About</li></ul></nav>
+    <div role="navigation"><div>Menu</div></div>
+    <main>
+      <h1>Heading</h1>
+      <p>First paragraph,<br>on two lines.</p>
+      <p>Second &amp; last paragraph.</p>
+    </main>
+    <footer>Copyright</footer>
+  </body>
+</html>
+"""
+
+
+def test_extract_html():
+    title, text = extract_html(_PAGE, chunk_size=16)
+    assert title == "The title"
+    assert text.split("\n") == [
+        "The title",
+        "Heading",
+        "First paragraph,",
+        "on two lines.",
+        "Second & last paragraph.",
+    ]
+
+
+def test_blocks_are_streamed():
+    extractor = TextExtractor(use_lxml=False)
+    assert extractor.feed("<p>one</p><p>tw") == ["one"]
+    assert extractor.feed("o</p>three") == ["two"]
+    assert extractor.close() == ["three"]
+    assert list(iter_blocks(["<div>a", "b</div>"])) == ["ab"]
+
+
+def test_page_level_form():
+    html = (
+        "<html><head><title>T</title></head><body>"
+        '<form id="form1"><div><h1>Main article</h1><p>Body text.</p></div>'
+        '<div role="search"><input name="q"> Search</div></form></body></html>'
+    )
+    assert extract_html(html) == ("T", "T\nMain article\nBody text.")
+
+
+def test_article_header():
+    html = (
+        "<body><header>Site name</header>"
+        "<article><header><h1>Post title</h1></header><p>Post.</p>"
+        "<footer>Posted in news</footer></article>"
+        "<footer>Copyright</footer></body>"
+    )
+    _, text = extract_html(html)
+    assert text.split("\n") == ["Post title", "Post.", "Posted in news"]
@@ -0,0 +1,24 @@
+import pytest
+
+from places.filters import parse_date, search_filters
+
+
+def test_parse_date():
+    assert parse_date("1700000000") == 1700000000.0
+    assert parse_date("1970-01-02") == 86400.0
+    assert parse_date("1970-01-01T01:00:00+01:00") == 0.0
+    with pytest.raises(ValueError):
+        parse_date("yesterday")
+
+
+def test_search_filters():
+    assert search_filters() == {}
+    assert search_filters(domain="", lang=None) == {}
+    assert search_filters(domain="https://Example.com/page", lang=" French") == {
+        "domain": "example.com",
+        "lang": "french",
+    }
+    assert search_filters(after="1970-01-02", before="86401") == {
+        "after": 86400.0,
+        "before": 86401.0,
+    }
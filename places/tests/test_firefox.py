@@ -0,0 +1,79 @@
+import asyncio
+import sqlite3
+
+from places.index.firefox import Places
+from places.index.state import INDEXED, IndexState
+
+
+def _create_places(path, rows):
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS moz_places "
+        "(id INTEGER PRIMARY KEY, url TEXT, last_visit_date INTEGER)"
+    )
+    con.executemany("INSERT OR REPLACE INTO moz_places VALUES (?, ?, ?)", rows)
+    con.commit()
+    con.close()
+
+
+def _read(places):
+    async def _run():
+        queue = asyncio.Queue()
+        places.queue = queue
+        await places.run()
+        urls = []
+        while (url := queue.get_nowait()) != "END":
+            urls.append(url)
+        return urls
+
+    return asyncio.run(_run())
+
+
+def test_incremental_sync(tmp_path):
+    db = str(tmp_path / "places.sqlite")
+    _create_places(
+        db,
+        [
+            (1, "https://example.com/1", 100),
+            (2, "https://example.com/2", 200),
+            (3, "https://example.com/3", None),
+        ],
+    )
+    state = IndexState()
+    places = Places(None, db=db, state=state, incremental=True)
+
+    assert _read(places) == [f"https://example.com/{i}" for i in (1, 2, 3)]
+    for i in (1, 2, 3):
+        state.set(f"https://example.com/{i}", INDEXED)
+
+    # the mark is only saved once the urls are indexed
+    assert _read(places) == []
+    places.commit()
+    assert state.get_mark(places.mark_key) == {"id": 3, "last_visit_date": 200}
+
+    # a new page, and a revisited one
+    _create_places(
+        db, [(4, "https://example.com/4", 300), (1, "https://example.org/1", 400)]
+    )
+    assert _read(places) == ["https://example.org/1", "https://example.com/4"]
+
+
+def test_incremental_retry(tmp_path):
+    db = str(tmp_path / "places.sqlite")
+    _create_places(
+        db, [(1, "https://example.com/1", 100), (2, "https://example.com/2", 200)]
+    )
+    state = IndexState(backoff=0)
+    places = Places(None, db=db, state=state, incremental=True)
+
+    assert _read(places) == ["https://example.com/1", "https://example.com/2"]
+    state.failed("https://example.com/1", OSError())
+    state.set("https://example.com/2", INDEXED)
+    places.commit()
+    assert state.get_mark(places.mark_key) == {"id": 0, "last_visit_date": 200}
+
+    # the failed url is read again once its backoff is over
+    assert _read(places) == ["https://example.com/1"]
+    state.set("https://example.com/1", INDEXED)
+    places.commit()
+    assert state.get_mark(places.mark_key) == {"id": 2, "last_visit_date": 200}
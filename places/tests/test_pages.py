@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+from places.db import Pages, migrate_pages
+
+
+def test_pages(tmp_path):
+    pages = Pages(str(tmp_path), batch_size=2)
+    with pytest.raises(KeyError):
+        pages.get("http://a")
+
+    pages.set("http://a", {"html": "<p>été</p>", "etag": '"v1"'})
+    # pending writes are visible
+    assert pages.get("http://a")["html"] == "<p>été</p>"
+    pages.set("http://a", {"text": "été", "hash": "h"})
+
+    # another process only writes the text
+    other = Pages(str(tmp_path))
+    other.set("http://a", {"text": "summer"})
+
+    page = pages.get("http://a")
+    assert page["html"] == "<p>été</p>"
+    assert page["text"] == "summer"
+    assert page["etag"] == '"v1"' and page["hash"] == "h"
+    assert "html" not in pages.get("http://a", html=False, text=False)
+
+    pages.remove("http://a")
+    with pytest.raises(KeyError):
+        other.get("http://a")
+    pages.close()
+    other.close()
+
+
+def test_migrate_pages(tmp_path):
+    source = tmp_path / "legacy"
+    source.mkdir()
+    for url in ("http://a", "http://b"):
+        name = hashlib.md5(url.encode("utf8")).hexdigest()
+        with open(source / name, "w") as f:
+            f.write(json.dumps({"url": url, "ts": 1.0, "html": url, "hash": "h"}))
+
+    pages = Pages(str(tmp_path / "store"))
+    assert migrate_pages(str(source), pages, delete=True) == 2
+    assert len(pages) == 2
+    assert pages.get("http://b") == {
+        "url": "http://b",
+        "ts": 1.0,
+        "html": "http://b",
+        "hash": "h",
+    }
+    assert os.listdir(source) == []
+
+
+def test_delayed_flush(tmp_path):
+    pages = Pages(str(tmp_path), batch_size=100, max_delay=0.05)
+    pages.set("http://a", {"hash": "h"})
+    time.sleep(0.3)
+    # written by the timer, without another set
+    other = Pages(str(tmp_path))
+    assert other.get("http://a")["hash"] == "h"
+    other.close()
+    pages.close()
@@ -0,0 +1,21 @@
+from places.policy import DomainPolicy
+
+
+def test_domain_policy():
+    policy = DomainPolicy(["google.com", "dartsearch", ""])
+    assert policy.is_skipped("https://google.com/search?q=places")
+    assert policy.is_skipped("https://mail.Google.com./inbox")
+    assert policy.is_skipped("dartsearch")
+    assert not policy.is_skipped("https://notgoogle.com")
+    assert not policy.is_skipped("https://example.com")
+
+    # the most specific domain wins
+    policy.set_skip("https://docs.google.com/document", False)
+    assert not policy.is_skipped("https://docs.google.com/x")
+    assert not policy.is_skipped("https://a.docs.google.com/x")
+    assert policy.is_skipped("https://mail.google.com")
+
+    policy.load([("example.com", 1), ("google.com", 0)])
+    assert policy.is_skipped("https://www.example.com")
+    assert not policy.is_skipped("https://mail.google.com")
+    assert policy.skipped() == ["dartsearch", "example.com"]
@@ -0,0 +1,47 @@
+import asyncio
+
+import numpy as np
+
+from places.backends._vectra import LocalDB
+from places.chunking import SentenceHashes
+from places.db import DB, Pages
+from places.policy import DomainPolicy
+from places.purge import DONE, PurgeJob
+
+
+def test_purge(tmp_path):
+    async def _run():
+        client = LocalDB(vectra_path=str(tmp_path / "index"))
+        await client.init_db()
+        pages = Pages(str(tmp_path / "pages"))
+        db = DB(str(tmp_path / "db.sqlite"), policy=DomainPolicy())
+        await db.check_db()
+
+        hashes = SentenceHashes()
+        urls = [f"http://www.example.com/{i}" for i in range(5)] + ["http://b.com"]
+        for url in urls:
+            hashes.dedup(url, ["Shared sentence"])
+            points = [
+                client.create_point(i, url, "title", np.ones(8) + i, f"sentence {i}")
+                for i in range(2)
+            ]
+            await client.index(points)
+            pages.set(url, {"html": "<p>page</p>"})
+            await db.indexed(url)
+
+        job = PurgeJob("example.com", client, pages, db, hashes, batch_size=2)
+        await job.run()
+        assert job.stats()["state"] == DONE
+        assert (job.total, job.removed) == (5, 5)
+
+        assert (await client.get_db_info())["vectors_count"] == 2
+        assert await client.domain_urls("example.com") == []
+        assert len(pages) == 1
+        assert (await db.domain_info("www.example.com"))["indexed_pages"] == 0
+        assert (await db.domain_info("b.com"))["indexed_pages"] == 1
+        assert hashes.dedup("http://b.com", ["Shared sentence"]) == ["Shared sentence"]
+        pages.close()
+        await db.close()
+        await client.close()
+
+    asyncio.run(_run())
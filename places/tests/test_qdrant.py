@@ -0,0 +1,195 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import PointStruct
+
+from places.backends._qdrant import BatchSizer, QDrantDB
+
+
+@asynccontextmanager
+async def _memory_db(**kw):
+    """
+    Yields a QDrantDB on the in-process implementation of the client.
+    """
+    db = QDrantDB(**kw)
+    await db.client.close()
+    db.client = AsyncQdrantClient(location=":memory:")
+    await db.init_db()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+def test_batch_sizer():
+    sizer = BatchSizer(initial=64, minimum=8, maximum=128, target=0.5)
+    sizer.update(0.1)
+    assert sizer.size == 128
+    sizer.update(0.1)
+    assert sizer.size == 128
+    sizer.update(0.3)
+    assert sizer.size == 128
+    sizer.update(1.0)
+    assert sizer.size == 64
+    for _ in range(10):
+        sizer.update(0.1, failed=True)
+    assert sizer.size == 8
+
+
+def test_index_and_search():
+    async def _run():
+        async with _memory_db(qdrant_concurrency=2) as db:
+            rng = np.random.default_rng(0)
+            vectors = rng.normal(size=(300, 768)).astype(np.float32)
+            points = [
+                db.create_point(
+                    i, f"http://example.com/{i % 10}", "title", vec, f"sentence {i}"
+                )
+                for i, vec in enumerate(vectors)
+            ]
+            db.batch_sizer.size = 32
+            resp = await db.index(points)
+            # batches of whole pages
+            assert len(resp) > 1
+            assert db.generation == 1
+
+            info = await db.get_db_info()
+            assert info["points_count"] == 300
+
+            hits = [hit async for hit in db.search(vectors[42], limit=3)]
+            assert hits[0]["sentence"] == "sentence 42"
+
+    asyncio.run(_run())
+
+
+def test_delete_urls():
+    async def _run():
+        async with _memory_db() as db:
+            rng = np.random.default_rng(0)
+            urls = [
+                "http://example.com/a",
+                "http://www.example.com/b",
+                "http://other.com",
+            ]
+            points = [
+                db.create_point(i, url, "title", rng.normal(size=768), f"sentence {i}")
+                for url in urls
+                for i in range(3)
+            ]
+            await db.index(points)
+
+            assert await db.domain_urls("example.com") == urls[:2]
+            await db.delete_urls(urls[:2])
+            assert db.generation == 2
+            info = await db.get_db_info()
+            assert info["points_count"] == 3
+            assert await db.domain_urls("example.com") == []
+
+    asyncio.run(_run())
+
+
+def test_reindex_shorter_page():
+    async def _run():
+        async with _memory_db() as db:
+            rng = np.random.default_rng(0)
+
+            def points(url, count):
+                return [
+                    db.create_point(i, url, "title", rng.normal(size=768), f"s {i}")
+                    for i in range(count)
+                ]
+
+            await db.index(points("http://a.com", 30) + points("http://b.com", 5))
+            await db.index(points("http://a.com", 10))
+            info = await db.get_db_info()
+            assert info["points_count"] == 15
+
+    asyncio.run(_run())
+
+
+def test_filtered_search():
+    async def _run():
+        async with _memory_db() as db:
+            rng = np.random.default_rng(0)
+            urls = ["http://www.a.com/1", "http://b.a.com/2", "http://c.com/3"]
+            points = [
+                db.create_point(
+                    j,
+                    url,
+                    "title",
+                    rng.normal(size=768),
+                    f"{i}-{j}",
+                    lang="french" if i == 2 else "english",
+                    ts=i,
+                )
+                for i, url in enumerate(urls)
+                for j in range(3)
+            ]
+            await db.index(points)
+            query = rng.normal(size=768)
+
+            async def search(**filters):
+                hits = [hit async for hit in db.search(query, 10, filters=filters)]
+                return {hit["url"] for hit in hits}
+
+            assert await search() == set(urls)
+            assert await search(domain="a.com") == set(urls[:2])
+            assert await search(domain="b.a.com") == {urls[1]}
+            assert await search(lang="french") == {urls[2]}
+            assert await search(lang="english", before=1) == {urls[0]}
+            assert await search(after=1) == set(urls[1:])
+
+    asyncio.run(_run())
+
+
+def test_batches_of_whole_pages():
+    db = QDrantDB()
+    vec = np.zeros(4)
+    points = [
+        db.create_point(i, url, "title", vec, "s")
+        for url, count in (("http://a.com", 3), ("http://b.com", 2), ("http://c", 6))
+        for i in range(count)
+    ]
+    db.batch_sizer.size = 4
+    assert db._cut_batch(points, 0) == 3
+    assert db._cut_batch(points, 3) == 5
+    # bigger pages are not split
+    assert db._cut_batch(points, 5) == 11
+    asyncio.run(db.close())
+
+
+def test_backfill():
+    async def _run():
+        async with _memory_db() as db:
+            rng = np.random.default_rng(0)
+            # points indexed before the filters
+            legacy = [
+                PointStruct(
+                    id=i,
+                    vector=rng.normal(size=768).tolist(),
+                    payload={"url": url, "title": "t", "sentence": "s"},
+                )
+                for i, url in enumerate(["http://www.a.com/1", "http://b.com/2"])
+            ]
+            await db.client.upsert(db._collection_name, points=legacy)
+            new = db.create_point(
+                0, "http://a.com/3", "t", rng.normal(size=768), "s", ts=1
+            )
+            await db.index([new])
+
+            assert await db.domain_urls("a.com") == [
+                "http://a.com/3",
+                "http://www.a.com/1",
+            ]
+            assert await db.backfill() == 2
+            assert await db.backfill() == 0
+            hits = db.search(rng.normal(size=768), 10, filters={"domain": "a.com"})
+            assert {hit["url"] async for hit in hits} == {
+                "http://a.com/3",
+                "http://www.a.com/1",
+            }
+            assert await db.count_unfiltered() == 2
+
+    asyncio.run(_run())
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+
+from places.scheduler import HostScheduler, _Host, is_overload
+
+
+class _Overloaded(Exception):
+    status = 429
+    headers = {"Retry-After": "0.2"}
+
+
+def test_per_host_limits():
+    running = {}
+    peaks = {}
+    starts = {}
+    done = []
+
+    async def fetch(url, host):
+        starts.setdefault(host, []).append(time.monotonic())
+        running[host] = running.get(host, 0) + 1
+        peaks[host] = max(peaks.get(host, 0), running[host])
+        await asyncio.sleep(0.01)
+        running[host] -= 1
+        return url
+
+    def callback(url, result, error):
+        done.append(result)
+
+    async def _run():
+        scheduler = HostScheduler(per_host=2, delay=0.02, concurrency=8)
+        for i in range(6):
+            url = f"http://busy.com/{i}"
+            await scheduler.put(url, lambda url=url: fetch(url, "busy"), callback)
+        url = "http://idle.com/"
+        await scheduler.put(url, lambda: fetch(url, "idle"), callback)
+        await scheduler.join()
+        return scheduler
+
+    scheduler = asyncio.run(_run())
+    assert len(done) == 7
+    assert peaks["busy"] <= 2
+    # the other host does not wait behind the busy one
+    assert starts["idle"][0] - starts["busy"][0] < 0.02
+    gaps = np.diff(starts["busy"])
+    assert min(gaps) >= 0.015
+    assert scheduler.stats()["busy.com"]["requests"] == 6
+
+
+def test_overload_backoff():
+    errors = []
+    attempts = []
+
+    async def fetch():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise _Overloaded()
+        return "ok"
+
+    def callback(url, result, error):
+        errors.append(error)
+
+    async def _run():
+        scheduler = HostScheduler(per_host=1, delay=0, concurrency=4)
+        await scheduler.put("http://example.com/1", fetch, callback)
+        await scheduler.put("http://example.com/2", fetch, callback)
+        await scheduler.join()
+        return scheduler
+
+    scheduler = asyncio.run(_run())
+    assert isinstance(errors[0], _Overloaded)
+    assert errors[1] is None
+    # the second fetch waited for the Retry-After delay
+    assert attempts[1] - attempts[0] >= 0.15
+    assert scheduler.stats()["example.com"]["errors"] == 1
+
+
+def test_adaptive_concurrency():
+    scheduler = HostScheduler(concurrency=8, min_concurrency=2, target_latency=1.0)
+    host = _Host()
+    for _ in range(8):
+        scheduler._adapt(host, 0.1, None)
+    assert scheduler.concurrency == 9
+    for _ in range(40):
+        scheduler._adapt(host, 0.1, _Overloaded())
+    assert scheduler.concurrency < 8
+
+
+def test_is_overload():
+    assert is_overload(_Overloaded())
+    assert is_overload(asyncio.TimeoutError())
+    assert is_overload(aiohttp.ServerDisconnectedError())
+    assert not is_overload(UnicodeDecodeError("utf-8", b"", 0, 1, "invalid"))
+    assert not is_overload(aiohttp.InvalidURL("x"))
+    assert not is_overload(ValueError("parser error"))
@@ -0,0 +1,106 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from places.db import Pages, content_hash
+from places.index.state import FAILED, FETCHED, INDEXED, SKIPPED, IndexState
+from places.scrap import WebScrap, read_html
+
+_PAGE = "<html><body>Some text</body></html>"
+
+
+def test_conditional_get(tmp_path):
+    requests = []
+
+    async def handler(request):
+        requests.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(
+            text=_PAGE, content_type="text/html", headers={"ETag": '"v1"'}
+        )
+
+    async def _run():
+        app = web.Application()
+        app.router.add_get("/", handler)
+        async with TestServer(app) as server:
+            url = str(server.make_url("/"))
+            state = IndexState()
+            scrap = WebScrap(None, None, state=state)
+            scrap.pages_db = Pages(str(tmp_path))
+            async with aiohttp.ClientSession() as client:
+                assert await scrap.fetch(client, url) == (url, _PAGE)
+                assert state.state(url) == FETCHED
+
+                # not indexed yet, so the stored page is used on a 304
+                state.set(url, INDEXED)
+                assert await scrap.fetch(client, url) == (url, _PAGE)
+                assert requests[-1]["If-None-Match"] == '"v1"'
+
+                # once indexed, the page is not read again
+                state.set(url, INDEXED)
+                scrap.pages_db.set(url, {"hash": content_hash(_PAGE)})
+                assert await scrap.fetch(client, url) is None
+                assert state.state(url) == INDEXED
+
+    asyncio.run(_run())
+
+
+def test_fetch(tmp_path):
+    async def page(request):
+        return web.Response(text="x" * 1000, content_type="text/html")
+
+    async def pdf(request):
+        return web.Response(body=b"%PDF", content_type="application/pdf")
+
+    async def _run():
+        app = web.Application()
+        app.router.add_get("/page", page)
+        app.router.add_get("/pdf", pdf)
+        async with TestServer(app) as server:
+            state = IndexState()
+            pages = asyncio.Queue()
+            scrap = WebScrap(None, pages, state=state, max_bytes=100)
+            scrap.pages_db = Pages(str(tmp_path))
+            async with aiohttp.ClientSession() as client:
+                url = str(server.make_url("/page"))
+                scrap.url_fetched(url, await scrap.fetch(client, url), None)
+                assert pages.get_nowait() == (url, "x" * 100)
+
+                # the body of other documents is not read
+                url = str(server.make_url("/pdf"))
+                scrap.url_fetched(url, await scrap.fetch(client, url), None)
+                assert state.state(url) == SKIPPED
+
+                url = str(server.make_url("/missing"))
+                with pytest.raises(aiohttp.ClientResponseError) as error:
+                    await scrap.fetch(client, url)
+                scrap.url_fetched(url, None, error.value)
+                assert state.state(url) == FAILED
+            assert pages.empty()
+            scrap.pages_db.close()
+
+    asyncio.run(_run())
+
+
+def test_read_html_cutoff():
+    body = "é" * 10000
+
+    async def handler(request):
+        return web.Response(text=body, content_type="text/html")
+
+    async def _run():
+        app = web.Application()
+        app.router.add_get("/", handler)
+        async with TestServer(app) as server:
+            async with aiohttp.ClientSession() as client:
+                async with client.get(server.make_url("/")) as resp:
+                    assert await read_html(resp) == body
+                async with client.get(server.make_url("/")) as resp:
+                    # the last character is cut in half
+                    assert await read_html(resp, max_bytes=101) == "é" * 50 + "\ufffd"
+
+    asyncio.run(_run())
@@ -0,0 +1,69 @@
+from diskcache import Cache
+
+from places.index.state import (
+    EMBEDDED,
+    FAILED,
+    FETCHED,
+    INDEXED,
+    QUEUED,
+    IndexState,
+)
+
+
+def test_transitions(tmp_path):
+    cache = Cache(str(tmp_path))
+    state = IndexState(cache)
+    url = "http://example.com"
+
+    assert state.pending(url)
+    state.queue(url)
+    state.set(url, FETCHED)
+    # queuing again does not lose the fetched page
+    state.queue(url)
+    assert state.state(url) == FETCHED
+
+    state.checkpoint(url, {"vectors": [1, 2]})
+    cache.close()
+
+    # a new run resumes from the checkpoint
+    cache = Cache(str(tmp_path))
+    state = IndexState(cache)
+    assert state.state(url) == EMBEDDED
+    assert state.pending(url)
+    assert state.restore(url) == {"vectors": [1, 2]}
+
+    state.set(url, INDEXED)
+    assert not state.pending(url)
+    assert state.restore(url) is None
+    assert ("vectors", url) not in cache
+    cache.close()
+
+
+def test_failures():
+    state = IndexState(max_failures=3, backoff=10)
+    url = "http://example.com"
+
+    entry = state.failed(url, ValueError("boom"))
+    assert entry["state"] == FAILED
+    assert not state.pending(url, now=entry["ts"] + 5)
+    assert state.pending(url, now=entry["ts"] + 10)
+
+    # the delay doubles
+    state.queue(url)
+    entry = state.failed(url, ValueError("boom"))
+    assert entry["failures"] == 2
+    assert entry["retry_at"] == entry["ts"] + 20
+
+    state.failed(url, ValueError("boom"))
+    assert not state.pending(url, now=entry["ts"] + 10_000)
+
+
+def test_legacy_values():
+    state = IndexState(
+        {"a": "processing", "b": "processed", "c": "error", "d": "unreadable"}
+    )
+    assert state.state("a") == QUEUED
+    assert state.pending("a")
+    assert not state.pending("b")
+    assert state.state("c") == FAILED
+    assert state.pending("d", now=0)
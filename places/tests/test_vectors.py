@@ -1,4 +1,4 @@
-import json
+import numpy as np
 
 from places.vectors import build_vector
 
@@ -11,10 +11,9 @@ _HTML_PAGE = """\
 
 
 def test_build_vector():
-    data = {"url": "http://example.com", "text": _HTML_PAGE}
+    res = build_vector("http://example.com", _HTML_PAGE)
 
-    res = json.loads(build_vector(json.dumps(data)))
-
-    assert res["sentences"] == ["The title Some text"]
-    assert len(res["vectors"][0]) == 768
-    assert res["title"] == "The title"
+    assert res.sentences == ["The title Some text"]
+    assert res.vectors.shape == (1, 768)
+    assert res.vectors.dtype == np.float32
+    assert res.title == "The title"
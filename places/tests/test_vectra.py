@@ -0,0 +1,383 @@
+import asyncio
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from places.backends._vectra import LocalDB
+from places.backends.ivf import IVFIndex
+from places.backends.quantize import ProductQuantizer, ScalarQuantizer
+from places.backends.vectra import LocalIndex
+from places.bench import synthetic_vectors
+
+
+def _index(tmp_path, vectors):
+    index = LocalIndex(str(tmp_path / "index"))
+    index.create_index()
+
+    async def _fill():
+        for i, vec in enumerate(vectors):
+            await index.upsert_item(
+                {"id": str(i), "vector": list(vec), "metadata": {"n": i}}
+            )
+
+    asyncio.run(_fill())
+    return index
+
+
+def test_query_items(tmp_path):
+    vectors = np.eye(4, 8)
+    vectors[0, 2] = 0.5
+    index = _index(tmp_path, vectors)
+
+    res = asyncio.run(index.query_items(list(vectors[2]), 2))
+
+    assert [hit["item"]["id"] for hit in res] == ["2", "0"]
+    assert res[0]["score"] > res[1]["score"]
+    assert abs(res[0]["score"] - 1) < 1e-5
+
+
+def test_query_items_filter(tmp_path):
+    vectors = np.eye(4, 8) + 0.1
+    index = _index(tmp_path, vectors)
+
+    res = asyncio.run(index.query_items(list(vectors[2]), 10, {"n": {"$lt": 2}}))
+
+    assert sorted(hit["item"]["id"] for hit in res) == ["0", "1"]
+
+
+def test_upsert_and_delete(tmp_path):
+    vectors = np.eye(4, 8)
+    index = _index(tmp_path, vectors)
+
+    async def _update():
+        await index.upsert_item({"id": "0", "vector": list(vectors[3]), "metadata": {}})
+        await index.delete_item("3")
+        return await index.query_items(list(vectors[3]), 1)
+
+    res = asyncio.run(_update())
+
+    assert res[0]["item"]["id"] == "0"
+    assert asyncio.run(index.get_index_stats())["items"] == 3
+
+    # reloading from disk gives the same results
+    reloaded = LocalIndex(str(tmp_path / "index"))
+    res = asyncio.run(reloaded.query_items(list(vectors[3]), 1))
+    assert res[0]["item"]["id"] == "0"
+
+
+def test_migrate_json_index(tmp_path):
+    path = tmp_path / "index"
+    path.mkdir()
+    items = [
+        {"id": str(i), "metadata": {"n": i}, "vector": list(vec), "norm": 1.0}
+        for i, vec in enumerate(np.eye(3, 8))
+    ]
+    with open(path / "index.json", "w") as f:
+        json.dump({"version": 1, "metadata_config": {}, "items": items}, f)
+
+    index = LocalIndex(str(path))
+    res = asyncio.run(index.query_items([0, 1, 0, 0, 0, 0, 0, 0], 1))
+
+    assert res[0]["item"] == {"id": "1", "metadata": {"n": 1}}
+    assert not (path / "index.json").exists()
+
+    reloaded = LocalIndex(str(path))
+    asyncio.run(reloaded.load_index_data())
+    assert isinstance(reloaded._base, np.memmap)
+    assert asyncio.run(reloaded.get_index_stats())["items"] == 3
+
+
+def _items(vectors, start=0):
+    return [
+        {"id": str(i), "vector": list(vec), "metadata": {"n": i}}
+        for i, vec in enumerate(vectors, start)
+    ]
+
+
+def test_compaction(tmp_path):
+    path = tmp_path / "index"
+    index = LocalIndex(str(path), compact_min_rows=4)
+    index.create_index()
+    vectors = np.eye(8)
+
+    async def _update():
+        await index.upsert_items(_items(vectors[:4]))
+        compaction = index._compaction
+        # let the compaction start, then keep updating while it writes
+        await asyncio.sleep(0)
+        await index.upsert_items(_items(vectors[4:5], 4))
+        await index.upsert_item({"id": "0", "vector": list(vectors[5]), "metadata": {}})
+        await index.delete_item("1")
+        await compaction
+
+    asyncio.run(_update())
+
+    assert sorted(os.listdir(path)) == [
+        "header.json",
+        "items.1.json",
+        "lock",
+        "vectors.1.npy",
+        "wal.1.log",
+    ]
+    for idx in (index, LocalIndex(str(path))):
+        assert asyncio.run(idx.get_item("1")) is None
+        assert asyncio.run(idx.get_index_stats())["items"] == 4
+        res = asyncio.run(idx.query_items(list(vectors[5]), 1))
+        assert res[0]["item"]["id"] == "0"
+        res = asyncio.run(idx.query_items(list(vectors[4]), 1))
+        assert res[0]["item"]["id"] == "4"
+
+
+def test_torn_log_record(tmp_path):
+    path = tmp_path / "index"
+    _index(tmp_path, np.eye(3, 8))
+    with open(path / "wal.0.log", "ab") as f:
+        f.write(b"\x10\x00\x00")
+
+    reloaded = LocalIndex(str(path))
+    assert asyncio.run(reloaded.get_index_stats())["items"] == 3
+    asyncio.run(reloaded.upsert_item({"id": "3", "vector": [1] * 8}))
+    assert asyncio.run(LocalIndex(str(path)).get_index_stats())["items"] == 4
+
+
+def test_unlocked_reader(tmp_path):
+    path = tmp_path / "index"
+    writer = _index(tmp_path, np.eye(3, 8))
+    writer._compact_min_rows = 1
+    # a record being written by the writer
+    with open(path / "wal.0.log", "ab") as f:
+        f.write(b"\x10\x00\x00")
+    size = os.path.getsize(path / "wal.0.log")
+
+    reader = LocalIndex(str(path), compact_min_rows=1)
+    assert asyncio.run(reader.get_index_stats())["items"] == 3
+    assert os.path.getsize(path / "wal.0.log") == size
+    with pytest.raises(Exception, match="used by another process"):
+        asyncio.run(reader.upsert_item({"id": "3", "vector": [1] * 8}))
+    asyncio.run(writer.close())
+
+
+def test_reload_during_compaction(tmp_path):
+    path = tmp_path / "index"
+    index = LocalIndex(str(path), compact_min_rows=4)
+    index.create_index()
+    started = threading.Event()
+    release = threading.Event()
+    write_segment = index._write_segment
+
+    def slow_write_segment(*args):
+        started.set()
+        release.wait(5)
+        write_segment(*args)
+
+    index._write_segment = slow_write_segment
+    vectors = np.eye(8)
+
+    async def _update():
+        await index.upsert_items(_items(vectors[:4]))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # the update is reloaded from disk while the segment is written
+        index.cancel_update()
+        threading.Timer(0.1, release.set).start()
+        await index.upsert_items(_items(vectors[4:5], 4))
+        await index.close()
+
+    asyncio.run(_update())
+    assert asyncio.run(LocalIndex(str(path)).get_index_stats())["items"] == 5
+
+
+def test_ivf_index(tmp_path):
+    path = tmp_path / "index"
+    vectors = synthetic_vectors(400, dim=16)
+    ann = IVFIndex(nlist=8, nprobe=8, min_train_rows=100)
+    index = LocalIndex(str(path), compact_min_rows=300, ann=ann)
+    index.create_index()
+
+    async def _update():
+        await index.upsert_items(_items(vectors[:300]))
+        await index._compaction
+        # added after the training, assigned on insertion
+        await index.upsert_items(_items(vectors[300:], 300))
+
+    asyncio.run(_update())
+
+    assert ann.trained
+    assert (path / "ivf.1.npz").exists()
+    for idx in (index, LocalIndex(str(path), ann=IVFIndex(nprobe=8))):
+        for i in (5, 350):
+            res = asyncio.run(idx.query_items(list(vectors[i]), 3))
+            assert res[0]["item"]["id"] == str(i)
+        assert idx._ann.trained
+
+
+def test_quantized_index(tmp_path):
+    vectors = synthetic_vectors(400, dim=16)
+    for quantizer in (
+        ScalarQuantizer(min_train_rows=100),
+        ProductQuantizer(subspaces=4, min_train_rows=100),
+    ):
+        path = tmp_path / quantizer.__class__.__name__
+        index = LocalIndex(str(path), compact_min_rows=300, quantizer=quantizer)
+        index.create_index()
+
+        async def _update(index=index):
+            await index.upsert_items(_items(vectors[:300]))
+            await index._compaction
+            await index.upsert_items(_items(vectors[300:], 300))
+
+        asyncio.run(_update())
+
+        assert quantizer.trained
+        for i in (5, 350):
+            res = asyncio.run(index.query_items(list(vectors[i]), 3))
+            assert res[0]["item"]["id"] == str(i)
+            assert abs(res[0]["score"] - 1) < 1e-5
+        res = asyncio.run(index.query_items(list(vectors[5]), 3, {"n": {"$gt": 5}}))
+        assert len(res) == 3
+        assert all(hit["item"]["metadata"]["n"] > 5 for hit in res)
+
+
+def test_indexed_fields(tmp_path):
+    path = str(tmp_path / "index")
+    index = LocalIndex(path, compact_min_rows=4, indexed_fields=("url",))
+    index.create_index()
+    vectors = np.eye(6, 8)
+
+    async def _update():
+        for i, vec in enumerate(vectors):
+            url = f"http://{'a' if i < 4 else 'b'}.com"
+            await index.upsert_item(
+                {"id": str(i), "vector": list(vec), "metadata": {"url": url}}
+            )
+        # moves an item to another url
+        await index.upsert_item(
+            {"id": "0", "vector": list(vectors[0]), "metadata": {"url": "http://b.com"}}
+        )
+        await index.delete_items(await index.list_ids_by_field("url", "http://a.com"))
+        await index.close()
+
+    asyncio.run(_update())
+    assert asyncio.run(index.list_field_values("url")) == ["http://b.com"]
+    assert asyncio.run(index.get_index_stats())["items"] == 3
+
+    # the field index is rebuilt from disk
+    reloaded = LocalIndex(path, indexed_fields=("url",))
+    ids = asyncio.run(reloaded.list_ids_by_field("url", "http://b.com"))
+    assert sorted(ids) == ["0", "4", "5"]
+    assert asyncio.run(reloaded.list_ids_by_field("url", "http://a.com")) == []
+
+
+def test_reindex_shorter_page(tmp_path):
+    async def _run():
+        client = LocalDB(vectra_path=str(tmp_path / "index"))
+        await client.init_db()
+
+        def points(url, count):
+            return [
+                client.create_point(i, url, "title", np.ones(8) + i, f"s {i}")
+                for i in range(count)
+            ]
+
+        await client.index(points("http://a.com", 30) + points("http://b.com", 5))
+        await client.index(points("http://a.com", 10))
+        await client.close()
+
+        # the replacement was a single log append
+        reloaded = LocalDB(vectra_path=str(tmp_path / "index"))
+        assert (await reloaded.get_db_info())["vectors_count"] == 15
+        await reloaded.close()
+
+    asyncio.run(_run())
+
+
+def test_filtered_search(tmp_path):
+    async def _run():
+        client = LocalDB(
+            vectra_path=str(tmp_path / "index"), ann="ivf", ann_nlist=4, ann_nprobe=1
+        )
+        await client.init_db()
+        client._index._compact_min_rows = 50
+        client._index._ann.min_train_rows = 50
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(120, 16))
+        urls = ["http://www.a.com/1", "http://b.a.com/2", "http://c.com/3"]
+        for i, url in enumerate(urls):
+            lang = "french" if i == 2 else "english"
+            await client.index(
+                [
+                    client.create_point(j, url, "t", vec, f"{i}-{j}", lang=lang, ts=i)
+                    for j, vec in enumerate(vectors[i * 40 : (i + 1) * 40])
+                ]
+            )
+        await client.close()
+        assert client._index._ann.trained
+
+        async def search(vec, **filters):
+            hits = [hit async for hit in client.search(vec, 5, filters=filters)]
+            return {hit["url"] for hit in hits}
+
+        # the filtered points are also looked up outside of the probed cluster
+        query = vectors[100]
+        assert await search(query) >= {"http://c.com/3"}
+        assert await search(query, domain="a.com") == set(urls[:2])
+        assert await search(query, domain="b.a.com") == {urls[1]}
+        assert await search(query, domain="z.com") == set()
+        assert await search(query, lang="english", before=1) == {urls[0]}
+        assert await search(query, after=1) == set(urls[1:])
+        hits = [
+            hit async for hit in client.search(query, 1, filters={"lang": "french"})
+        ]
+        assert hits[0]["sentence"] == "2-20"
+
+    asyncio.run(_run())
+
+
+def test_index_lock(tmp_path):
+    async def _run():
+        path = str(tmp_path / "index")
+        server = LocalDB(vectra_path=path)
+        await server.init_db()
+        with pytest.raises(Exception, match="used by another process"):
+            await LocalDB(vectra_path=path).init_db()
+        await server.close()
+        bulk = LocalDB(vectra_path=path)
+        await bulk.init_db()
+        await bulk.close()
+
+    asyncio.run(_run())
+
+
+def test_backfill(tmp_path):
+    async def _run():
+        path = str(tmp_path / "index")
+        # points indexed before the filters
+        index = LocalIndex(path)
+        index.create_index()
+        await index.upsert_items(
+            [
+                {"id": str(i), "vector": list(vec), "metadata": {"url": url}}
+                for i, (url, vec) in enumerate(
+                    zip(
+                        ["http://www.a.com/1", "http://b.com/2"],
+                        np.eye(2, 8),
+                        strict=True,
+                    )
+                )
+            ]
+        )
+        await index.close()
+
+        client = LocalDB(vectra_path=path)
+        await client.init_db()
+        assert await client.domain_urls("a.com") == ["http://www.a.com/1"]
+        hits = client.search(np.eye(8)[1], 10, filters={"domain": "a.com"})
+        assert [hit["url"] async for hit in hits] == ["http://www.a.com/1"]
+        assert await client.count_unfiltered() == 2
+        assert await client.backfill() == 0
+        await client.close()
+
+    asyncio.run(_run())
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from places.workers import WorkerPool, receive_array, share_array
+
+
+def test_shared_array():
+    array = np.arange(12, dtype=np.float64).reshape(3, 4)
+    name, shape = share_array(array)
+
+    received = receive_array(name, shape)
+    assert received.dtype == np.float32
+    np.testing.assert_array_equal(received, array)
+
+    # the block is freed once received
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+    name, shape = share_array(np.empty((0, 4)))
+    assert receive_array(name, shape).shape == (0, 4)
+
+
+def test_cancelled_shared_array():
+    pool = WorkerPool(workers=1, models=False)
+    pool.shutdown()
+    pool.executor = ThreadPoolExecutor(1)
+    release = threading.Event()
+    names = []
+
+    def share():
+        release.wait(5)
+        name, shape = share_array(np.ones(4))
+        names.append(name)
+        return name, shape
+
+    async def _run():
+        task = asyncio.create_task(pool.run_shared(share))
+        await asyncio.sleep(0.05)
+        # the client is gone while the worker is running
+        task.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        while not names:
+            await asyncio.sleep(0.01)
+        # lets the done callback run
+        await asyncio.sleep(0.05)
+
+    asyncio.run(_run())
+    pool.shutdown()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=names[0])
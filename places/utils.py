@@ -4,20 +4,19 @@ import os
 import re
 from contextlib import asynccontextmanager
 from functools import cache
-from urllib.parse import urlparse
 
 import fasttext
 import nltk
 import numpy as np
-from bs4 import BeautifulSoup
 from nltk.langnames import langname
 from sentence_transformers import util
 from transformers import pipeline
 
-from places.config import URL_SKIP_LIST
+from places.extract import extract_html
 from places.lexrank import degree_centrality_scores
+from places.policy import domain_policy
 
-_QA = pipeline("question-answering", model="distilbert-base-cased-distilled-squad")
+_QA = None
 
 
 _WEBEXT_VERSION = None
@@ -45,15 +44,8 @@ def extract_text(filename):
         return "\n\n".join(pdf).strip()
 
 
-def should_skip(url, cache=None):
-    url_hostname = urlparse(url).hostname
-    if url_hostname in URL_SKIP_LIST:
-        return True
-    if cache is not None:
-        if url in cache:
-            if cache[url] != "error" and cache[url] != "unreadable":
-                return True
-    return False
+def should_skip(url):
+    return domain_policy.is_skipped(url)
 
 
 class Tasks:
@@ -158,25 +150,24 @@ def tokenize(text, lang=None):
 
 
 def tokenize_html(html):
-    soup = BeautifulSoup(html, "html.parser")
-    try:
-        title = soup.title
-        if title is None:
-            title = ""
-        else:
-            title = title.string
-    except Exception:
-        title = ""
-
-    title = _RE_TEXT.sub(" ", title).strip()
-    text = soup.get_text()
+    title, text = extract_html(html)
     lang = detect_lang(text)
     return title, tokenize(text, lang), lang, text
 
 
+def get_qa():
+    """Returns the question answering pipeline, loaded on first use."""
+    global _QA
+    if _QA is None:
+        _QA = pipeline(
+            "question-answering", model="distilbert-base-cased-distilled-squad"
+        )
+    return _QA
+
+
 @cache
 def answer(question, context):
-    return _QA(context=context, question=question)
+    return get_qa()(context=context, question=question)
 
 
 def build_answer(url, question, text):
@@ -1,5 +1,4 @@
 import functools
-import json
 import time
 import traceback as tb
 from multiprocessing import current_process
@@ -8,77 +7,120 @@ import aiohttp
 import ujson
 from sentence_transformers import SentenceTransformer
 
-from places.db import Pages
+from places.chunking import chunk_sentences, get_sentence_hashes
+from places.db import PAGES_DIR, Pages
+from places.index.state import INDEXED, IndexState
 from places.utils import task_pool, tokenize_html
 
-_MODEL = "multi-qa-distilbert-cos-v1"
-# _MODEL = 'distiluse-base-multilingual-cased-v1'
+MODEL = "multi-qa-distilbert-cos-v1"
+# MODEL = 'distiluse-base-multilingual-cased-v1'
 
-model = SentenceTransformer(_MODEL)
-pages_db = Pages("/tmp/pages")
+_model = None
+pages_db = Pages(PAGES_DIR)
 
 
-def json_error(func):
-    @functools.wraps(func)
-    def _json_error(*args, **kw):
+def get_model():
+    """Returns the sentence model, loaded on first use."""
+    global _model
+    if _model is None:
+        _model = SentenceTransformer(MODEL)
+    return _model
+
+
+def extract_page(url, html):
+    """Extracts the title, sentences and language of a page.
+
+    Sentences are chunked, and the ones already indexed for other pages
+    are dropped. The extracted text is stored in the pages db.
+
+    Returns a (title, sentences, lang, text) tuple.
+    """
+    title, sentences, lang, text = tokenize_html(html)
+    sentences = get_sentence_hashes().dedup(url, chunk_sentences(sentences))
+    pages_db.set(url, {"text": text})
+    return title, sentences, lang, text
+
+
+def extract_pages(pages):
+    """Runs extract_page on a list of (url, html) pages.
+
+    Returns the result of each page, or the exception it failed with.
+    """
+    results = []
+    for url, html in pages:
         try:
-            return func(*args, **kw)
+            results.append(extract_page(url, html))
         except Exception as e:
-            return json.dumps(
-                {
-                    "error": repr(e),
-                    "tb": "".join(tb.format_exception(None, e, e.__traceback__)),
-                }
-            )
+            results.append(e)
+    return results
 
-    return _json_error
 
+def embed(sentences):
+    """Returns the float32 embeddings of the sentences, as one batch."""
+    return get_model().encode(
+        sentences, batch_size=max(len(sentences), 1), convert_to_numpy=True
+    )
 
-@json_error
-def build_vector(data):
-    """Vectorizes a page.
 
-    1. Extracts the title and text using BeautifulSoup
-    2. Segmentizes the text
-    3. Create embeddings for each sentences using SentenceTransformer
+class PageVectors:
+    """Sentences of a page, with their embeddings.
+
+    `vectors` is a (len(sentences), dim) float32 array, passed as is
+    to the backends. `content_hash` is the hash of the html, stored once
+    the page is indexed.
+    """
+
+    def __init__(self, url, title, sentences, lang, text, vectors, content_hash=None):
+        self.url = url
+        self.title = title
+        self.sentences = sentences
+        self.lang = lang
+        self.text = text
+        self.vectors = vectors
+        self.content_hash = content_hash
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def points(self, client):
+        """Returns the points of the sentences, for `client.index`.
+
+        Points are dated with the time they are indexed.
+        """
+        ts = time.time()
+        return [
+            client.create_point(
+                idx, self.url, self.title, vec, sentence, lang=self.lang, ts=ts
+            )
+            for idx, (vec, sentence) in enumerate(
+                zip(self.vectors, self.sentences, strict=True)
+            )
+        ]
 
-    Accepts a JSON-encoded mapping containing the url and text.
-    The data is passed as a string so it can be pickled.
 
-    Returns a JSON-encoded mapping containing:
+def build_vector(url, html):
+    """Vectorizes a page.
 
-    - vectors: a list of vectors
-    - sentences: a list of sentences
-    - title: the title of the page
+    1. Extracts the title and main text with places.extract
+    2. Segmentizes the text, and chunks and deduplicates the sentences
+    3. Create embeddings for each sentences using SentenceTransformer
 
+    Returns a PageVectors.
     """
-    data = json.loads(data)
-    url = data["url"]
-    text = data["text"]
     cp = current_process()
     print(f"[extractor][{cp.pid}] working on {url}")
     start = time.time()
     sentences = []
     try:
         print(f"[extractor][{cp.pid}] tokenizing html")
-        title, sentences, lang, text = tokenize_html(text)
+        title, sentences, lang, text = extract_page(url, html)
         print(f"[extractor][{cp.pid}] done, title is {title}")
-        pages_db.set(url, {"text": text})
-        sentences = list(sentences)
 
         print(f"[extractor][{cp.pid}] running model on sentences")
-        embeddings = model.encode(sentences, show_progress_bar=True)
+        embeddings = embed(sentences)
         print(f"[extractor][{cp.pid}] done")
 
-        return json.dumps(
-            {
-                "vectors": embeddings.tolist(),
-                "sentences": sentences,
-                "title": title,
-                "lang": lang,
-                "text": text,
-            }
-        )
+        return PageVectors(url, title, sentences, lang, text, embeddings)
     except Exception as e:
         trace = "".join(tb.format_exception(None, e, e.__traceback__))
         e = repr(e)
@@ -91,9 +133,10 @@ def build_vector(data):
 
 
 class Upserter:
-    def __init__(self, queue, server="http://localhost:8080"):
+    def __init__(self, queue, server="http://localhost:8080", state=None):
         self.queue = queue
         self.server = server
+        self.state = state or IndexState()
 
     async def post_url(self, client, url, text):
         try:
@@ -103,9 +146,12 @@ class Upserter:
                 res = await resp.json()
                 if resp.status > 299:
                     print(res["error"])
+                    self.state.failed(url, res["error"])
                     return None
+            self.state.set(url, INDEXED)
         except Exception as e:
             print(f"[scrap] Could not post {url} {e}")
+            self.state.failed(url, e)
             return None
 
     async def run(self):
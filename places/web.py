@@ -3,13 +3,13 @@ Web app
 """
 import logging
 import os
-from collections import OrderedDict
 from uuid import uuid4
 
 from aiohttp import web
 
 from places.apis import apis
 from places.app import PlacesApplication
+from places.filters import FILTERS, search_filters
 from places.utils import build_answer
 
 HERE = os.path.dirname(__file__)
@@ -23,33 +23,19 @@ ANSWERS = {}
 async def search(request):
     q = request.query["q"].strip()
     question = q.endswith("?")
-
-    res = OrderedDict()
-
-    urls = []
+    params = {name: request.query.get(name, "").strip() for name in FILTERS}
+    try:
+        filters = search_filters(**params)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e)) from e
 
     print("Querying..")
-
-    for hit in await request.app.query(q):
-        url = hit["url"]
-        title = hit["title"]
-        key = url, title
-        sentence = hit["sentence"]
-        if url not in urls:
-            urls.append(url)
-
-        if key in res:
-            if sentence not in res[key]:
-                res[key].append(sentence)
-        else:
-            res[key] = [sentence]
-
-    hits = [list(k) + [sentences] for k, sentences in res.items()]
+    hits, urls = await request.app.search(q, filters=filters)
 
     if question and len(urls) > 0:
         uuid = str(uuid4())
         url = urls[0]
-        text = request.app.pages_db.get(url)["text"]
+        text = request.app.pages_db.get(url, html=False)["text"]
 
         # keep only the last ten entries
         if len(ANSWERS) > 10:
@@ -64,6 +50,7 @@ async def search(request):
     args = {
         "hits": hits,
         "query": q,
+        "filters": {name: value for name, value in params.items() if value},
         "answer_uuid": uuid,
     }
     return await request.app.html_resp("index.html", **args)
@@ -82,6 +69,7 @@ async def admin(request):
     args = {
         "indexed": indexed,
         "skipped": skipped,
+        "purge_jobs": [job.stats() for job in request.app.purge_jobs.values()],
     }
 
     return await request.app.html_resp("admin.html", **args)
@@ -98,6 +86,5 @@ def main(args):
     app.add_routes(routes)
     app.add_routes(apis)
     app.add_routes([web.static("/static", STATIC)])
-    app.init_db()
     print("Starting semantic bookmarks server...")
     web.run_app(app, port=8080)
@@ -0,0 +1,125 @@
+"""
+Worker processes for the CPU-heavy work: html extraction, embeddings
+and answers.
+
+Workers are spawned rather than forked: forking a process that already
+runs torch threads can deadlock, which used to block the server in
+docker. Each worker loads the models once, in its initializer.
+
+Embeddings come back through shared memory instead of being pickled.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+def _init_worker(threads, models):
+    if not models:
+        # loads the language detection model
+        import places.utils  # noqa: F401
+
+        return
+
+    import torch
+
+    from places.vectors import get_model
+
+    torch.set_num_threads(threads)
+    get_model()
+
+
+def share_array(array):
+    """
+    Copies a float32 array in a new shared memory block.
+
+    Returns the (name, shape) to pass to receive_array().
+    """
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=np.float32, buffer=shm.buf)[:] = array
+    # the receiving process frees the block
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, array.shape
+
+
+def _encode(sentences):
+    from places.vectors import embed
+
+    return share_array(embed(sentences))
+
+
+def receive_array(name, shape):
+    """
+    Copies a float32 array out of a shared memory block, and frees it.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _free_result(future):
+    """
+    Frees the block of an array shared by a worker nobody waits for.
+    """
+    if not future.cancelled() and future.exception() is None:
+        receive_array(*future.result())
+
+
+class WorkerPool:
+    """
+    Spawned worker processes. With `models` unset, the sentence model
+    is not loaded upfront, for pools that only extract text.
+
+    `threads` is the number of torch threads of each worker; by default
+    the workers share the cores.
+    """
+
+    def __init__(self, workers=2, models=True, threads=None):
+        self.workers = workers
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(threads, models),
+        )
+
+    async def run(self, function, *args):
+        """
+        Runs a picklable function in a worker.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def run_shared(self, function, *args):
+        """
+        Runs a function returning an array with share_array() in a
+        worker, and returns the array.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, function, *args)
+        try:
+            name, shape = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the worker may still share the array, which is then freed
+            future.add_done_callback(_free_result)
+            raise
+        return receive_array(name, shape)
+
+    async def encode(self, sentences):
+        """
+        Returns the float32 embeddings of the sentences.
+        """
+        return await self.run_shared(_encode, list(sentences))
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)